@@ -130,6 +130,42 @@ USE_TZ = True
 STATIC_ROOT = BASE_DIR / "staticfiles"
 STATIC_URL = 'static/'
 
+# загруженные файлы (ImportJob)
+MEDIA_ROOT = BASE_DIR / "media"
+MEDIA_URL = 'media/'
+# разобранные строки загруженных файлов (ImportManager(is_cached=True)), общие для сайта и importworker
+IMPORT_PARSE_CACHE_DIR = BASE_DIR / "import_cache"
+# отчеты загрузок (sert.importreport) - пишет сайт или importworker, скачивает сайт
+IMPORT_REPORT_DIR = BASE_DIR / "import_reports"
+# процессы печати сертификатов (sert.createdocx2.GroupManager); 1 - печать в процессе сайта
+PRINT_RENDER_WORKERS = 1
+# пул процессов печати из запроса сайта: fork в многопоточном процессе сайта может зависнуть (sert.workers),
+# включать только при однопоточных процессах сайта (например, gunicorn с sync workers)
+PRINT_RENDER_IN_REQUEST = False
+# пачка сертификатов отдается архивом по мере печати (StreamingHttpResponse), а не собирается целиком в памяти
+PRINT_STREAMING_ZIP = True
+# собранные документы сертификатов по отпечатку данных (sert.createdocx2.get_docx_cache_key), общие для процессов сайта
+PRINT_DOCX_CACHE_DIR = BASE_DIR / "print_cache"
+# замеры этапов печати (sert.printtrace) - строками JSON в лог sert.printtrace; выключены - без затрат
+PRINT_TRACE = False
+
+# замеры этапов загрузки (sert.importxlsx) - в консоль сайта и importworker
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'sert': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
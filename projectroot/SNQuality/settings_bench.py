@@ -0,0 +1,13 @@
+# настройки для замера загрузки (manage.py importbench): все как в settings, но база - локальный файл SQLite
+from SNQuality.settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'importbench.sqlite3',
+        # тесты (manage.py test) - тоже в файле: база в памяти не дает потокам теста писать одновременно
+        'TEST': {
+            'NAME': BASE_DIR / 'test_importbench.sqlite3',
+        },
+    }
+}
@@ -8,6 +8,7 @@ from sert.models import (
     Signatories,
     Conclusion,
     Guarantee,
+    ImportJob,
 )
 from sert.forms import (
     SertNumberForm,
@@ -348,6 +349,23 @@ class GuaranteeAdmin(admin.ModelAdmin):
             'guarantee_text',
         )
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = (
+        'id',
+        'file_name',
+        'user',
+        'status',
+        'created_at',
+        'finished_at',
+        'attempts',
+        'parsed_count',
+        'validated_count',
+        'saved_count',
+    )
+    list_filter = (
+        'status',
+    )
+
 admin.site.register(SertNumber, SertNumberAdmin)
 admin.site.register(Sert, SertAdmin)
 admin.site.register(Kernel, KernelAdmin)
@@ -356,6 +374,7 @@ admin.site.register(Melt, MeltAdmin)
 admin.site.register(Signatories, SignatoriesAdmin)
 admin.site.register(Conclusion, ConclusionAdmin)
 admin.site.register(Guarantee, GuaranteeAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
 
 admin.site.site_title = 'Страница администратора'
 admin.site.site_header = 'Страница администратора'
\ No newline at end of file
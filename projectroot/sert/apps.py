@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class SertConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sert'
+
+    def ready(self):
+        # изменения справочников сбрасывают их cache в процессах печати (sert.models_refdata)
+        from sert.models_refdata import connect_reference_data_signals
+        connect_reference_data_signals()
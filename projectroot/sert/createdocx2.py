@@ -1,25 +1,48 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+from contextlib import nullcontext
 from decimal import Decimal
 from abc import ABC
-
+from io import BytesIO
+import copy
+import hashlib
+import json
+import os
+import re
+from xml.sax.saxutils import escape
+
+from django.conf import settings
 from django.contrib import messages
-from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Model, Q
 from django.db.models.expressions import result
 from docx import Document
 from docx.enum.section import WD_ORIENT
 from docx.shared import Pt, Mm, RGBColor
 from docx.oxml import OxmlElement, parse_xml
 from docx.oxml.ns import nsdecls
+from docx.oxml.shape import CT_Inline
 from docx.enum.text import WD_LINE_SPACING, WD_ALIGN_PARAGRAPH, WD_PARAGRAPH_ALIGNMENT
 from docx.enum.table import WD_TABLE_ALIGNMENT, WD_ALIGN_VERTICAL
-from sert.models import Sert, Kernel, Attachment, Melt, Guarantee, Conclusion, Signatories
+from sert.models import Sert, Kernel, Attachment, Melt
 from sert.models_data_bygost import ByGost
+from sert.diskcache import DiskLRUCache
+from sert.models_refdata import get_reference_data
+from sert.printtrace import NULL_TRACER, PrintTracer, get_print_tracer
+from sert.workers import get_process_pool
+
+# параллельная печать (settings.PRINT_RENDER_WORKERS > 1) - только для пачек не меньше этого числа сертификатов:
+# на малой пачке запуск процессов дороже самой печати
+PARALLEL_MIN_SERTS = 4
+# cache собранных документов в settings.PRINT_DOCX_CACHE_DIR: общий размер записей (байт)
+DOCX_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# версия печати: увеличить при любом изменении DocxMaker или DocxSkeleton, иначе из cache придут прежние документы
+DOCX_CACHE_VERSION = 2
 
 
 class SertIncarnation:
     def __init__(self, sert, kernel_data, attach_data, melt_data):
         # данные из model
         self.sert = sert
+        self.sert_id = sert.id
         self.kernel_data = kernel_data
         self.attach_data = attach_data
         self.melt_data = melt_data
@@ -538,36 +561,35 @@ class StaticTabsMaker:
             ),
         ]
         for cond in CONDITIONS:
-            data_parent = []
-            if not cond.is_first_selection:
-                for i in result_tab:
-                    if i.__getattribute__(cond.data_parent_selection_condition):
-                        data_parent.append(i)
-            else:
-                data_parent.append('plug')
+            # дети уровня - по индексу родителя (b_index/b1_index/b2_index): родитель берет своих детей
+            # из словаря, а не перебором всех строк уровня; порядок детей - как в attach_data
             data_child = []
+            children_index = {}
             for i in attach_data:
                 if i.__getattribute__(cond.data_child_selection_condition):
                     data_child.append(i)
+                    if not cond.is_first_selection:
+                        child_key = i.__getattribute__(cond.child_comparison_condition)
+                        children_index.setdefault(child_key, []).append(i)
             tab = []
-            for i in data_parent:
+            if cond.is_first_selection:
                 cnt = 1
                 for j in data_child:
-                    if not cond.is_first_selection:
-                        if (i.__getattribute__(cond.parent_comparison_condition) ==
-                                j.__getattribute__(cond.child_comparison_condition)):
-                            cnt_str = f'{i.order_num}.{cnt}'
-                            quantity = j.quantity * Decimal(i.quantity)
-                            tab = self.create_row_for_parts_tab(tab, j, cnt_str, quantity, model_row, fields_list,)
-                            cnt += 1
-                    else:
-                        cnt_str = str(cnt)
-                        quantity = j.quantity * kernel_data.quantity
+                    cnt_str = str(cnt)
+                    quantity = j.quantity * kernel_data.quantity
+                    tab = self.create_row_for_parts_tab(tab, j, cnt_str, quantity, model_row, fields_list,)
+                    cnt += 1
+            else:
+                for i in result_tab:
+                    if not i.__getattribute__(cond.data_parent_selection_condition):
+                        continue
+                    cnt = 1
+                    for j in children_index.get(i.__getattribute__(cond.parent_comparison_condition), []):
+                        cnt_str = f'{i.order_num}.{cnt}'
+                        quantity = j.quantity * Decimal(i.quantity)
                         tab = self.create_row_for_parts_tab(tab, j, cnt_str, quantity, model_row, fields_list,)
                         cnt += 1
-            if tab:
-                for i in tab:
-                    result_tab.append(i)
+            result_tab += tab
         return result_tab
 
     @staticmethod
@@ -757,9 +779,14 @@ class StaticTabsMaker:
 
 
 class SertTabsMaker(StaticTabsMaker):
-    def __init__(self, sert_incarnation):
+    def __init__(self, sert_incarnation, reference_data=None, tracer=NULL_TRACER):
         super().__init__()
         self.si = sert_incarnation
+        self.tracer = tracer
+        # Conclusion, Guarantee, Signatories из cache процесса (ReferenceData) - без запросов на сертификат
+        if reference_data is None:
+            reference_data = get_reference_data()
+        self.reference_data = reference_data
         self.create_tabs()
 
     def create_tabs(self):
@@ -772,10 +799,12 @@ class SertTabsMaker(StaticTabsMaker):
             'ctk_mech_tab': 'create_ctk_mech_tab',
             'ctk_chem_tab': 'create_ctk_chem_tab',
         }
-        self.create_docx_tab()
-        self.create_main_tab()
+        # строки этапа - вложения сертификата, из которых строится таблица
+        rows = len(self.si.attach_data or [])
+        self.tracer.call('create_docx_tab', self.si.sert_id, self.create_docx_tab)
+        self.tracer.call('create_main_tab', self.si.sert_id, self.create_main_tab)
         for tab_name in self.si.tabs_names_list:
-            self.__getattribute__(NAMES[tab_name]).__call__()
+            self.tracer.call(NAMES[tab_name], self.si.sert_id, self.__getattribute__(NAMES[tab_name]), rows=rows)
 
     # создать данные внешнего вида docx документа
     def create_docx_tab(self):
@@ -844,23 +873,23 @@ class SertTabsMaker(StaticTabsMaker):
         sert_number = f'{sert_format_date}-{sert_str_number}'
         di['sert_number'] = sert_number
         di['date'] = date
-        try:
-            conclusion = Conclusion.objects.get(conclusion_type=self.si.head_gost_str)
-            di['head_gost_str'] = conclusion.conclusion_text
-        except ObjectDoesNotExist:
+        reference_data = self.reference_data
+        head_gost_text = reference_data.get_conclusion_text(self.si.head_gost_str)
+        if head_gost_text is not None:
+            di['head_gost_str'] = head_gost_text
+        else:
             error_text = (f'DataTabs.create_docx_tab: сертификат {self.si.sert.number_unique.id} '
                           f'ссылку на не предусмотренный ГОСТ для шапки сертификата - {self.si.head_gost_str}. '
                           f'Установлен тип "CTK_HEAD"')
             error = (messages.ERROR, error_text)
             self.si.errors_list.append(error)
-            default_val = Conclusion.objects.get(conclusion_type='CTK_HEAD')
-            di['head_gost_str'] = default_val.conclusion_text
+            di['head_gost_str'] = reference_data.get_conclusion_text('CTK_HEAD')
 
         # для работы setting_conclusion DocxMaker
         if not self.si.sert.guarantee_type:
             di['guarantee_text'] = None
         else:
-            guarantees = Guarantee.objects.filter(guarantee_type=self.si.sert.guarantee_type)
+            guarantees = reference_data.get_guarantee_texts(self.si.sert.guarantee_type)
             if not guarantees:
                 error_text = (f'DataTabs.create_docx_tab: сертификат {self.si.sert.number_unique.id} '
                               f'ссылку на не предусмотренный тип гарантии - {self.si.sert.guarantee_type}.')
@@ -868,10 +897,7 @@ class SertTabsMaker(StaticTabsMaker):
                 self.si.errors_list.append(error)
                 di['guarantee_text'] = None
             else:
-                texts = []
-                for t in guarantees:
-                    texts.append(t.guarantee_text)
-                di['guarantee_text'] = ', '.join(texts)
+                di['guarantee_text'] = ', '.join(guarantees)
         di['is_drag_met'] = self.si.sert.is_drag_met
         if not self.si.conclusion_type:
             error_text = (f'DataTabs.create_docx_tab: сертификат {self.si.sert.number_unique.id} '
@@ -879,20 +905,18 @@ class SertTabsMaker(StaticTabsMaker):
                           f'Установлен тип "MAIN"')
             error = (messages.ERROR, error_text)
             self.si.errors_list.append(error)
-            default_val = Conclusion.objects.get(conclusion_type='MAIN')
-            di['conclusion_text'] = default_val.conclusion_text
+            di['conclusion_text'] = reference_data.get_conclusion_text('MAIN')
         else:
-            try:
-                conclusion = Conclusion.objects.get(conclusion_type=self.si.conclusion_type)
-                di['conclusion_text'] = conclusion.conclusion_text
-            except ObjectDoesNotExist:
+            conclusion_text = reference_data.get_conclusion_text(self.si.conclusion_type)
+            if conclusion_text is not None:
+                di['conclusion_text'] = conclusion_text
+            else:
                 error_text = (f'DataTabs.create_docx_tab: сертификат {self.si.sert.number_unique.id} '
                               f'ссылку на не предусмотренный тип заключения - {self.si.conclusion_type}. '
                               f'Установлен тип "MAIN"')
                 error = (messages.ERROR, error_text)
                 self.si.errors_list.append(error)
-                default_val = Conclusion.objects.get(conclusion_type='MAIN')
-                di['conclusion_text'] = default_val.conclusion_text
+                di['conclusion_text'] = reference_data.get_conclusion_text('MAIN')
 
         # для работы setting_signs DocxMaker
         if not self.si.sign_type:
@@ -901,11 +925,11 @@ class SertTabsMaker(StaticTabsMaker):
                           f'Установлен тип "MAIN"')
             error = (messages.ERROR, error_text)
             self.si.errors_list.append(error)
-            di['signatories_list'] = Signatories.objects.filter(sign_type='MAIN')
+            di['signatories_list'] = reference_data.get_signatories('MAIN')
         else:
-            signs = Signatories.objects.filter(sign_type=self.si.sign_type)
+            signs = reference_data.get_signatories(self.si.sign_type)
             if not signs:
-                di['signatories_list'] = Signatories.objects.filter(sign_type='MAIN')
+                di['signatories_list'] = reference_data.get_signatories('MAIN')
                 error_text = (f'DataTabs.create_docx_tab: сертификат {self.si.sert.number_unique.id} '
                               f'ссылку на не предусмотренный тип подписантов - {self.si.sign_type}. '
                               f'Установлен тип "MAIN"')
@@ -1096,15 +1120,16 @@ class SertTabsMaker(StaticTabsMaker):
                                                                                            model_row, fields_list,
                                                                                            self.si.melt_anatomy,)
         if asymm_melts_rows:
+            # плавки сертификата уже загружены в melt_data
+            melts_dict = {melt.melt_id: melt for melt in self.si.melt_data or []}
             asymm_melts = {}
             for i in range(1, len(asymm_melts_rows) + 1):
                 asymm_melts_list = []
                 for m in asymm_melts_rows[i]:
                     melt_id = f'{m.melt_number}-{m.material_id}-{m.melt_year}-{m.melt_passport}'
-                    try:
-                        melt = Melt.objects.get(melt_id=melt_id)
-                        asymm_melts_list.append(melt)
-                    except ObjectDoesNotExist:
+                    if melt_id in melts_dict:
+                        asymm_melts_list.append(melts_dict[melt_id])
+                    else:
                         error_text = (f'SertTabsMaker: {melt_id} не найдена в Melt')
                         error = (messages.ERROR, error_text)
                         self.si.errors_list.append(error)
@@ -1335,11 +1360,8 @@ class SertTabsMaker(StaticTabsMaker):
             conclusion_type = None
 
             def get_conc_text(search_param):
-                list_co = Conclusion.objects.filter(conclusion_type=search_param)
-                if list_co:
-                    CO = list_co[0]
-                    result = CO.conclusion_text
-                else:
+                result = self.reference_data.get_conclusion_text(search_param)
+                if result is None:
                     result = f'Нет такого Conclusion: {search_param}'
                 return result
 
@@ -1400,6 +1422,55 @@ class ModelDataLoader:
         return data
 
 
+class BatchModelDataLoader(ModelDataLoader):
+    # те же get_*_data, но из памяти: вложения и плавки всех сертификатов на печать
+    # загружаются заранее (prefetch_model_data) - по одному запросу на model
+    def __init__(self):
+        self.attachments_by_spg = {}  # {(number_spg, sert_type): [Attachment, ...]}
+        self.attachments_by_number = {}  # {(number_spg, sert_type, number_unique): [Attachment, ...]}
+        self.numbers_with_attachments = set()  # number_unique, на которые ссылается хоть одно вложение
+        self.melts_dict = {}  # {melt_id: Melt}
+
+    def prefetch_model_data(self, attach_serts, melt_serts):
+        # attach_serts - сертификаты, которым нужны вложения, melt_serts - еще и плавки
+        spg_list = {sert.number_spg_id for sert in attach_serts}
+        numbers_list = {sert.number_unique_id for sert in attach_serts}
+        if not spg_list:
+            return
+        attachments = (Attachment.objects.filter(Q(number_spg__in=spg_list) | Q(number_unique__in=numbers_list))
+                       .order_by('pk'))
+        melt_keys = {(sert.number_spg_id, sert.sert_type) for sert in melt_serts}
+        melt_ids = set()
+        for attach in attachments:
+            spg_key = (attach.number_spg_id, attach.sert_type)
+            if attach.number_unique_id is not None:
+                self.numbers_with_attachments.add(attach.number_unique_id)
+            self.attachments_by_spg.setdefault(spg_key, []).append(attach)
+            self.attachments_by_number.setdefault(spg_key + (attach.number_unique_id,), []).append(attach)
+            if spg_key in melt_keys:
+                melt_ids.add(self.get_melt_id(attach))
+        if melt_ids:
+            self.melts_dict = Melt.objects.in_bulk(list(melt_ids))
+
+    @staticmethod
+    def get_melt_id(attachment_data_item):
+        a = attachment_data_item
+        return f'{a.melt_number}-{a.material_id}-{a.melt_year}-{a.melt_passport}'
+
+    def get_attachment_data(self, sert):
+        # как ModelDataLoader: по номеру сертификата, если на него ссылаются вложения, иначе по number_spg и типу
+        spg_key = (sert.number_spg_id, sert.sert_type)
+        if sert.number_unique_id not in self.numbers_with_attachments:
+            return self.attachments_by_spg.get(spg_key, [])
+        return self.attachments_by_number.get(spg_key + (sert.number_unique_id,), [])
+
+    def get_melt_data(self, attachment_data_item):
+        melt = self.melts_dict.get(self.get_melt_id(attachment_data_item))
+        if melt is None:
+            return []
+        return [melt]
+
+
 class DocxMakerStatic(ABC):
 
     @staticmethod
@@ -1416,28 +1487,15 @@ class DocxMakerStatic(ABC):
         first_row_props.append(tbl_header)  # now first row is the header row
         return table
 
-    # to change background colour of the column cells
-    @staticmethod
-    def change_columns_background(row_count, *columns, color='grey1'):
-        COLORS = {
-            'grey1': r'<w:shd {} w:fill="E0E0E0"/>'.format(nsdecls('w')),
-            'grey2': r'<w:shd {} w:fill="C0C0C0"/>'.format(nsdecls('w')),
-            'grey3': r'<w:shd {} w:fill="A0A0A0"/>'.format(nsdecls('w')),
-        }
-        for i in range(0, row_count + 1):
-            shading_elm_1 = parse_xml(COLORS[color])
-            columns[0].cells[i]._tc.get_or_add_tcPr().append(shading_elm_1)
-
     # ???
     # расширять/сужать строки в зависимости от длинны таблицы
     @staticmethod
-    def tune_up_table_rows_heights(table):
-        len_tab = len(table.rows) - 1
+    def tune_up_table_rows_heights(builder):
+        # builder - DocxTableBuilder внешней таблицы; высота задается всем ее строкам, включая шапку и строки
+        # с вложенными таблицами; у вложенных DocxTableBuilder row_height остается None
+        len_tab = builder.get_rows_count() - 1
         if ((21 < len_tab) and (len_tab < 33)) or ((68 < len_tab) and (len_tab < 82)):
-            count = len(table.rows)
-            while count >= 0:
-                table.rows[count - 1].height = Mm(10)
-                count -= 1
+            builder.row_height = Mm(10)
 
     @staticmethod
     def data_tab_set_head_row(table, head_row_data):
@@ -1476,10 +1534,173 @@ class DocxMakerStatic(ABC):
             count -= 1
 
 
+class DocxTableBuilder:
+    # таблица w:tbl собирается одной строкой XML и разбирается один раз - без table.add_row, row.cells и
+    # настройки каждой ячейки через python-docx. Свойства ячеек (ширина, выравнивание, заливка) и шрифт
+    # строки готовятся заранее. Результат тот же, что у add_table с text ячеек, style_tabrow_set_alignment_and_font_bold,
+    # add_repeat_table_header и style_tab_set_widths_for_cols, заливка ячеек - FILLS;
+    # вложенные таблицы (add_nested_table_row) собираются своим DocxTableBuilder и встраиваются строкой
+    RUN_CONTENT_SPLIT = re.compile(r'([\t\r\n])')
+    FILLS = {
+        'grey1': 'E0E0E0',
+        'grey2': 'C0C0C0',
+        'grey3': 'A0A0A0',
+    }
+
+    def __init__(self, widths, style_id=None, alignment='center', color=None):
+        self.widths_twips = [width.twips for width in widths]
+        self.style_id = style_id
+        self.alignment = alignment
+        # заливка всех ячеек таблицы (FILLS)
+        self.shd_xml = f'<w:shd w:fill="{self.FILLS[color]}"/>' if color else ''
+        self.tc_pr_list = [
+            f'<w:tcPr><w:tcW w:w="{twips}" w:type="dxa"/><w:vAlign w:val="center"/>{self.shd_xml}</w:tcPr>'
+            for twips in self.widths_twips
+        ]
+        # высота всех строк (Length), задается после заполнения - зависит от числа строк
+        self.row_height = None
+        self.rows_list = []  # (is_header, XML ячеек)
+
+    @staticmethod
+    def get_r_pr_xml(font_bold=False, font_size=None):
+        props = ''
+        if font_bold:
+            props += '<w:b/>'
+        if font_size:
+            props += f'<w:sz w:val="{int(font_size * 2)}"/>'
+        return f'<w:rPr>{props}</w:rPr>' if props else ''
+
+    @classmethod
+    def get_run_content_xml(cls, text):
+        # как Run.text: табуляция - w:tab, перевод строки - w:br
+        content = []
+        for part in cls.RUN_CONTENT_SPLIT.split(text):
+            if part == '\t':
+                content.append('<w:tab/>')
+            elif part in ['\r', '\n']:
+                content.append('<w:br/>')
+            elif part:
+                space = ' xml:space="preserve"' if len(part.strip()) < len(part) else ''
+                content.append(f'<w:t{space}>{escape(part)}</w:t>')
+        return ''.join(content)
+
+    def add_row(self, values, font_bold=False, font_size=None, is_header=False, first_cell_font_size=None):
+        # values короче числа колонок - остальные ячейки пустые;
+        # first_cell_font_size - свой размер шрифта первой ячейки (номер строки в таблице деталей)
+        r_pr_xml = self.get_r_pr_xml(font_bold, font_size)
+        cells = []
+        for index, tc_pr_xml in enumerate(self.tc_pr_list):
+            if index < len(values):
+                cell_r_pr_xml = r_pr_xml
+                if index == 0 and first_cell_font_size:
+                    cell_r_pr_xml = self.get_r_pr_xml(font_bold, first_cell_font_size)
+                run_xml = f'<w:r>{cell_r_pr_xml}{self.get_run_content_xml(str(values[index]))}</w:r>'
+            else:
+                run_xml = ''
+            cells.append(f'<w:tc>{tc_pr_xml}<w:p><w:pPr><w:jc w:val="center"/></w:pPr>{run_xml}</w:p></w:tc>')
+        self.rows_list.append((is_header, ''.join(cells)))
+
+    def add_nested_table_row(self, inner_builder, title='в составе:', title_font_size=8):
+        # одна ячейка на все колонки: подпись, вложенная таблица и абзац-отступ под ней
+        tc_pr_xml = (f'<w:tcPr><w:tcW w:w="{self.widths_twips[0]}" w:type="dxa"/>'
+                     f'<w:gridSpan w:val="{len(self.widths_twips)}"/>{self.shd_xml}</w:tcPr>')
+        title_xml = (f'<w:p><w:r>{self.get_r_pr_xml(font_size=title_font_size)}'
+                     f'{self.get_run_content_xml(title)}</w:r></w:p>')
+        space_xml = ('<w:p><w:pPr><w:spacing w:line="120" w:lineRule="exact"/></w:pPr>'
+                     '<w:r><w:t xml:space="preserve"> </w:t></w:r></w:p>')
+        cell_xml = f'<w:tc>{tc_pr_xml}{title_xml}{inner_builder.get_xml(is_nested=True)}{space_xml}</w:tc>'
+        self.rows_list.append((False, cell_xml))
+
+    def get_rows_count(self):
+        return len(self.rows_list)
+
+    def get_rows_xml(self):
+        height_xml = f'<w:trHeight w:val="{self.row_height.twips}"/>' if self.row_height else ''
+        rows_xml = []
+        for is_header, cells_xml in self.rows_list:
+            tr_pr_xml = height_xml + ('<w:tblHeader/>' if is_header else '')
+            if tr_pr_xml:
+                tr_pr_xml = f'<w:trPr>{tr_pr_xml}</w:trPr>'
+            rows_xml.append(f'<w:tr>{tr_pr_xml}{cells_xml}</w:tr>')
+        return ''.join(rows_xml)
+
+    def get_xml(self, is_nested=False):
+        # у вложенной таблицы пространство имен уже объявлено внешней
+        ns_xml = '' if is_nested else f' {nsdecls("w")}'
+        style_xml = f'<w:tblStyle w:val="{self.style_id}"/>' if self.style_id else ''
+        grid_xml = ''.join(f'<w:gridCol w:w="{twips}"/>' for twips in self.widths_twips)
+        return (
+            f'<w:tbl{ns_xml}>'
+            f'<w:tblPr>{style_xml}<w:tblW w:type="auto" w:w="0"/><w:jc w:val="{self.alignment}"/>'
+            f'<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" '
+            f'w:noVBand="1" w:val="04A0"/></w:tblPr>'
+            f'<w:tblGrid>{grid_xml}</w:tblGrid>'
+            f'{self.get_rows_xml()}'
+            f'</w:tbl>'
+        )
+
+    def insert_into(self, parent_element):
+        # parent_element - w:body документа или w:tc ячейки
+        tbl = parse_xml(self.get_xml())
+        parent_element._insert_tbl(tbl)
+        return tbl
+
+
+class DocxSkeleton:
+    # заготовка документа одного вида (organization, page_orientation, head_image): стили, поля, размер
+    # страницы и картинка шапки уже в документе; документ сертификата - копия заготовки (get_docx)
+    def __init__(self, sert_incarno):
+        self.docx = Document()
+        docx_tab = sert_incarno.docx_tab
+        DocxMaker.set_page_settings(self.docx, docx_tab.page_width, docx_tab.page_height,
+                                    docx_tab.page_orientation_flag)
+        # картинка читается с диска один раз; в копиях та же связь rId -> часть с картинкой
+        self.head_image_rId, self.head_image = self.docx.part.get_or_add_image(sert_incarno.head_image)
+
+    def get_docx(self):
+        return copy.deepcopy(self.docx)
+
+
+def get_head_image_state(head_image):
+    # размер и время изменения файла картинки шапки: замена файла меняет заготовку и ключ cache печати
+    try:
+        image_stat = os.stat(head_image)
+        return [image_stat.st_size, image_stat.st_mtime_ns]
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+# заготовки этого процесса: {вид документа: (состояние файла картинки шапки, заготовка)}
+docx_skeletons = {}
+
+
+def get_docx_skeleton(sert_incarno):
+    key = (sert_incarno.organization, sert_incarno.page_orientation, sert_incarno.head_image)
+    head_image_state = get_head_image_state(sert_incarno.head_image)
+    image_state, skeleton = docx_skeletons.get(key, (None, None))
+    if skeleton is None or image_state != head_image_state:
+        # файл картинки заменен - заготовка собирается заново и вытесняет прежнюю
+        skeleton = DocxSkeleton(sert_incarno)
+        docx_skeletons[key] = (head_image_state, skeleton)
+    return skeleton
+
+
 class DocxMaker(DocxMakerStatic):
-    def __init__(self, sert_incarno, docx):
+    # вложенные таблицы деталей по уровню: строки уровня (sort_data_by_attach_index), a-ключ строки-родителя
+    # и b-ключ вложенной строки, ширины колонок, заливка и размер шрифта номера строки
+    PartsNesting = namedtuple('PartsNesting', ['sorted_data_attr', 'a_index', 'b_index', 'widths', 'color', 'fontsize'])
+    PARTS_NESTING = {
+        1: PartsNesting('is_two', 'a_index', 'b_index', [Mm(18), Mm(55), Mm(95), Mm(18),], 'grey1', 12),
+        2: PartsNesting('is_three', 'a1_index', 'b1_index', [Mm(16), Mm(55), Mm(95), Mm(16),], 'grey2', 10),
+        3: PartsNesting('is_four', 'a2_index', 'b2_index', [Mm(14), Mm(55), Mm(95), Mm(14),], 'grey3', 10),
+    }
+
+    def __init__(self, sert_incarno, docx, skeleton=None, tracer=NULL_TRACER):
         self.si = sert_incarno
         self.docx = docx
+        # docx - копия skeleton: страница уже настроена, картинка шапки уже в документе
+        self.skeleton = skeleton
+        self.tracer = tracer
         self.make_frankenstein()
 
     def get_docx(self):
@@ -1487,35 +1708,46 @@ class DocxMaker(DocxMakerStatic):
 
     # настроить docx добавлением информации
     def make_frankenstein(self):
-        self.setting_page()
+        if self.skeleton is None:
+            self.trace_step(self.setting_page)
 
         if self.si.sert_type not in ['СЕРТ_ЦТК', 'СЕРТ_ЦТК_НТ_ВЭЛВ', 'СЕРТ_ЦТК_АРМАПРОМ_20ГЛ_60']:
 
             if self.si.sert_type in ['РЕМКОМПЛЕКТ']:
-                self.setting_header_for_parts_tab()
+                self.trace_step(self.setting_header_for_parts_tab)
             else:
-                self.setting_header()
+                self.trace_step(self.setting_header)
 
             if self.si.sert_type in ['НАСОС', 'АРМАТУРА']:
-                self.setting_main_tab_gross()
+                self.trace_step(self.setting_main_tab_gross)
             elif self.si.sert_type in ['НАСОС_КУСОЧКИ', 'АРМАТУРА_КУСОЧКИ', 'РЕМКОМПЛЕКТ',
                                        'НАСОС_ХИМ', 'АРМАТУРА_ХИМ', 'СЕРТ_ЦТК_ГГ_НАСОС',]:
-                self.setting_main_tab_klein()
+                self.trace_step(self.setting_main_tab_klein)
 
             if self.si.sert_type not in ['НАСОС', 'АРМАТУРА']:
-                self.setting_body()
+                self.trace_step(self.setting_body)
         else:
-            self.setting_header_for_ctk()
-            self.setting_body()
+            self.trace_step(self.setting_header_for_ctk)
+            self.trace_step(self.setting_body)
 
-        self.setting_conclusion()
-        self.setting_signs()
+        self.trace_step(self.setting_conclusion)
+        self.trace_step(self.setting_signs)
 
         self.set_errors_strings()
 
         if self.si.iter_index != self.si.sert_number_index:
             self.docx.add_page_break()
 
+    def trace_step(self, method):
+        # строки этапа - добавленные в документ абзацы и таблицы
+        if not self.tracer.is_enabled:
+            return method()
+        body = self.docx.element.body
+        with self.tracer.span(method.__name__, self.si.sert_id) as span:
+            body_len = len(body)
+            method()
+            span['rows'] = len(body) - body_len
+
     def set_errors_strings(self):
         if self.si.errors_list:
             prf = self.docx.add_paragraph(' ')
@@ -1540,26 +1772,41 @@ class DocxMaker(DocxMakerStatic):
             'ctk_chem_tab': 'setting_body_for_ctk_chem_tab',
         }
         for tab_name in self.si.tabs_names_list:
-            self.__getattribute__(METHODS[tab_name]).__call__()
+            self.trace_step(self.__getattribute__(METHODS[tab_name]))
 
     def setting_page(self):
+        self.set_page_settings(self.docx, self.si.docx_tab.page_width, self.si.docx_tab.page_height,
+                               self.si.docx_tab.page_orientation_flag)
+
+    @staticmethod
+    def set_page_settings(docx, page_width, page_height, page_orientation_flag):
         # определи базовые настройки шрифта (имя и размер)
-        style_all_document = self.docx.styles['Normal']
+        style_all_document = docx.styles['Normal']
         style_all_document.font.name = 'Times New Roman'
         style_all_document.font.size = Pt(12)
-        paragraph_format = self.docx.styles['Normal'].paragraph_format
+        paragraph_format = docx.styles['Normal'].paragraph_format
         paragraph_format.line_spacing_rule = WD_LINE_SPACING.SINGLE  # интервал между абзацами
         paragraph_format.space_after = Pt(0)
         # определи поля документа
-        section = self.docx.sections[0]
+        section = docx.sections[0]
         section.left_margin = Mm(10)
         section.right_margin = Mm(10)
         section.top_margin = Mm(10)
         section.bottom_margin = Mm(10)
         # задай настройки страницы - её размер и ориентацию
-        self.docx.sections[0].page_width = self.si.docx_tab.page_width
-        self.docx.sections[0].page_height = self.si.docx_tab.page_height
-        self.docx.sections[0].orientation = self.si.docx_tab.page_orientation_flag
+        docx.sections[0].page_width = page_width
+        docx.sections[0].page_height = page_height
+        docx.sections[0].orientation = page_orientation_flag
+
+    def add_head_picture(self, run, width):
+        # без skeleton картинка читается с диска и сверяется по SHA1 на каждой странице
+        if self.skeleton is None:
+            run.add_picture(self.si.head_image, width=width)
+            return
+        cx, cy = self.skeleton.head_image.scaled_dimensions(width, None)
+        inline = CT_Inline.new_pic_inline(self.docx.part.next_id, self.skeleton.head_image_rId,
+                                          self.skeleton.head_image.filename, cx, cy)
+        run._r.add_drawing(inline)
 
     def create_sert_number_str(self):
         if not self.si.is_iter_index:
@@ -1582,8 +1829,8 @@ class DocxMaker(DocxMakerStatic):
             i.font.size = Pt(font_size)
 
     def setting_header(self):
-        self.docx.add_picture(self.si.docx_tab.head_image, width=Mm(190))
-        picture_paragraph = self.docx.paragraphs[-1]
+        picture_paragraph = self.docx.add_paragraph()
+        self.add_head_picture(picture_paragraph.add_run(), Mm(190))
         picture_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
         sert_number_str = self.create_sert_number_str()
         sert_number_paragraph = self.docx.add_paragraph(f'СЕРТИФИКАТ КАЧЕСТВА №{sert_number_str}')
@@ -1638,7 +1885,7 @@ class DocxMaker(DocxMakerStatic):
         hdr_cells[0].text = ''
         cell_icon = hdr_cells[1].add_paragraph()
         cell_icon.add_run()
-        cell_icon.runs[0].add_picture(self.si.head_image, width=Mm(25))
+        self.add_head_picture(cell_icon.runs[0], Mm(25))
         self.delete_paragraph(hdr_cells[1].paragraphs[0])
         hdr_cells[2].text = 'Россия,\nВоронежская обл.,\nПанинский р-он,\nООО «ЦТК «Литьё»'
         hdr_cells[2].vertical_alignment = WD_ALIGN_VERTICAL.CENTER
@@ -1826,27 +2073,18 @@ class DocxMaker(DocxMakerStatic):
             data_rows = self.si.main_parts_tab.symm_data_rows
         else:
             data_rows = self.si.main_parts_tab.asymm_data_rows[self.si.sert_number_index]
-        # создать и настроить таблицу
-        table = self.docx.add_table(rows=1, cols=4)
-        table.style = 'Table Grid'
-        table.alignment = WD_TABLE_ALIGNMENT.CENTER
-        # заполнить шапку таблицы
-        hdr_cells = table.rows[0].cells
-        for i in range(len(head_row)):
-            hdr_cells[i].text = str(head_row[i])
-        self.style_tabrow_set_alignment_and_font_bold(table.rows[0], font_bold=True)
-        # заполнить тело таблицы
-        for row in data_rows:
-            current_table_row = table.add_row()
-            row_cells = current_table_row.cells
-            for i in range(len(row)):
-                row_cells[i].text = str(row[i])
-            self.style_tabrow_set_alignment_and_font_bold(current_table_row, font_bold=False)
-        # настроить повторяющийся заголовок
-        table = self.add_repeat_table_header(table)
-        # настрой ширины колонок таблицы
+        # создать таблицу с шапкой и телом, задать ширины колонок
         widths = [Mm(10), Mm(60), Mm(100), Mm(20), ]
-        self.style_tab_set_widths_for_cols(table, widths)
+        self.add_data_table(head_row, data_rows, widths)
+
+    def add_data_table(self, head_row, data_rows, widths, font_size=None):
+        # таблица Table Grid по центру страницы: жирная шапка повторяется на каждой странице,
+        # текст всех ячеек по центру; число колонок - len(widths)
+        builder = DocxTableBuilder(widths, self.docx.styles['Table Grid'].style_id)
+        builder.add_row(head_row, font_bold=True, font_size=font_size, is_header=True)
+        for row in data_rows:
+            builder.add_row(row, font_size=font_size)
+        return builder.insert_into(self.docx.element.body)
 
     def sort_data_by_attach_index(self, data):
         SD = namedtuple(
@@ -1865,83 +2103,33 @@ class DocxMaker(DocxMakerStatic):
                 sorted_data.is_four.append(i)
         return sorted_data
 
-    def fill_tab_row(self, row, data_row, fontsize=12):
-
-        def tune_up_fontsize_in_cell(cell, size):
-            for i in cell.paragraphs:
-                for ii in i.runs:
-                    ii.font.size = Pt(size)
-
-        row_cells = row.cells
-        row_cells[0].text = str(data_row.order_num)
-        tune_up_fontsize_in_cell(row_cells[0], fontsize)
-        row_cells[1].text = str(data_row.denomination)
-        row_cells[2].text = str(data_row.designation)
-        row_cells[3].text = str(data_row.quantity)
-
-    def get_is_need_inner_row(self, row, sorted_data, nesting_index):
-        Nesting = namedtuple('Nesting', [
-            'sorted_data_attr', 'a_index', 'b_index',
-        ])
-        NESTING = {
-            1: Nesting(sorted_data_attr='is_two', a_index='a_index', b_index='b_index',),
-            2: Nesting(sorted_data_attr='is_three', a_index='a1_index', b_index='b1_index', ),
-            3: Nesting(sorted_data_attr='is_four', a_index='a2_index', b_index='b2_index', ),
-        }
-        is_need_inner_row = False
-        for i in sorted_data.__getattribute__(NESTING[nesting_index].sorted_data_attr):
-            if (row.__getattribute__(NESTING[nesting_index].a_index)
-                    == i.__getattribute__(NESTING[nesting_index].b_index)):
-                is_need_inner_row = True
-                break
-        return is_need_inner_row
-
-    def add_row_for_nested_table_and_table_itself(self, table):
-
-        def merge_four_cells_in_one(table_row):
-            row_cells_for_merge = table_row.cells
-            row_cells_for_merge[0].merge(row_cells_for_merge[1])
-            row_cells_for_merge[0].merge(row_cells_for_merge[2])
-            row_cells_for_merge[0].merge(row_cells_for_merge[3])
-            row_cells_for_merge[0].text = 'в составе:'
-            row_cells_for_merge[0].paragraphs[0].runs[0].font.size = Pt(8)
-            return table_row
-
-        current_table_row = table.add_row()
-        current_table_row = merge_four_cells_in_one(current_table_row)
-        inner_table = current_table_row.cells[0].add_table(rows=1, cols=4)
-        inner_table.style = 'Table Grid'
-        inner_table.alignment = WD_TABLE_ALIGNMENT.CENTER
-        current_table_row.cells[0].paragraphs[1].add_run(' ')
-        current_table_row.cells[0].paragraphs[1].paragraph_format.line_spacing = Pt(6)
-        return inner_table
-
-    def tune_up_table_columns_widths_and_color(self, table, widths_index=0, color='grey1'):
-        WIDTHS = {
-            0: None,
-            1: [Mm(18), Mm(55), Mm(95), Mm(18), ],
-            2: [Mm(16), Mm(55), Mm(95), Mm(16), ],
-            3: [Mm(14), Mm(55), Mm(95), Mm(14), ],
-        }
-        if table:
-            # задать размер колонок таблицы
-            self.style_tab_set_widths_for_cols(table, WIDTHS[widths_index])
-
-            row_count = len(table.rows) - 1
-            for i in range(4):
-                self.change_columns_background(row_count, table.columns[i], color=color)
-
-    def fill_inner_tab(self, data_row, inner_table, is_first_row, fontsize=12):
-        if is_first_row:
-            first_inner_row = inner_table.rows[0]
-            self.fill_tab_row(first_inner_row, data_row, fontsize)
-            self.style_tabrow_set_alignment_and_font_bold(first_inner_row)
-        else:
-            inner_row = inner_table.add_row()
-            self.fill_tab_row(inner_row, data_row, fontsize)
-            self.style_tabrow_set_alignment_and_font_bold(inner_row)
-        is_first_row = False
-        return is_first_row
+    def index_nested_rows(self, sorted_data):
+        # {уровень вложенности: {b-ключ: [строки уровня по порядку]}} - дерево строится один раз на таблицу
+        children_index = {}
+        for nesting_index, nesting in self.PARTS_NESTING.items():
+            level_index = children_index[nesting_index] = {}
+            for row in getattr(sorted_data, nesting.sorted_data_attr):
+                level_index.setdefault(getattr(row, nesting.b_index), []).append(row)
+        return children_index
+
+    def get_inner_rows(self, row, children_index, nesting_index):
+        # строки следующего уровня, у которых b-ключ равен a-ключу строки
+        nesting = self.PARTS_NESTING.get(nesting_index)
+        if nesting is None:
+            return []
+        return children_index[nesting_index].get(getattr(row, nesting.a_index), [])
+
+    def add_parts_tab_rows(self, builder, rows, children_index, nesting_index=1, fontsize=12):
+        # строки таблицы и под каждой строкой с вложенными строками - объединенная строка с их таблицей
+        for row in rows:
+            builder.add_row([row.order_num, row.denomination, row.designation, row.quantity],
+                            first_cell_font_size=fontsize)
+            inner_rows = self.get_inner_rows(row, children_index, nesting_index)
+            if inner_rows:
+                nesting = self.PARTS_NESTING[nesting_index]
+                inner_builder = DocxTableBuilder(nesting.widths, builder.style_id, color=nesting.color)
+                self.add_parts_tab_rows(inner_builder, inner_rows, children_index, nesting_index + 1, nesting.fontsize)
+                builder.add_nested_table_row(inner_builder)
 
     def setting_body_for_parts_tab(self):
         # взять данные для заполнения таблицы в зависимости от глубины вложенности
@@ -1949,74 +2137,18 @@ class DocxMaker(DocxMakerStatic):
         head_row = head_row[:len(head_row) - 10]
         data_rows = self.si.parts_tab.symm_data_rows
         sorted_data = self.sort_data_by_attach_index(data_rows)
-        # создать и настроить таблицу
-        table = self.docx.add_table(rows=1, cols=4)
-        table.style = 'Table Grid'
-        table.alignment = WD_TABLE_ALIGNMENT.CENTER
-        # заполнить шапку таблицы
-        hdr_cells = table.rows[0].cells
-        for i in range(len(head_row)):
-            hdr_cells[i].text = str(head_row[i])
-        self.style_tabrow_set_alignment_and_font_bold(table.rows[0], font_bold=True)
-        # заполнить тело таблицы
-        # построчно заполняет основную таблицу №1
-        for main_row in sorted_data.is_one:
-            # добавляет строку в основную таблицу и заполняет её содержимым
-            current_table_row1 = table.add_row()
-            self.fill_tab_row(current_table_row1, main_row)
-            # определяет есть ли у данной строки вложенные подстроки
-            is_need_inner_row = self.get_is_need_inner_row(main_row, sorted_data, 1)
-            inner_table2 = None
-            is_first_row2 = True
-            # добавляет в основную таблицу пустую строку, сращивает её в одну и создает внутри вложенную таблицу
-            if is_need_inner_row:
-                inner_table2 = self.add_row_for_nested_table_and_table_itself(table)
-            # построчно заполняет вложенную таблицу №2
-            for row2 in sorted_data.is_two:
-                # отбирает из сортированного списка те строки, которые имеют отношение к данной вложенной строке
-                if main_row.a_index == row2.b_index:
-
-                    is_first_row2 = self.fill_inner_tab(row2, inner_table2, is_first_row2)
-
-                    is_need_inner_row2 = self.get_is_need_inner_row(row2, sorted_data, 2)
-                    inner_table3 = None
-                    is_first_row3 = True
-
-                    if is_need_inner_row2:
-                        inner_table3 = self.add_row_for_nested_table_and_table_itself(inner_table2)
-                    # построчно заполняет вложенную таблицу №3
-                    for row3 in sorted_data.is_three:
-                        if row2.a1_index == row3.b1_index:
-                            is_first_row3 = self.fill_inner_tab(row3, inner_table3, is_first_row3, fontsize=10)
-
-                            is_need_inner_row3 = self.get_is_need_inner_row(row3, sorted_data, 3)
-                            inner_table4 = None
-                            is_first_row4 = True
-                            if is_need_inner_row3:
-                                inner_table4 = self.add_row_for_nested_table_and_table_itself(
-                                    inner_table3)
-                            # построчно заполняет вложенную таблицу №4
-                            for row4 in sorted_data.is_four:
-                                if row3.a2_index == row4.b2_index:
-                                    is_first_row4 = self.fill_inner_tab(row4, inner_table4, is_first_row4, fontsize=10)
-
-                            self.tune_up_table_columns_widths_and_color(inner_table4, widths_index=3, color='grey3')
-
-                    self.tune_up_table_columns_widths_and_color(inner_table3, widths_index=2, color='grey2')
-            # задает размер и цвет колонкам строки
-            self.tune_up_table_columns_widths_and_color(inner_table2, widths_index=1)
-            # задает выравнивание колонкам строки
-            self.style_tabrow_set_alignment_and_font_bold(current_table_row1)
-        # настроить повторяющийся заголовок
-        table = self.add_repeat_table_header(table)
-        # задать размер колонок основной таблицы
+        children_index = self.index_nested_rows(sorted_data)
+        # основная таблица с повторяющейся шапкой, вложенные таблицы - по дереву children_index
         widths = [Mm(20), Mm(55), Mm(95), Mm(20),]
-        self.style_tab_set_widths_for_cols(table, widths)
+        builder = DocxTableBuilder(widths, self.docx.styles['Table Grid'].style_id)
+        builder.add_row(head_row, font_bold=True, is_header=True)
+        self.add_parts_tab_rows(builder, sorted_data.is_one, children_index)
         # управляет высотой строк в зависимости от их количества
         # это сомнительный механизм для корректного заполнения страниц документа
         # чтобы одинокая подпись не слетала на новую страницу, а имела хоть какие-то
         # строки таблицы над собой
-        self.tune_up_table_rows_heights(table)
+        self.tune_up_table_rows_heights(builder)
+        builder.insert_into(self.docx.element.body)
 
     def setting_body_for_galv_parts_tab(self):
         name_paragraph = self.docx.add_paragraph('Наименование продукции:')
@@ -2024,27 +2156,9 @@ class DocxMaker(DocxMakerStatic):
         # взять данные для заполнения таблицы в зависимости от симметрии
         head_row = self.si.galv_parts_tab.head_row
         data_rows = self.si.galv_parts_tab.symm_data_rows
-        # создать и настроить таблицу
-        table = self.docx.add_table(rows=1, cols=4)
-        table.style = 'Table Grid'
-        table.alignment = WD_TABLE_ALIGNMENT.CENTER
-        # заполнить шапку таблицы
-        hdr_cells = table.rows[0].cells
-        for i in range(len(head_row)):
-            hdr_cells[i].text = str(head_row[i])
-        self.style_tabrow_set_alignment_and_font_bold(table.rows[0], font_bold=True)
-        # заполнить тело таблицы
-        for row in data_rows:
-            current_table_row = table.add_row()
-            row_cells = current_table_row.cells
-            for i in range(len(row)):
-                row_cells[i].text = str(row[i])
-            self.style_tabrow_set_alignment_and_font_bold(current_table_row, font_bold=False)
-        # настроить повторяющийся заголовок
-        table = self.add_repeat_table_header(table)
-        # настрой ширины колонок таблицы
+        # создать таблицу с шапкой и телом, задать ширины колонок
         widths = [Mm(20), Mm(110), Mm(30), Mm(30),]
-        self.style_tab_set_widths_for_cols(table, widths)
+        self.add_data_table(head_row, data_rows, widths)
 
     def setting_body_for_casts_tab(self):
         # взять данные для заполнения таблицы в зависимости от симметрии
@@ -2053,27 +2167,9 @@ class DocxMaker(DocxMakerStatic):
             data_rows = self.si.casts_tab.symm_data_rows
         else:
             data_rows = self.si.casts_tab.asymm_data_rows[self.si.sert_number_index]
-        # создать и настроить таблицу
-        table = self.docx.add_table(rows=1, cols=5)
-        table.style = 'Table Grid'
-        table.alignment = WD_TABLE_ALIGNMENT.CENTER
-        # заполнить шапку таблицы
-        hdr_cells = table.rows[0].cells
-        for i in range(len(head_row)):
-            hdr_cells[i].text = str(head_row[i])
-        self.style_tabrow_set_alignment_and_font_bold(table.rows[0], font_bold=True)
-        # заполнить тело таблицы
-        for row in data_rows:
-            current_table_row = table.add_row()
-            row_cells = current_table_row.cells
-            for i in range(len(row)):
-                row_cells[i].text = str(row[i])
-            self.style_tabrow_set_alignment_and_font_bold(current_table_row, font_bold=False)
-        # настроить повторяющийся заголовок
-        table = self.add_repeat_table_header(table)
-        # настрой ширины колонок таблицы
+        # создать таблицу с шапкой и телом, задать ширины колонок
         widths = [Mm(60), Mm(50), Mm(20), Mm(30), Mm(30), ]
-        self.style_tab_set_widths_for_cols(table, widths)
+        self.add_data_table(head_row, data_rows, widths)
         # добавь пустую строку между таблицами
         mid_paragraph = self.docx.add_paragraph(' ')
         mid_paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
@@ -2089,67 +2185,33 @@ class DocxMaker(DocxMakerStatic):
         else:
             head_row = self.si.chem_tab.asymm_head_row[self.si.sert_number_index]
             data_rows = self.si.chem_tab.asymm_data_rows[self.si.sert_number_index]
-        # создать и настроить таблицу
-        table = self.docx.add_table(rows=1, cols=len(head_row))
-        table.style = 'Table Grid'
-        table.alignment = WD_TABLE_ALIGNMENT.CENTER
-        # заполнить шапку таблицы
-        hdr_cells = table.rows[0].cells
-        for i in range(len(head_row)):
-            hdr_cells[i].text = str(head_row[i])
-        self.style_tabrow_set_alignment_and_font_bold(table.rows[0], font_bold=True)
-        # заполнить тело таблицы
-        for row in data_rows:
-            current_table_row = table.add_row()
-            row_cells = current_table_row.cells
-            for i in range(len(row)):
-                row_cells[i].text = str(row[i])
-            self.style_tabrow_set_alignment_and_font_bold(current_table_row, font_bold=False)
-        # настроить повторяющийся заголовок
-        table = self.add_repeat_table_header(table)
-        # настрой ширины колонок таблицы
+        # ширины колонок таблицы
+        cols_count = len(head_row)
         widths = [Mm(20), Mm(22), ]  # всего 190 Mm
-        r_widths = int(148 // (len(table.columns) - 2))
-        for i in range(len(table.columns) - 2):
+        r_widths = int(148 // (cols_count - 2))
+        for i in range(cols_count - 2):
             widths += [Mm(r_widths)]
-        corr = 148 - (r_widths * (len(table.columns) - 2))
+        corr = 148 - (r_widths * (cols_count - 2))
         if corr > 0:
             widths[0] = Mm(20 + corr)
-        self.style_tab_set_widths_for_cols(table, widths)
+        # создать таблицу с шапкой и телом
+        self.add_data_table(head_row, data_rows, widths[:cols_count])
 
     def setting_body_for_ctk_mech_tab(self):
         # взять данные для заполнения таблицы в зависимости от симметрии
         head_row = self.si.ctk_mech_tab.casts_head_row[self.si.sert_number_index]
         data_rows = self.si.ctk_mech_tab.casts_data_rows[self.si.sert_number_index]
-        # создать и настроить таблицу
-        table = self.docx.add_table(rows=1, cols=len(head_row))
-        table.style = 'Table Grid'
-        table.alignment = WD_TABLE_ALIGNMENT.CENTER
-        # заполнить шапку таблицы
-        hdr_cells = table.rows[0].cells
-        for i in range(len(head_row)):
-            hdr_cells[i].text = str(head_row[i])
-        self.style_tabrow_set_alignment_and_font_bold(table.rows[0], font_bold=True,
-                                                      is_change_font_size=True, font_size=11)
-        # заполнить тело таблицы
-        for row in data_rows:
-            current_table_row = table.add_row()
-            row_cells = current_table_row.cells
-            for i in range(len(row)):
-                row_cells[i].text = str(row[i])
-            self.style_tabrow_set_alignment_and_font_bold(current_table_row, font_bold=False,
-                                                          is_change_font_size=True, font_size=11)
-        # настроить повторяющийся заголовок
-        table = self.add_repeat_table_header(table)
-        # настрой ширины колонок таблицы
+        # ширины колонок таблицы
+        cols_count = len(head_row)
         widths = [Mm(10), Mm(50), Mm(11), Mm(20), Mm(26),]  # всего 277 Mm
-        r_widths = int(160 / (len(table.columns) - 5))
-        for i in range(len(table.columns) - 5):
+        r_widths = int(160 / (cols_count - 5))
+        for i in range(cols_count - 5):
             widths += [Mm(r_widths)]
-        corr = int(160 % (len(table.columns) - 5))
+        corr = int(160 % (cols_count - 5))
         if corr > 0:
             widths[2] = Mm(11 + corr)
-        self.style_tab_set_widths_for_cols(table, widths)
+        # создать таблицу с шапкой и телом
+        self.add_data_table(head_row, data_rows, widths[:cols_count], font_size=11)
         # отступ от след таблицы
         prf = self.docx.add_paragraph(' ')
         prf.alignment = WD_ALIGN_PARAGRAPH.LEFT
@@ -2173,71 +2235,162 @@ class DocxMaker(DocxMakerStatic):
             inner_tab = cols_index
         o_table = self.docx.add_table(rows=1, cols=outer_tab)
         o_table.alignment = WD_TABLE_ALIGNMENT.CENTER
-        tab_list = []
-        if outer_tab is not None:
-            hdr_cells = o_table.rows[0].cells
-            for i in range(outer_tab):
-                self.delete_paragraph(hdr_cells[i].paragraphs[0])
-                tab = hdr_cells[i].add_table(rows=1, cols=inner_tab)
-                tab.style = 'Table Grid'
-                tab.alignment = WD_TABLE_ALIGNMENT.LEFT
-                tab_list.append(tab)
-        else:
-            tab_list.append(o_table)
-            o_table.style = 'Table Grid'
-
-        # заполняем шапку
-        row_summ_index = len(tab_list)
-        mirror_tab_iter_index = 0
-        for i in range(row_summ_index):
-            table = tab_list[mirror_tab_iter_index]
-            # заполнить шапку таблицы
-            hdr_cells = table.rows[0].cells
-            for i in range(len(head_row)):
-                hdr_cells[i].text = str(head_row[i])
-            self.style_tabrow_set_alignment_and_font_bold(table.rows[0], font_bold=True,
-                                                          is_change_font_size=True, font_size=10)
-            # настроить повторяющийся заголовок
-            table = self.add_repeat_table_header(table)
-            mirror_tab_iter_index += 1
-            # настрой ширины колонок таблицы
-            widths = [Mm(16), ]  # всего 277 Mm
-            for i in range(len(head_row)):
-                widths += [Mm(14), ]
-            self.style_tab_set_widths_for_cols(table, widths)
-        # заполняем тело
-        row_summ_index = len(data_rows)
-        tab_iter_index = outer_tab
-        mirror_tab_iter_index = 0
-        for i in range(row_summ_index):
-            table = tab_list[mirror_tab_iter_index]
-
-            current_table_row = table.add_row()
-            row_cells = current_table_row.cells
-            for j in range(len(data_rows[i])):
-                row_cells[j].text = str(data_rows[i][j])
-            self.style_tabrow_set_alignment_and_font_bold(current_table_row, font_bold=False,
-                                                          is_change_font_size=True, font_size=10)
-
-            mirror_tab_iter_index += 1
-            tab_iter_index -= 1
-            if tab_iter_index == 0:
-                tab_iter_index = outer_tab
-                mirror_tab_iter_index = 0
-
-
-class GroupManager(ModelDataLoader):
-    def __init__(self):
+        # настрой ширины колонок вложенных таблиц
+        widths = [Mm(16), ]  # всего 277 Mm
+        for i in range(len(head_row)):
+            widths += [Mm(14), ]
+        widths = widths[:cols_index]
+        style_id = self.docx.styles['Table Grid'].style_id
+        # в каждую ячейку внешней таблицы - вложенная таблица с шапкой;
+        # строки тела раскладываются по вложенным таблицам по очереди
+        hdr_cells = o_table.rows[0].cells
+        for i in range(outer_tab):
+            self.delete_paragraph(hdr_cells[i].paragraphs[0])
+            builder = DocxTableBuilder(widths, style_id, alignment='left')
+            builder.add_row(head_row, font_bold=True, font_size=10, is_header=True)
+            for data_row in data_rows[i::outer_tab]:
+                builder.add_row(data_row, font_size=10)
+            builder.insert_into(hdr_cells[i]._tc)
+            # ячейка таблицы должна заканчиваться абзацем
+            hdr_cells[i].add_paragraph()
+
+
+# строки таблиц SertTabsMaker - namedtuple, объявленные внутри методов: pickle не находит их классы,
+# поэтому для процессов печати строки пересобираются в классы этого модуля (get_print_row_class)
+print_row_classes = {}
+
+
+def get_print_row_class(typename, field_names):
+    key = (typename, tuple(field_names))
+    row_class = print_row_classes.get(key)
+    if row_class is None:
+        row_class = namedtuple(typename, field_names)
+        row_class.__reduce__ = reduce_print_row
+        print_row_classes[key] = row_class
+    return row_class
+
+
+def reduce_print_row(row):
+    return create_print_row, (type(row).__name__, row._fields, tuple(row))
+
+
+def create_print_row(typename, field_names, values):
+    return get_print_row_class(typename, field_names)._make(values)
+
+
+def to_print_value(value):
+    # namedtuple на любой глубине списков, кортежей и словарей - в строки get_print_row_class
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        row_class = get_print_row_class(type(value).__name__, value._fields)
+        return row_class._make(to_print_value(item) for item in value)
+    if isinstance(value, tuple):
+        return tuple(to_print_value(item) for item in value)
+    if isinstance(value, list):
+        return [to_print_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_print_value(item) for key, item in value.items()}
+    return value
+
+
+class SertPrintData:
+    # то из SertIncarnation, что читает DocxMaker: без Sert/Kernel/Attachment/Melt и запросов в базу,
+    # передается процессу печати целиком
+    FIELDS = [
+        'sert_type', 'organization', 'page_orientation', 'head_image', 'tabs_names_list', 'is_symmetrical',
+        'is_iter_index', 'iter_index', 'sert_number_index',
+        'docx_tab', 'main_tab', 'main_parts_tab', 'parts_tab', 'galv_parts_tab', 'casts_tab', 'chem_tab',
+        'ctk_mech_tab', 'ctk_chem_tab',
+        'errors_list',
+    ]
+
+    def __init__(self, sert_incarnation):
+        # sert_id - только для замеров, в ключ cache печати не входит
+        self.sert_id = sert_incarnation.sert_id
+        for name in self.FIELDS:
+            setattr(self, name, to_print_value(getattr(sert_incarnation, name)))
+
+
+def render_docx(sert_incarnation, tracer=NULL_TRACER):
+    # все страницы сертификата (iter_index) в одну копию заготовки
+    skeleton = get_docx_skeleton(sert_incarnation)
+    docx = skeleton.get_docx()
+    iter_index = sert_incarnation.iter_index
+    while iter_index:
+        DocxMaker(sert_incarnation, docx, skeleton, tracer)
+        sert_incarnation.sert_number_index += 1
+        iter_index -= 1
+    sert_incarnation.sert_number_index = 1
+    return docx
+
+
+def render_docx_content(print_data, is_traced=False):
+    # задание процесса печати: SertPrintData -> (содержимое .docx, замеры этапов DocxMaker);
+    # замеры копятся в процессе печати и пишутся в лог процессом, который их получил
+    tracer = PrintTracer(is_logged=False) if is_traced else NULL_TRACER
+    with tracer.span('render_docx', print_data.sert_id) as span:
+        docx = render_docx(print_data, tracer)
+        with BytesIO() as buffer:
+            docx.save(buffer)
+            content = buffer.getvalue()
+        span['rows'] = print_data.iter_index
+    return content, tracer.get_spans()
+
+
+def get_docx_cache():
+    return DiskLRUCache(settings.PRINT_DOCX_CACHE_DIR, DOCX_CACHE_MAX_SIZE)
+
+
+def get_docx_cache_key(sert_incarnation):
+    # все, из чего DocxMaker собирает документ: таблицы (строки Sert, Kernel, Attachment, Melt, тексты
+    # справочников), выбранный SertStyleMaker вид, файл картинки шапки и версия печати
+    schema = {
+        'version': DOCX_CACHE_VERSION,
+        'head_image': get_head_image_state(sert_incarnation.head_image),
+        'data': [[name, getattr(sert_incarnation, name)] for name in SertPrintData.FIELDS],
+    }
+    content = json.dumps(schema, default=get_docx_cache_value, ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def get_docx_cache_value(value):
+    # model (подписанты, плавки в таблицах) - по значениям всех полей, а не по __str__
+    if isinstance(value, Model):
+        return [value._meta.label, [getattr(value, field.attname) for field in value._meta.concrete_fields]]
+    return str(value)
+
+
+def get_render_workers(is_request=False):
+    # в запросе сайта пул процессов (sert.workers) - только если это явно разрешено в settings
+    if is_request and not getattr(settings, 'PRINT_RENDER_IN_REQUEST', False):
+        return 1
+    return getattr(settings, 'PRINT_RENDER_WORKERS', 1)
+
+
+class GroupManager(BatchModelDataLoader):
+    def __init__(self, render_workers=None, is_lazy=False, tracer=None):
+        super().__init__()
+        # замеры этапов печати (sert.printtrace); по умолчанию - по settings.PRINT_TRACE
+        self.tracer = tracer or get_print_tracer()
+        # число процессов печати; 1 - печать в этом процессе
+        self.render_workers = render_workers or get_render_workers()
+        # is_lazy: документы не собираются сразу, а выдаются по одному из iter_docx_list
+        self.is_lazy = is_lazy
         self.serts_to_print = None
         self.fatal_error = False
         self.serts_incarnations_list = []
+        # справочники на всю печать - одна проверка версии в cache
+        self.reference_data = None
         self.docx_list = []
         self.errors_list = []  # (level, text,)
 
         self.load_serts_to_print()
 
     def load_serts_to_print(self):
-        serts = Sert.objects.filter(is_print=True)
+        # Kernel, номер и заключение - тем же запросом, вложения и плавки - по запросу на всю печать
+        with self.tracer.span('load_serts_to_print') as span:
+            serts = list(Sert.objects.filter(is_print=True)
+                         .select_related('number_spg', 'number_unique', 'conclusion_type'))
+            span['rows'] = len(serts)
         if not len(serts) > 0:
             self.fatal_error = True
             error_text = (f'GroupManager: ни один сертификат не выбран для печати '
@@ -2247,11 +2400,20 @@ class GroupManager(ModelDataLoader):
             return
         else:
             self.serts_to_print = serts
+            with self.tracer.span('prefetch_model_data') as span:
+                self.reference_data = get_reference_data()
+                self.prefetch_model_data(
+                    [sert for sert in serts if self.get_data_flags(sert.sert_type).is_attach_data],
+                    [sert for sert in serts if self.get_data_flags(sert.sert_type).is_melt_data],
+                )
+                span['rows'] = len(serts)
             self.create_serts_incarnations()
-            self.create_docx_documents()
-            self.fill_docx_list()
+            if not self.is_lazy:
+                self.create_docx_documents()
+                self.fill_docx_list()
 
-    def load_model_data(self, sert):
+    @staticmethod
+    def get_data_flags(sert_type):
         NT = namedtuple('flags', ['is_attach_data', 'is_melt_data',])
         DATA_BY_TYPES = {
             'НАСОС': NT(is_attach_data=False, is_melt_data=False),
@@ -2267,10 +2429,14 @@ class GroupManager(ModelDataLoader):
             'СЕРТ_ЦТК_НТ_ВЭЛВ': NT(is_attach_data=True, is_melt_data=True),  # ???
             # 'СЕРТ_ЦТК_АРМАПРОМ_20ГЛ_60': '',
         }
+        return DATA_BY_TYPES[sert_type]
+
+    def load_model_data(self, sert):
+        data_flags = self.get_data_flags(sert.sert_type)
         kernel_data = self.get_kernel_data(sert)
         attach_data = None
         melt_data = None
-        if DATA_BY_TYPES[sert.sert_type].is_attach_data:
+        if data_flags.is_attach_data:
             attach_data = list(self.get_attachment_data(sert))
             if not attach_data:
                 self.fatal_error = True
@@ -2278,7 +2444,7 @@ class GroupManager(ModelDataLoader):
                               f'не содержит необходимых вложений в Attachment')
                 error = (messages.ERROR, error_text)
                 self.errors_list.append(error)
-            if DATA_BY_TYPES[sert.sert_type].is_melt_data:
+            if data_flags.is_melt_data:
                 melt_data = []
                 for attach_item in attach_data:
                     melt = list(self.get_melt_data(attach_item))
@@ -2297,13 +2463,9 @@ class GroupManager(ModelDataLoader):
 
     def create_serts_incarnations(self):
         for sert in self.serts_to_print:
-            kernel_data, attach_data, melt_data = self.load_model_data(sert)
-            print('========================',
-                  '\nsert_type:', sert.sert_type,
-                  '\nkernel_data:', kernel_data,
-                  '\nattach_data:', attach_data,
-                  '\nmelt_data:', melt_data,
-                  '\n--------------------',)
+            with self.tracer.span('load_model_data', sert.id) as span:
+                kernel_data, attach_data, melt_data = self.load_model_data(sert)
+                span['rows'] = len(attach_data or []) + len(melt_data or [])
             if not self.fatal_error:
                 si = SertIncarnation(
                     sert=sert,
@@ -2312,76 +2474,10 @@ class GroupManager(ModelDataLoader):
                     melt_data=melt_data,
                 )
                 # настроить style
-                si = self.set_style(si)
-                print("настроить style",
-                    '\norganization:', si.organization,
-                    '\npaging:', si.paging,
-                    '\npage_orientation:', si.page_orientation,
-                    '\nhead_image:', si.head_image,
-                    '\nis_galv_date:', si.is_galv_date,
-                    '\nmelt_anatomy:', si.melt_anatomy,
-                    '\nconclusion_type:', si.conclusion_type,
-                    '\nsign_type:', si.sign_type,
-                    '\nhead_gost_str:', si.head_gost_str,
-                    '\ntabs_names_list:', si.tabs_names_list,
-                    '\n--------------------',)
+                si = self.tracer.call('set_style', si.sert_id, self.set_style, si)
                 # создать tabs с данными
-                si = self.set_tabs(si)
-                print("создать tabs с данными",
-                      '\ndocx_tab:', si.docx_tab,
-                      '\nmain_tab:', si.main_tab,)
-                print('main_parts_tab:')
-                if si.main_parts_tab:
-                    for i in si.main_parts_tab:
-                        print(i)
-                else:
-                    print(si.main_parts_tab)
-                print('parts_tab:')
-                if si.parts_tab:
-                    for i in si.parts_tab:
-                        for ii in i:
-                            if isinstance(ii, type(list())):
-                                for iii in ii:
-                                    print(iii)
-                            else:
-                                print(ii)
-                else:
-                    print(si.parts_tab)
-                print('galv_parts_tab:')
-                if si.galv_parts_tab:
-                    for i in si.galv_parts_tab:
-                        print(i)
-                else:
-                    print(si.galv_parts_tab)
-                print('casts_tab:')
-                if si.casts_tab:
-                    for i in si.casts_tab:
-                        print(i)
-                else:
-                    print(si.casts_tab)
-                print('chem_tab:')
-                if si.chem_tab:
-                    for i in si.chem_tab:
-                        print(i)
-                else:
-                    print(si.chem_tab)
-                print('ctk_mech_tab:')
-                if si.ctk_mech_tab:
-                    for i in si.ctk_mech_tab:
-                        print(i)
-                else:
-                    print(si.ctk_mech_tab)
-
-
-                print('errors_list:')
-                if si.errors_list:
-                    for i in si.errors_list:
-                        print(i)
-                else:
-                    print(si.errors_list)
-                print('\n--------------------', )
+                si = self.tracer.call('set_tabs', si.sert_id, self.set_tabs, si, rows=len(attach_data or []))
                 self.serts_incarnations_list.append(si)
-                # куда-то надо снятие is_print, наверное в fill_docx_list
 
     def set_style(self, si):
         ssm = SertStyleMaker(si)
@@ -2389,28 +2485,67 @@ class GroupManager(ModelDataLoader):
         return si
 
     def set_tabs(self, si):
-        stm = SertTabsMaker(si)
+        stm = SertTabsMaker(si, self.reference_data, self.tracer)
         si = stm.get_result()
         return si
 
     def create_docx_documents(self):
-        for si in self.serts_incarnations_list:
-            docx = si.docx
-            iter_index = si.iter_index
-            while iter_index:
-                if not docx:
-                    docx = Document()
-                    dm = DocxMaker(si, docx)
-                    docx = dm.get_docx()
-                else:
-                    dm = DocxMaker(si, docx)
-                    docx = dm.get_docx()
-                si.sert_number_index += 1
-                iter_index -= 1
-            si.docx = docx
-            si.sert_number_index = 1
+        # si.docx - содержимое .docx (bytes)
+        for si, content in zip(self.serts_incarnations_list, self.iter_docx_contents()):
+            si.docx = content
+
+    def is_worth_parallel(self):
+        return self.render_workers > 1 and len(self.serts_incarnations_list) >= PARALLEL_MIN_SERTS
+
+    def iter_docx_contents(self):
+        # содержимое .docx в порядке serts_incarnations_list: из cache печати или собранное заново;
+        # при параллельной печати в работе не больше двух заданий на процесс,
+        # чтобы готовые документы не копились, пока их не заберут
+        docx_cache = get_docx_cache()
+        is_parallel = self.is_worth_parallel()
+        max_workers = min(self.render_workers, len(self.serts_incarnations_list))
+        window = max_workers * 2 if is_parallel else 1
+        with (get_process_pool(max_workers) if is_parallel else nullcontext()) as pool:
+            pending = deque()  # (si, cache_key, future)
+            for si in self.serts_incarnations_list:
+                cache_key = get_docx_cache_key(si)
+                future = None
+                if is_parallel and not docx_cache.exists(cache_key):
+                    future = pool.submit(render_docx_content, SertPrintData(si), self.tracer.is_enabled)
+                pending.append((si, cache_key, future))
+                if len(pending) >= window:
+                    yield self.get_docx_content(docx_cache, *pending.popleft())
+            while pending:
+                yield self.get_docx_content(docx_cache, *pending.popleft())
+
+    def get_docx_content(self, docx_cache, si, cache_key, future):
+        if future is not None:
+            content, spans = future.result()
+        else:
+            with self.tracer.span('docx_cache_get', si.sert_id) as span:
+                content = docx_cache.get(cache_key)
+                span['rows'] = 0 if content is None else 1
+            if content is not None:
+                return content
+            content, spans = render_docx_content(si, self.tracer.is_enabled)
+        self.tracer.add_spans(spans)
+        docx_cache.set(cache_key, content)
+        return content
+
+    def iter_docx_list(self):
+        # для is_lazy: docx_parts (content - bytes) по мере печати, в памяти - один документ;
+        # галочки на печать снимаются, только если выданы все документы
+        if self.fatal_error is True:
+            return
+        for si, content in zip(self.serts_incarnations_list, self.iter_docx_contents()):
+            yield self.create_docx_parts(si, content)
+        self.clear_is_print()
 
-    def fill_docx_list(self):
+    def get_docx_count(self):
+        return len(self.serts_incarnations_list)
+
+    @staticmethod
+    def create_docx_parts(si, content):
         docx_parts = namedtuple('docx_parts', ['content', 'name', 'format'])
         FILENAMES = {
             'НАСОС': 'PUMP',
@@ -2427,21 +2562,31 @@ class GroupManager(ModelDataLoader):
             # 'СЕРТ_ЦТК_АРМАПРОМ_20ГЛ_60': 'CTK_ARMA_PROM',
         }
         format_str = 'docx'
+        first_name_str = si.main_tab.data_row.number_spg.split('.')
+        first_name_str = '-'.join(first_name_str)
+        try:
+            second_name_str = FILENAMES[si.sert_type]
+        except KeyError:
+            second_name_str = 'UNKNOWN'
+        name_str = f'{first_name_str}-{second_name_str}'
+        return docx_parts(
+            content=content,
+            name=name_str,
+            format=format_str,
+        )
+
+    def fill_docx_list(self):
+        for si in self.serts_incarnations_list:
+            self.docx_list.append(self.create_docx_parts(si, si.docx))
+        self.clear_is_print()
+
+    def clear_is_print(self):
         for si in self.serts_incarnations_list:
-            first_name_str = si.main_tab.data_row.number_spg.split('.')
-            first_name_str = '-'.join(first_name_str)
-            try:
-                second_name_str = FILENAMES[si.sert_type]
-            except KeyError:
-                second_name_str = 'UNKNOWN'
-            name_str = f'{first_name_str}-{second_name_str}'
-            self.docx_list.append(docx_parts(
-                content=si.docx,
-                name=name_str,
-                format=format_str,
-            ))
             si.sert.is_print = False
-            si.sert.save()
+        # галочки на печать снимаются одним запросом
+        printed_ids = [si.sert.id for si in self.serts_incarnations_list]
+        if printed_ids:
+            Sert.objects.filter(id__in=printed_ids).update(is_print=False)
 
     def get_docx_list(self):
         if self.fatal_error is True:
@@ -0,0 +1,74 @@
+import os
+import pickle
+import tempfile
+
+
+class DiskLRUCache:
+    # значения хранятся файлами pickle в directory, общей для всех процессов (сайт и importworker);
+    # общий размер файлов не больше max_size байт: при переполнении удаляются давно не читанные записи,
+    # время последнего чтения - mtime файла
+    def __init__(self, directory, max_size):
+        self.directory = str(directory)
+        self.max_size = max_size
+
+    def get_path(self, key):
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def get(self, key, default=None):
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                value = pickle.load(cache_file)
+        except FileNotFoundError:
+            return default
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # запись от другой версии кода или недописанная - просто промах
+            self.delete(key)
+            return default
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def exists(self, key):
+        # запись может быть удалена cull другого процесса и после проверки - get все равно может вернуть default
+        return os.path.exists(self.get_path(key))
+
+    def set(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        # запись во временный файл и os.replace: читатель никогда не видит файл наполовину
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump(value, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.get_path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.cull()
+
+    def delete(self, key):
+        try:
+            os.remove(self.get_path(key))
+        except FileNotFoundError:
+            pass
+
+    def cull(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
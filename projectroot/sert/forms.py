@@ -3,6 +3,7 @@ from decimal import Decimal, InvalidOperation
 from django import forms
 from datetime import datetime
 import random
+import zipfile
 
 
 from sert.models import (
@@ -21,31 +22,118 @@ from sert.models_data import (
     ITEM_UNITS,
 )
 from sert.models_inspector import Inspector
+from sert.models_numbers import SertNumberPool
+from sert.uploadhandlers import IMPORT_MAX_FILE_SIZE, IMPORT_MAX_UNCOMPRESSED_SIZE
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 
 
 class BaseForm(forms.Form):
     file = forms.FileField()
+    is_dry_run = forms.BooleanField(required=False, label='Только проверить, без записи в базу')
+    is_stale_deleted = forms.BooleanField(
+        required=False, label='Удалить загруженные ранее вложения сертификатов файла, строк которых в файле больше нет')
+
+    def __init__(self, *args, upload_error=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # файл отброшен еще при приеме (ImportFileUploadHandler) - вместо "обязательного поля" причина отказа
+        if upload_error:
+            self.fields['file'].error_messages['required'] = upload_error
+
+    def clean_file(self):
+        # xlsx-файл и zip с CSV проверяются как zip-архив до разбора: не распаковываются в гигабайты,
+        # а xlsx содержит книгу
+        file = self.cleaned_data['file']
+        if file.size > IMPORT_MAX_FILE_SIZE:
+            max_size = IMPORT_MAX_FILE_SIZE // (1024 * 1024)
+            raise ValidationError(f'Файл "{file.name}" больше {max_size} МБ и не принят.')
+        if not file.name.endswith(('.xlsx', '.zip')):
+            return file
+        try:
+            with zipfile.ZipFile(file) as zf:
+                names = zf.namelist()
+                uncompressed_size = sum(info.file_size for info in zf.infolist())
+        except zipfile.BadZipFile:
+            raise ValidationError(f'Файл "{file.name}" поврежден или не является zip-архивом.')
+        if file.name.endswith('.xlsx') and 'xl/workbook.xml' not in names:
+            raise ValidationError(f'Файл "{file.name}" не содержит книгу Excel.')
+        if uncompressed_size > IMPORT_MAX_UNCOMPRESSED_SIZE:
+            max_size = IMPORT_MAX_UNCOMPRESSED_SIZE // (1024 * 1024)
+            raise ValidationError(f'Файл "{file.name}" в распакованном виде больше {max_size} МБ.')
+        file.seek(0)
+        return file
+
+
+class KeyIndexModelChoiceField(forms.ModelChoiceField):
+    # при заданном key_index запись ищется в индексе загрузки, а не запросом в базу
+    key_index = None
 
-
-class SertNumberForm(forms.ModelForm):
+    def to_python(self, value):
+        if self.key_index is None or value in self.empty_values:
+            return super().to_python(value)
+        obj = self.key_index.get_object(value, self.queryset.model)
+        if obj is None:
+            raise ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+        return obj
+
+
+class KeyIndexFormMixin:
+    # key_index (ImportKeyIndex) передает Loader: проверки идут по индексу загрузки,
+    # без него - как раньше, через Inspector
+    def __init__(self, *args, key_index=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key_index = key_index
+        for field in self.fields.values():
+            if isinstance(field, KeyIndexModelChoiceField):
+                field.key_index = key_index
+
+    def is_exist_in_model(self, value, model, field_name):
+        if self.key_index is None:
+            return Inspector.is_exist_in_model(value, model, field_name)
+        return self.key_index.is_exist(value, model)
+
+    def is_unique_exist_in_model(self, value, model):
+        if self.key_index is None:
+            return Inspector.is_unique_exist_in_model(value, model)
+        return self.key_index.is_exist(value, model)
+
+    def _get_validation_exclusions(self):
+        # ForeignKey уже проверены по key_index в KeyIndexModelChoiceField - повторный запрос в model.full_clean не нужен
+        exclude = super()._get_validation_exclusions()
+        if self.key_index is not None:
+            for name, field in self.fields.items():
+                if isinstance(field, KeyIndexModelChoiceField):
+                    exclude.add(name)
+        return exclude
+
+    def validate_unique(self):
+        if self.key_index is None:
+            super().validate_unique()
+            return
+        model = self._meta.model
+        pk_name = model._meta.pk.name
+        pk = self.instance.pk
+        if (not self.instance._state.adding) or (pk_name in self._errors) or (pk in [None, '']):
+            return
+        if self.key_index.is_exist(pk, model):
+            error = self.instance.unique_error_message(model, (pk_name,))
+            self._update_errors(ValidationError({pk_name: [error]}))
+
+
+class SertNumberForm(KeyIndexFormMixin, forms.ModelForm):
 
     def clean_number(self):
+        # пустой номер выдается в save из счетчика года (SertNumberSequence)
         number = self.cleaned_data['number']
-
-        def get_numder():
-            last = SertNumber.objects.order_by("-year").order_by("-number")[0]
-            number = last.number + 1
-            return number
-
-        if not number:
-            number = get_numder()
-        else:
+        if number:
             r_number, is_good = Inspector.try_integeralization(number)
             if not is_good:
                 error_text = f'{number} - Недопустимое значение'
                 self.add_error('number', ValidationError(error_text))
-                number = get_numder()
+                number = None
             else:
                 number = r_number
         return number
@@ -54,9 +142,7 @@ class SertNumberForm(forms.ModelForm):
         year = self.cleaned_data['year']
 
         def get_year():
-            last = SertNumber.objects.order_by("-year").order_by("-number")[0]
-            year = last.year
-            return year
+            return datetime.now().year
 
         if not year:
             year = get_year()
@@ -76,16 +162,20 @@ class SertNumberForm(forms.ModelForm):
 
         id = self.cleaned_data['id']
 
-        number = self.cleaned_data['number']
         year = self.cleaned_data['year']
+        number = self.cleaned_data['number']
 
         def inspection_id(id):
-            is_exist = Inspector.is_unique_exist_in_model(id, self._meta.model)
+            is_exist = self.is_unique_exist_in_model(id, self._meta.model)
             if is_exist:
                 error_text = f'{id} - Такой номер сертификата уже существует'
-                raise ValidationError(error_text)
+                raise ValidationError(error_text, code='exists')
 
-        if not id:
+        if not number:
+            # номер еще не выдан - проверяется только заданный идентификатор
+            if id:
+                inspection_id(id)
+        elif not id:
             id = f'{number}-{year}'
             inspection_id(id)
         else:
@@ -95,6 +185,18 @@ class SertNumberForm(forms.ModelForm):
         self.cleaned_data['id'] = id
         super().clean()
 
+    def save(self, commit=True):
+        # номер из счетчика выдается только проверенной форме: форма с ошибками или показанная повторно
+        # номеров не расходует; занятые вручную номера пропускаются (SertNumberPool.take)
+        if not self.cleaned_data['number']:
+            year = self.cleaned_data['year']
+            sert_number = SertNumberPool(year, is_deferred=True).take()
+            self.instance.number = sert_number.number
+            self.instance.year = year
+            if not self.cleaned_data['id']:
+                self.instance.id = sert_number.id
+        return super().save(commit)
+
     class Meta:
         model = SertNumber
         fields = [
@@ -123,7 +225,11 @@ class MyDateField(forms.DateField):
         return r_value
 
 
-class SertForm(forms.ModelForm):
+class SertForm(KeyIndexFormMixin, forms.ModelForm):
+    def __init__(self, *args, is_number_deferred=False, **kwargs):
+        # is_number_deferred: номер сертификата не выдается (проверка файла без записи в базу)
+        super().__init__(*args, **kwargs)
+        self.is_number_deferred = is_number_deferred
 
     def clean_is_print(self):
         is_print = self.cleaned_data['is_print']
@@ -137,7 +243,7 @@ class SertForm(forms.ModelForm):
             error_text = 'Номер СПГ не указан'
             self.add_error('number_spg', ValidationError(error_text))
         else:
-            is_exist = Inspector.is_exist_in_model(KernelObj.number_spg, Kernel, 'number_spg')
+            is_exist = self.is_exist_in_model(KernelObj.number_spg, Kernel, 'number_spg')
             if not is_exist:
                 error_text = f'{KernelObj.number_spg} - Записи с таким номером СПГ нет в Kernel'
                 self.add_error('number_spg', ValidationError(error_text))
@@ -175,7 +281,7 @@ class SertForm(forms.ModelForm):
         if not ConclusionObj:
             pass
         else:
-            is_exist = Inspector.is_exist_in_model(ConclusionObj.conclusion_type, Conclusion, 'conclusion_type')
+            is_exist = self.is_exist_in_model(ConclusionObj.conclusion_type, Conclusion, 'conclusion_type')
             if not is_exist:
                 error_text = f'{ConclusionObj.conclusion_type} - Такого типа заключения не существует'
                 self.add_error('conclusion_type', ValidationError(error_text))
@@ -192,7 +298,7 @@ class SertForm(forms.ModelForm):
         if not guarantee_type:
             pass
         else:
-            is_exist = Inspector.is_exist_in_model(guarantee_type, Guarantee, 'guarantee_type')
+            is_exist = self.is_exist_in_model(guarantee_type, Guarantee, 'guarantee_type')
             if not is_exist:
                 error_text = f'{guarantee_type} - Такого типа гарантии не существует'
                 self.add_error('guarantee_type', ValidationError(error_text))
@@ -204,25 +310,32 @@ class SertForm(forms.ModelForm):
         if not sign_type:
             pass
         else:
-            is_exist = Inspector.is_exist_in_model(sign_type, Signatories, 'sign_type')
+            is_exist = self.is_exist_in_model(sign_type, Signatories, 'sign_type')
             if not is_exist:
                 error_text = f'{sign_type} - Такого типа подписантов не существует'
                 self.add_error('sign_type', ValidationError(error_text))
         return sign_type
 
-    def get_number_unique(self):
+    def is_number_needed(self):
+        # номера нет или он не найден в SertNumber
         SertNumberObj = self.cleaned_data['number_unique']
         if not SertNumberObj:
-            new_number = SertNumberForm({'id': '', 'number': '', 'year': '',})
-            new_number.save()
-            SertNumberObj = SertNumber.objects.get(pk=new_number.cleaned_data['id'])
-        else:
-            is_exist = Inspector.is_unique_exist_in_model(SertNumberObj.id, SertNumber)
-            if not is_exist:
-                new_number = SertNumberForm({'id': '', 'number': '', 'year': '',})
-                new_number.save()
-                SertNumberObj = SertNumber.objects.get(pk=new_number.cleaned_data['id'])
+            return True
+        return not self.is_unique_exist_in_model(SertNumberObj.id, SertNumber)
+
+    def set_number_unique(self, SertNumberObj):
+        # после проверки формы (is_number_deferred) номер попадает и в уже собранный instance
         self.cleaned_data['number_unique'] = SertNumberObj
+        self.instance.number_unique = SertNumberObj
+
+    def get_number_unique(self, number_pool=None):
+        # number_pool (SertNumberPool) - номера, зарезервированные заранее на всю загрузку
+        if self.is_number_needed():
+            if number_pool is None:
+                number_pool = SertNumberPool()
+            self.set_number_unique(number_pool.take(self.key_index))
+        elif self.key_index is not None:
+            self.key_index.add(self.cleaned_data['number_unique'].id, SertNumber)
 
     def clean(self):
         if self.errors:
@@ -233,10 +346,10 @@ class SertForm(forms.ModelForm):
         sert_type = self.cleaned_data['sert_type']
 
         def inspection_id(id):
-            is_exist = Inspector.is_unique_exist_in_model(id, self._meta.model)
+            is_exist = self.is_unique_exist_in_model(id, self._meta.model)
             if is_exist:
                 error_text = f'{id} - Такой сертификат уже существует'
-                raise ValidationError(error_text)
+                raise ValidationError(error_text, code='exists')
 
         if not id:
             id = f'{KernelObj.number_spg}-{sert_type}'
@@ -247,7 +360,7 @@ class SertForm(forms.ModelForm):
 
         self.cleaned_data['id'] = id
 
-        if not self.errors:
+        if not self.errors and not self.is_number_deferred:
             self.get_number_unique()
         super().clean()
 
@@ -269,6 +382,9 @@ class SertForm(forms.ModelForm):
         field_classes = {
             'date': MyDateField,
             'galvan_date': MyDateField,
+            'number_spg': KeyIndexModelChoiceField,
+            'number_unique': KeyIndexModelChoiceField,
+            'conclusion_type': KeyIndexModelChoiceField,
         }
 
 
@@ -313,7 +429,7 @@ class SertFormUpdate(SertForm):
         }
 
 
-class KernelForm(forms.ModelForm):
+class KernelForm(KeyIndexFormMixin, forms.ModelForm):
 
     def clean_is_atom(self):
         is_atom = self.cleaned_data['is_atom']
@@ -397,7 +513,7 @@ class MyDecimalField(forms.DecimalField):
         return value
 
 
-class AttachmentForm(forms.ModelForm):
+class AttachmentForm(KeyIndexFormMixin, forms.ModelForm):
 
     def clean_number_spg(self):
         KernelObj  = self.cleaned_data['number_spg']
@@ -405,7 +521,7 @@ class AttachmentForm(forms.ModelForm):
             error_text = 'Номер СПГ не указан'
             self.add_error('number_spg', ValidationError(error_text))
         else:
-            is_exist = Inspector.is_exist_in_model(KernelObj.number_spg, Kernel, 'number_spg')
+            is_exist = self.is_exist_in_model(KernelObj.number_spg, Kernel, 'number_spg')
             if not is_exist:
                 error_text = f'{KernelObj.number_spg} - Записи с таким номером СПГ нет в Kernel'
                 self.add_error('number_spg', ValidationError(error_text))
@@ -416,7 +532,7 @@ class AttachmentForm(forms.ModelForm):
         if not SertNumberObj:
             pass
         else:
-            is_exist = Inspector.is_exist_in_model(SertNumberObj.id, SertNumber, 'id')
+            is_exist = self.is_exist_in_model(SertNumberObj.id, SertNumber, 'id')
             if not is_exist:
                 error_text = f'{SertNumberObj.id} - Записи с таким номером сертификата нет в SertNumber'
                 self.add_error('number_unique', ValidationError(error_text))
@@ -521,7 +637,7 @@ class AttachmentForm(forms.ModelForm):
             melt_year = self.cleaned_data['melt_year']
             melt_passport = self.cleaned_data['melt_passport']
             melt_id = f'{melt_number}-{material_id}-{melt_year}-{melt_passport}'
-            is_exist = Inspector.is_exist_in_model(melt_id, Melt, 'melt_id')
+            is_exist = self.is_exist_in_model(melt_id, Melt, 'melt_id')
             if not is_exist:
                 error_text = f'{melt_id} - Такой плавки не зарегистрировано'
                 raise ValidationError(error_text)
@@ -630,6 +746,10 @@ class AttachmentForm(forms.ModelForm):
             'galvan_material',
             'galvan_units',
         ]
+        field_classes = {
+            'number_spg': KeyIndexModelChoiceField,
+            'number_unique': KeyIndexModelChoiceField,
+        }
         # field_classes = {
         #     'item_units': MyDecimalField,
         #     'quantity': MyDecimalField,
@@ -761,7 +881,7 @@ class AttachmentFormUpdate(AttachmentForm):
 
 
 
-class MeltForm(forms.ModelForm):
+class MeltForm(KeyIndexFormMixin, forms.ModelForm):
 
     def clean_by_gost_number(self):
         by_gost_number = self.cleaned_data['by_gost_number']
@@ -784,10 +904,10 @@ class MeltForm(forms.ModelForm):
             return melt_id
 
         def inspection_id(id):
-            is_exist = Inspector.is_unique_exist_in_model(id, self._meta.model)
+            is_exist = self.is_unique_exist_in_model(id, self._meta.model)
             if is_exist:
                 error_text = f'{id} - Такая отливка уже существует'
-                raise ValidationError(error_text)
+                raise ValidationError(error_text, code='exists')
 
         if not melt_id:
             melt_id = get_melt_id()
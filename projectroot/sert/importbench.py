@@ -0,0 +1,219 @@
+from collections import namedtuple
+from datetime import datetime
+import os
+import resource
+import time
+
+from django.core.files import File
+from django.db import connection
+from openpyxl import Workbook
+
+from sert.createdocx2 import MeltAnatomy
+from sert.importxlsx import Importer, Converter, Loader
+from sert.models import Melt, Kernel, Sert, SertNumber, SertNumberSequence, Attachment
+
+# сертификатов на один продукт - один, типы сертификатов по кругу
+BENCH_SERT_TYPES = ['НАСОС', 'АРМАТУРА', 'РЕМКОМПЛЕКТ',]
+# одна плавка на столько вложений
+BENCH_ATTACH_PER_MELT = 20
+
+
+class BenchWorkbookMaker:
+    # синтетическая книга SERT/ATTACH/MELT заданного размера: заголовки берутся из карт колонок Importer,
+    # вложения сертификата - дерево деталей по a/b/a1/b1/a2/b2_index с отливками, материалы плавок - из MeltAnatomy
+    def __init__(self, attach_count, attach_per_sert=50):
+        self.attach_count = attach_count
+        self.attach_per_sert = attach_per_sert
+        self.sert_count = max(1, -(-attach_count // attach_per_sert))
+        self.melt_count = max(1, attach_count // BENCH_ATTACH_PER_MELT)
+        self.importer = Importer()
+        self.melt_anatomy = MeltAnatomy()
+        self.melts_list = []
+
+    def make(self, path):
+        wb = Workbook(write_only=True)
+        self.add_melt_ws(wb)
+        self.add_sert_ws(wb)
+        self.add_attach_ws(wb)
+        wb.save(path)
+
+    def get_head_row(self, name):
+        names_conv = self.importer.__getattribute__(f'{name}_names_conv')
+        row_names = self.importer.__getattribute__(f'{name}_row_names')
+        inv_names_conv = {v: k for k, v in names_conv.items()}
+        return [inv_names_conv[row_name] for row_name in row_names]
+
+    def add_rows(self, wb, name, rows):
+        ws = wb.create_sheet(self.importer.ws_names_dict[name])
+        row_names = self.importer.__getattribute__(f'{name}_row_names')
+        ws.append(self.get_head_row(name))
+        for row in rows:
+            ws.append([row.get(row_name) for row_name in row_names])
+
+    def add_melt_ws(self, wb):
+        metadata_list = list(self.melt_anatomy.metadata_list.values())
+        melt_row_names = self.importer.melt_row_names
+        rows = []
+        for index in range(self.melt_count):
+            metadata = metadata_list[index % len(metadata_list)]
+            row = {
+                'melt_number': str(1000 + index),
+                'material_id': metadata.material_id,
+                'melt_year': '2024',
+                'melt_passport': f'П{index}',
+            }
+            for name in metadata.chem_list:
+                row[name] = 0.125
+            for mech_list in metadata.mech_list.values():
+                for name in mech_list:
+                    name = name.strip()
+                    if name in melt_row_names:
+                        row[name] = 300 if name in ['tensile_strength', 'yield_strength'] else '20'
+            rows.append(row)
+            self.melts_list.append(row)
+        self.add_rows(wb, 'melt', rows)
+
+    def add_sert_ws(self, wb):
+        rows = []
+        for index in range(self.sert_count):
+            rows.append({
+                'number_spg': f'БЕНЧ-{index}',
+                'designation': f'СПГ.{index:06}',
+                'denomination': f'Насосный агрегат {index}',
+                'quantity': 1 + index % 3,
+                'sert_type': BENCH_SERT_TYPES[index % len(BENCH_SERT_TYPES)],
+                'date': datetime(2024, 1 + index % 12, 1),
+                'is_drag_met': 'нет',
+                'is_print': 'нет',
+                'is_atom': 'нет',
+            })
+        self.add_rows(wb, 'sert', rows)
+
+    def add_attach_ws(self, wb):
+        rows = []
+        melt_index = 0
+        for index in range(self.sert_count):
+            count = min(self.attach_per_sert, self.attach_count - index * self.attach_per_sert)
+            for tree_row in self.get_tree_rows(count):
+                row = {
+                    'sert_type': BENCH_SERT_TYPES[index % len(BENCH_SERT_TYPES)],
+                    'number_spg': f'БЕНЧ-{index}',
+                    'designation': f'ДЕТ.{len(rows):07}',
+                    'denomination': 'Деталь',
+                    'quantity': 1 + len(rows) % 2,
+                    'is_by_gost_material_number': 'нет',
+                }
+                if tree_row.pop('is_cast', False):
+                    melt = self.melts_list[melt_index % len(self.melts_list)]
+                    melt_index += 1
+                    for name in ['melt_number', 'material_id', 'melt_year', 'melt_passport']:
+                        row[name] = melt[name]
+                row.update(tree_row)
+                rows.append(row)
+        self.add_rows(wb, 'attach', rows)
+
+    @staticmethod
+    def get_tree_rows(count):
+        # деталь 1-го уровня (a_index), два её узла 2-го уровня (b_index -> a1_index) с деталями 3-го (b1 -> a2)
+        # и 4-го (b2) уровня и отливка детали (b_index); по 8 строк на деталь 1-го уровня
+        rows = []
+        part = 0
+        while len(rows) < count:
+            part += 1
+            a_index = str(part)
+            rows.append({'a_index': a_index})
+            for node in range(1, 3):
+                a1_index = f'{part}.{node}'
+                a2_index = f'{a1_index}.1'
+                rows.append({'b_index': a_index, 'a1_index': a1_index})
+                rows.append({'b1_index': a1_index, 'a2_index': a2_index})
+                rows.append({'b2_index': a2_index})
+            rows.append({'b_index': a_index, 'is_cast': True})
+        return rows[:count]
+
+
+class ImportBenchmark:
+    # этапы загрузки по отдельности на пустой базе: разбор (Importer), преобразование (Converter),
+    # запись (Loader) и повторная запись того же файла (строки без изменений пропускаются)
+    def __init__(self, is_bulk=True, attach_per_sert=50):
+        self.is_bulk = is_bulk
+        self.attach_per_sert = attach_per_sert
+        self.stage_nt = namedtuple('stage', [
+            'size', 'stage', 'rows', 'seconds', 'rows_per_sec', 'peak_rss_mb', 'queries',
+        ])
+        self.queries_count = 0
+
+    def run(self, size, path):
+        maker = BenchWorkbookMaker(size, self.attach_per_sert)
+        stages_list = []
+        start = time.perf_counter()
+        maker.make(path)
+        stages_list.append(self.stage_nt(size, 'generate', maker.attach_count + maker.sert_count + maker.melt_count,
+                                         time.perf_counter() - start, None, None, None))
+
+        self.reset_db()
+        importer = Importer()
+        with open(path, 'rb') as input_file:
+            stages_list.append(self.measure(size, 'parse', importer.set_input_file,
+                                            File(input_file, name=os.path.basename(path))))
+        rows_count = sum(len(rows) for rows in importer.get_result().values())
+        stages_list[-1] = stages_list[-1]._replace(rows=rows_count, rows_per_sec=self.get_rate(rows_count,
+                                                   stages_list[-1].seconds))
+
+        converter = Converter()
+        stages_list.append(self.measure(size, 'convert', converter.set_input_data, importer.get_result()))
+        rows_count = sum(len(rows) for rows in converter.get_result().values())
+        stages_list[-1] = stages_list[-1]._replace(rows=rows_count, rows_per_sec=self.get_rate(rows_count,
+                                                   stages_list[-1].seconds))
+
+        for stage in ['load', 'reload']:
+            loader = Loader(is_bulk=self.is_bulk)
+            stages_list.append(self.measure(size, stage, loader.set_input_data, converter.get_result()))
+            stages_list[-1] = stages_list[-1]._replace(rows=rows_count, rows_per_sec=self.get_rate(rows_count,
+                                                       stages_list[-1].seconds))
+        return stages_list
+
+    def measure(self, size, stage, function, *args):
+        self.queries_count = 0
+        reset_peak_rss()
+        with connection.execute_wrapper(self.count_query):
+            start = time.perf_counter()
+            function(*args)
+            seconds = time.perf_counter() - start
+        return self.stage_nt(size, stage, None, seconds, None, get_peak_rss_mb(), self.queries_count)
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries_count += 1
+        return execute(sql, params, many, context)
+
+    @staticmethod
+    def get_rate(rows_count, seconds):
+        return rows_count / seconds if seconds else None
+
+    @staticmethod
+    def reset_db():
+        for model in [Attachment, Sert, SertNumber, SertNumberSequence, Kernel, Melt]:
+            model.objects.all().delete()
+        year = datetime.now().year
+        SertNumber.objects.create(id=f'1-{year}', number=1, year=year)
+
+
+def reset_peak_rss():
+    # в Linux пик RSS процесса (VmHWM) можно сбросить - тогда пик считается для каждого этапа отдельно
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # без /proc - пик за все время процесса (ru_maxrss в КБ)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
@@ -0,0 +1,142 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.contrib import messages
+from django.core.cache import cache
+from django.core.files import File
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from sert.importxlsx import ImportManager
+from sert.models import ImportJob
+
+# не чаще раза в PROGRESS_INTERVAL секунд счетчики загрузки пишутся в cache
+PROGRESS_INTERVAL = 1.0
+PROGRESS_TIMEOUT = 60 * 60
+# файлы от этого размера (байт) загружаются потоком: частями, каждая часть записывается своей транзакцией
+STREAMING_MIN_FILE_SIZE = 20 * 1024 * 1024
+# пока задание выполняется, worker раз в HEARTBEAT_INTERVAL секунд отмечается в cache; задание RUNNING без отметки
+# дольше HEARTBEAT_TIMEOUT брошено (worker упал или остановлен) и снова ставится в очередь,
+# а после MAX_ATTEMPTS запусков завершается ошибкой
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 5 * 60
+MAX_ATTEMPTS = 2
+
+
+class ImportJobRunner:
+    def __init__(self):
+        self.job = None
+        self.progress_time = 0.0
+
+    def claim_job(self):
+        # задание забирает тот worker, чей UPDATE сменил статус PENDING -> RUNNING
+        pending_ids = (ImportJob.objects.filter(status='PENDING')
+                       .order_by('created_at')
+                       .values_list('id', flat=True)[:10])
+        for job_id in pending_ids:
+            is_claimed = (ImportJob.objects.filter(id=job_id, status='PENDING')
+                          .update(status='RUNNING', started_at=timezone.now(), attempts=F('attempts') + 1))
+            if is_claimed:
+                job = ImportJob.objects.get(id=job_id)
+                self.set_heartbeat(job)
+                return job
+        return None
+
+    def reclaim_stale_jobs(self):
+        # брошенное задание забирает из RUNNING тот worker, чей UPDATE сменил статус
+        stale_time = timezone.now() - timedelta(seconds=HEARTBEAT_TIMEOUT)
+        for job in ImportJob.objects.filter(status='RUNNING', started_at__lt=stale_time):
+            if cache.get(job.get_heartbeat_key()) is not None:
+                continue
+            is_failed = job.attempts >= MAX_ATTEMPTS
+            status = 'FAILED' if is_failed else 'PENDING'
+            is_reclaimed = (ImportJob.objects.filter(id=job.id, status='RUNNING', started_at=job.started_at)
+                            .update(status=status))
+            if is_reclaimed and is_failed:
+                job.status = status
+                error_text = (f'ImportJob: загрузка прервана - worker остановился во время загрузки '
+                              f'{job.attempts} раз(а) подряд')
+                job.messages = job.messages + [[messages.ERROR, error_text]]
+                job.finished_at = timezone.now()
+                self.delete_job_file(job)
+                job.save(update_fields=['messages', 'finished_at', 'file'])
+                cache.delete(job.get_progress_key())
+
+    @staticmethod
+    def set_heartbeat(job):
+        cache.set(job.get_heartbeat_key(), time.time(), HEARTBEAT_TIMEOUT)
+
+    def run_heartbeat(self, job, stop_event):
+        # отдельный поток: отметки идут и во время долгих этапов без счетчиков (разбор книги, запись части)
+        while not stop_event.wait(HEARTBEAT_INTERVAL):
+            self.set_heartbeat(job)
+
+    @staticmethod
+    def delete_job_file(job):
+        # файл загрузки нужен только до завершения задания: сообщения хранятся в задании
+        if job.file:
+            job.file.delete(save=False)
+            job.file = ''
+
+    def run_once(self):
+        close_old_connections()
+        self.reclaim_stale_jobs()
+        self.job = self.claim_job()
+        if self.job is None:
+            return False
+        self.run_job()
+        return True
+
+    def run_forever(self, sleep_time):
+        while True:
+            if not self.run_once():
+                time.sleep(sleep_time)
+
+    def set_progress(self, progress_dict):
+        now = time.monotonic()
+        if now - self.progress_time >= PROGRESS_INTERVAL:
+            self.progress_time = now
+            cache.set(self.job.get_progress_key(), dict(progress_dict), PROGRESS_TIMEOUT)
+
+    def run_job(self):
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=self.run_heartbeat, args=(self.job, stop_event), daemon=True)
+        heartbeat.start()
+        try:
+            self.load_job()
+        finally:
+            stop_event.set()
+            heartbeat.join()
+            cache.delete(self.job.get_heartbeat_key())
+
+    def load_job(self):
+        job = self.job
+        self.progress_time = 0.0
+        # worker - отдельный процесс manage.py, в нем листы большого файла можно разбирать параллельно
+        is_streaming = job.file.size >= STREAMING_MIN_FILE_SIZE
+        # замеры этапов видны в сообщениях только сотрудникам (is_staff)
+        is_stats_shown = job.user is not None and job.user.is_staff
+        IM = ImportManager(is_bulk=job.is_bulk, is_stale_deleted=job.is_stale_deleted, is_concurrent=True,
+                           is_streaming=is_streaming, is_cached=True, is_stats_shown=is_stats_shown,
+                           progress_callback=self.set_progress)
+        try:
+            with job.file.open('rb') as input_file:
+                # файл хранилища на диске: книга читается по пути (get_file_path)
+                IM.set_file(File(input_file.file, name=job.file_name))
+            job.status = 'DONE'
+            job.messages = [[level, text] for level, text in IM.get_errors()]
+            job.report_key = IM.save_report(job.user_id)
+        except Exception as e:
+            job.status = 'FAILED'
+            error_text = f'ImportJob: загрузка прервана ошибкой: {e}'
+            job.messages = [[level, text] for level, text in IM.get_errors()] + [[messages.ERROR, error_text]]
+        progress = IM.get_progress()
+        job.parsed_count = progress['parsed']
+        job.validated_count = progress['validated']
+        job.saved_count = progress['saved']
+        job.finished_at = timezone.now()
+        self.delete_job_file(job)
+        job.save()
+        cache.delete(job.get_progress_key())
@@ -0,0 +1,90 @@
+from collections import namedtuple
+import csv
+import io
+import uuid
+
+from django.conf import settings
+from openpyxl import Workbook
+
+from sert.diskcache import DiskLRUCache
+
+# отчеты загрузок в settings.IMPORT_REPORT_DIR: общий размер записей (байт)
+REPORT_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# состояния строк в отчете в порядке вывода: сначала то, что требует исправления файла
+REPORT_STATUS_LIST = ['ошибка', 'конфликт', 'сохранена', 'обновлена', 'удалена',]
+REPORT_HEAD = ['статус', 'лист', 'строка', 'модель', 'запись', 'поле', 'сообщение',]
+REPORT_SHEET_ORDER = ['SERT', 'ATTACH', 'MELT',]
+
+ReportRow = namedtuple('ReportRow', ['status', 'sheet', 'row_number', 'model', 'key', 'field', 'message'])
+
+
+class ImportReport:
+    # итог загрузки: строки файла с ошибками полей и конфликтами и число сохраненных, обновленных и удаленных
+    # записей каждой model; в сообщения загрузки идут только счетчики и ссылка на отчет (xlsx или CSV)
+    def __init__(self):
+        self.rows_list = []
+        self.counts_dict = {}  # {(status, sheet, model): записей}
+        self.file_name = None
+        self.user_id = None
+
+    def add_row(self, status, sheet, row_number, model, key, field=None, message=None):
+        self.rows_list.append(ReportRow(status, sheet, row_number, model, key, field, message))
+
+    def add_count(self, status, sheet, model, count=1):
+        # сохраненные записи - только счетчиком по model: отчет не растет с размером файла
+        key = (status, sheet, model)
+        self.counts_dict[key] = self.counts_dict.get(key, 0) + count
+
+    def discard_saved(self):
+        # транзакция откачена - записи не сохранены, ошибки строк остаются
+        self.counts_dict = {}
+
+    def is_empty(self):
+        return not self.rows_list and not self.counts_dict
+
+    def get_count_rows(self):
+        # счетчик - строка отчета без номера строки файла
+        return [ReportRow(status, sheet, None, model, None, None, f'записей: {count}')
+                for (status, sheet, model), count in self.counts_dict.items()]
+
+    def get_rows(self):
+        # сгруппированы по состоянию, листу, номеру строки и полю
+        def sort_key(row):
+            sheet_index = REPORT_SHEET_ORDER.index(row.sheet) if row.sheet in REPORT_SHEET_ORDER else len(REPORT_SHEET_ORDER)
+            return (REPORT_STATUS_LIST.index(row.status), sheet_index, row.row_number or 0, row.field or '')
+        return sorted(self.rows_list + self.get_count_rows(), key=sort_key)
+
+    def get_xlsx_content(self):
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('ОТЧЕТ')
+        ws.append(REPORT_HEAD)
+        for row in self.get_rows():
+            ws.append(list(row))
+        with io.BytesIO() as buffer:
+            wb.save(buffer)
+            return buffer.getvalue()
+
+    def get_csv_content(self):
+        # utf-8 с BOM и ';' - файл открывается в Excel без мастера импорта
+        with io.StringIO() as buffer:
+            writer = csv.writer(buffer, delimiter=';')
+            writer.writerow(REPORT_HEAD)
+            for row in self.get_rows():
+                writer.writerow(['' if value is None else value for value in row])
+            return buffer.getvalue().encode('utf-8-sig')
+
+    def save(self, file_name, user_id):
+        # возвращает ключ отчета для ссылки importreport
+        self.file_name = file_name
+        self.user_id = user_id
+        report_key = uuid.uuid4().hex
+        get_report_cache().set(report_key, self)
+        return report_key
+
+
+def get_report_cache():
+    return DiskLRUCache(settings.IMPORT_REPORT_DIR, REPORT_CACHE_MAX_SIZE)
+
+
+def get_report(report_key):
+    return get_report_cache().get(report_key)
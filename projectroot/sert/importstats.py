@@ -0,0 +1,53 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import time
+
+from django.db import connection
+
+# этап загрузки: время общее и процессора (сек), строки и запросы к базе
+StageStat = namedtuple('StageStat', ['name', 'wall_time', 'cpu_time', 'rows', 'queries'])
+
+
+class ImportStats:
+    # замеры этапов одной загрузки в порядке выполнения: Importer, Converter и Loader ведут каждый свои,
+    # ImportManager собирает их в один список
+    def __init__(self):
+        self.stages_list = []
+
+    @contextmanager
+    def measure(self, name):
+        # with stats.measure('load_melt') as stage: ... stage['rows'] = ...
+        # этап записывается и при исключении - время до ошибки тоже полезно
+        stage = {'rows': 0, 'queries': 0}
+
+        def count_query(execute, sql, params, many, context):
+            stage['queries'] += 1
+            return execute(sql, params, many, context)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            with connection.execute_wrapper(count_query):
+                yield stage
+        finally:
+            self.stages_list.append(StageStat(
+                name,
+                time.perf_counter() - wall_start,
+                time.process_time() - cpu_start,
+                stage['rows'],
+                stage['queries'],
+            ))
+
+    def get_result(self):
+        return self.stages_list
+
+    def add_stages(self, stages_list):
+        # этапы из процессов пула приходят простыми кортежами
+        self.stages_list += [StageStat._make(stage) for stage in stages_list]
+
+    def get_text(self):
+        # одна строка: "get_file_object 0.05s cpu 0.04s rows 0 queries 0; iter_ws_rows:sert ...; ..."
+        return '; '.join(
+            f'{stage.name} {stage.wall_time:.2f}s cpu {stage.cpu_time:.2f}s rows {stage.rows} queries {stage.queries}'
+            for stage in self.stages_list
+        )
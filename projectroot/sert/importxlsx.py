@@ -1,9 +1,19 @@
 from collections import namedtuple
+from itertools import islice
 from datetime import datetime
+from django.conf import settings
 from django.contrib import messages
+from django.db import DatabaseError, transaction
+import csv
+import hashlib
+import io
 import json
-import copy
+import logging
+import os
+import zipfile
 
+from django.core.files import File
+from io import BytesIO
 from openpyxl import load_workbook, Workbook
 from sert.forms import (
     MeltForm,
@@ -11,26 +21,130 @@ from sert.forms import (
     SertForm,
     AttachmentForm,
 )
+from sert.models import Melt, Kernel, Sert, Attachment
+from sert.models_data import METHODS_LIST
+from sert.models_keyindex import ATTACHMENT_KEY_FIELDS, ImportKeyIndex
+from sert.models_numbers import SertNumberPool
+from sert.diskcache import DiskLRUCache
+from sert.importstats import ImportStats
+from sert.importreport import ImportReport
+from sert.workers import get_process_pool
+
+# размер пачки для bulk_create в режиме is_bulk
+BULK_BATCH_SIZE = 500
+# сколько строк model держит в памяти потоковая загрузка (is_streaming)
+STREAM_CHUNK_SIZE = 2000
+# файлы меньше этого размера (байт) в режиме is_concurrent все равно разбираются последовательно
+CONCURRENT_MIN_FILE_SIZE = 512 * 1024
+# разделитель CSV-файла - тот из этих символов, которого больше всего в строке заголовков
+CSV_DELIMITERS = [';', ',', '\t',]
+# ключ объекта ndjson-файла с именем листа: {"лист": "SERT", "номер_СПГ": ...}
+NDJSON_SHEET_KEY = 'лист'
+# колонка одиночного CSV-файла с именем листа строки: строки всех листов в одном файле
+CSV_SHEET_COLUMN = 'лист'
+# cache разбора файлов (is_cached) в settings.IMPORT_PARSE_CACHE_DIR: общий размер записей (байт)
+PARSE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# увеличь, если меняется преобразование строк, а карты колонок и поля остаются прежними
+PARSE_CACHE_VERSION = 2
+# даты текстовых форматов (CSV, ndjson); в xlsx-файле дата - значение ячейки
+TEXT_DATE_FORMATS = ['%d.%m.%Y', '%Y-%m-%d',]
+
+logger = logging.getLogger(__name__)
 
 
 class ImportManager:
-    def __init__(self):
+    def __init__(self, is_bulk=False, is_dry_run=False, is_stale_deleted=False, is_concurrent=False,
+                 is_streaming=False, is_cached=False, is_stats_shown=False, progress_callback=None):
+        # is_dry_run: файл читается и проверяется полностью, но в базу ничего не пишется
+        # is_stale_deleted: загруженные ранее вложения сертификатов файла, строк которых в файле больше нет,
+        # удаляются (Loader.delete_stale_attachments); по умолчанию они остаются
+        # is_concurrent: листы читаются и преобразуются параллельно, каждый в своем процессе;
+        # только вне запросов сайта - в importworker и командах manage.py (см. sert.workers)
+        # is_streaming: строки идут от чтения листа до записи частями по STREAM_CHUNK_SIZE,
+        # память не зависит от размера файла; is_concurrent и is_cached при этом не действуют
+        # is_cached: разобранные строки файла сохраняются в cache на диске, повторная загрузка
+        # того же файла начинается сразу с проверки строк
+        # is_stats_shown: замеры этапов (get_stats) добавляются в сообщения загрузки, в лог они пишутся всегда
+        self.is_concurrent = is_concurrent
+        self.is_streaming = is_streaming
+        self.is_cached = is_cached
+        self.is_stats_shown = is_stats_shown
+        # progress_callback(progress_dict) вызывается при каждом изменении счетчиков строк
+        self.progress_callback = progress_callback
+        self.progress_dict = {'parsed': 0, 'validated': 0, 'saved': 0,}
         self.input_file = None
         self.importer = Importer()
         self.converter = Converter()
-        self.loader = Loader()
+        self.loader = Loader(is_bulk=is_bulk, is_dry_run=is_dry_run, is_stale_deleted=is_stale_deleted,
+                             progress_callback=self.set_progress)
         self.errors_list = [] # (level, text,)
+        # этапы самого ImportManager: cache разбора и вся загрузка файла (set_file)
+        self.stats = ImportStats()
 
     def get_errors(self):
         return self.errors_list
 
+    def get_summary(self):
+        return self.loader.get_summary()
+
+    def get_report(self):
+        return self.loader.get_report()
+
+    def save_report(self, user_id):
+        # ключ сохраненного отчета или None, если в отчете нет строк
+        report = self.get_report()
+        if report.is_empty():
+            return None
+        return report.save(self.input_file.name, user_id)
+
+    def get_stats(self):
+        # этапы Importer, Converter, Loader и ImportManager в одном ImportStats;
+        # при is_streaming чтение и преобразование строк идут внутри этапов load_*
+        stats = ImportStats()
+        for component in [self.importer, self.converter, self.loader, self]:
+            stats.stages_list += component.stats.get_result()
+        return stats
+
+    def get_progress(self):
+        return self.progress_dict
+
+    def set_progress(self, **kwargs):
+        self.progress_dict.update(kwargs)
+        if self.progress_callback is not None:
+            self.progress_callback(self.progress_dict)
+
     def set_file(self, input_file):
-        self.importer.set_input_file(input_file)
+        try:
+            with self.stats.measure('set_file') as stage:
+                self.load_file(input_file)
+                stage['rows'] = self.progress_dict['parsed']
+        finally:
+            self.report_stats(input_file)
+
+    def report_stats(self, input_file):
+        stats_text = self.get_stats().get_text()
+        logger.info('Загрузка файла "%s": %s', input_file.name, stats_text)
+        if self.is_stats_shown:
+            error_text = f'Замеры загрузки (время, время процессора, строки, запросы): {stats_text}'
+            error = (messages.INFO, error_text)
+            self.errors_list.append(error)
+
+    def load_file(self, input_file):
+        self.input_file = input_file
+        self.importer = self.get_importer(input_file)
+        if self.is_streaming:
+            self.set_file_streaming(input_file)
+            return
+        if self.is_cached:
+            self.parse_cached(input_file)
+        else:
+            self.parse_file(input_file)
         if self.importer.get_errors():
             self.errors_list += self.importer.get_errors()
 
         if not self.importer.get_fatal_error():
-            self.converter.set_input_data(self.importer.get_result())
+            # строки, разобранные по models: строка листа SERT дает Kernel и Sert
+            self.set_progress(parsed=sum(len(rows) for rows in self.converter.get_result().values()))
             # if self.converter.get_errors():
             #     self.errors_list += self.converter.get_errors()
 
@@ -38,8 +152,175 @@ class ImportManager:
             if self.loader.get_errors():
                 self.errors_list += self.loader.get_errors()
 
+    def set_file_streaming(self, input_file):
+        # листы и колонки проверяются до загрузки, строки читаются уже во время записи
+        self.importer.open_input_file(input_file)
+        if self.importer.get_errors():
+            self.errors_list += self.importer.get_errors()
+
+        if not self.importer.get_fatal_error():
+            input_stream = {name: self.get_rows_stream(name) for name in self.converter.result_lists_names}
+            self.loader.set_input_stream(input_stream)
+            if self.loader.get_errors():
+                self.errors_list += self.loader.get_errors()
+        self.importer.close_file_object()
+
+    def get_rows_stream(self, name):
+        def rows_stream():
+            rows = self.importer.iter_ws_rows(self.converter.data_pair[name])
+            return self.count_parsed(self.converter.iter_model_rows(name, rows))
+        return rows_stream
+
+    def count_parsed(self, rows):
+        for row in rows:
+            self.progress_dict['parsed'] += 1
+            yield row
+
+    def parse_file(self, input_file):
+        if self.is_concurrent and self.is_worth_concurrent(input_file):
+            self.parse_concurrent(input_file)
+        else:
+            self.parse(input_file)
+
+    def parse_cached(self, input_file):
+        parse_cache = get_parse_cache()
+        with self.stats.measure('parse_cached') as stage:
+            cache_key = self.get_cache_key(input_file)
+            cached = parse_cache.get(cache_key)
+            if cached is not None:
+                errors, fatal_error, converted = cached
+                self.importer.set_cached_errors(errors, fatal_error)
+                self.converter.set_converted_rows(converted)
+                stage['rows'] = sum(len(rows) for rows in converted.values())
+        if cached is not None:
+            return
+        self.parse_file(input_file)
+        # строки хранятся простыми кортежами, как их возвращает parse_sheet
+        converted = {}
+        for name, rows in self.converter.get_result().items():
+            if rows:
+                converted[name] = [tuple(row) for row in rows]
+        parse_cache.set(cache_key, (self.importer.get_errors(), self.importer.get_fatal_error(), converted))
+
+    def get_cache_key(self, input_file):
+        # содержимое файла и схема разбора: тот же файл под другим именем находит ту же запись,
+        # а после изменения карт колонок Importer или полей Converter прежние записи cache больше не находятся;
+        # формат файла (по расширению) входит в схему - это класс Importer
+        key_hash = hashlib.sha256()
+        key_hash.update(self.get_parse_schema().encode('utf-8'))
+        for chunk in input_file.chunks():
+            key_hash.update(chunk)
+        input_file.seek(0)
+        return key_hash.hexdigest()
+
+    def get_parse_schema(self):
+        importer = self.importer
+        converter = self.converter
+        schema = {
+            'version': PARSE_CACHE_VERSION,
+            'importer': type(importer).__name__,
+            'text': [CSV_DELIMITERS, NDJSON_SHEET_KEY, CSV_SHEET_COLUMN],
+            'sheets': [[
+                importer.ws_names_dict[name],
+                importer.__getattribute__(f'{name}_names_conv'),
+                importer.__getattribute__(f'{name}_row_names'),
+            ] for name in importer.ws_list],
+            'models': [[
+                name,
+                converter.__getattribute__(f'{name}_pattern'),
+                converter.__getattribute__(f'{name}_load_fields'),
+                converter.__getattribute__(f'{name}_nt')._fields,
+            ] for name in converter.result_lists_names],
+            'fields': [converter.bool_fields, converter.date_fields, converter.melt_id_fields],
+        }
+        return json.dumps(schema, default=str, ensure_ascii=False)
+
+    def parse(self, input_file):
+        self.importer.set_input_file(input_file)
+        if not self.importer.get_fatal_error():
+            self.converter.set_input_data(self.importer.get_result())
+
+    @staticmethod
+    def get_importer(input_file):
+        # чтение файла выбирается по расширению; строки листов у всех одинаковые - Converter и Loader общие
+        IMPORTERS = {
+            '.xlsx': Importer,
+            '.zip': CsvImporter,
+            '.csv': CsvFileImporter,
+            '.ndjson': NdjsonImporter,
+            '.jsonl': NdjsonImporter,
+        }
+        for extension, importer_class in IMPORTERS.items():
+            if input_file.name.endswith(extension):
+                return importer_class()
+        # сообщит о неподходящем формате
+        return Importer()
+
+    @staticmethod
+    def is_worth_concurrent(input_file):
+        return input_file.name.endswith('.xlsx') and input_file.size >= CONCURRENT_MIN_FILE_SIZE
+
+    def parse_concurrent(self, input_file):
+        # процессам пула передается путь к файлу; содержимое - только если файла на диске нет
+        file_source = get_file_path(input_file)
+        if file_source is None:
+            input_file.seek(0)
+            file_source = input_file.read()
+        ws_list = self.importer.ws_list
+        with get_process_pool(len(ws_list)) as pool:
+            futures = [pool.submit(parse_sheet, file_source, input_file.name, ws_name) for ws_name in ws_list]
+            sheets_results = [future.result() for future in futures]
+        self.importer.set_sheets_errors([errors for errors, converted, stages in sheets_results])
+        for errors, converted, stages in sheets_results:
+            self.importer.stats.add_stages(stages)
+        if not self.importer.get_fatal_error():
+            for errors, converted, stages in sheets_results:
+                self.converter.set_converted_rows(converted)
+
+
+def get_parse_cache():
+    return DiskLRUCache(settings.IMPORT_PARSE_CACHE_DIR, PARSE_CACHE_MAX_SIZE)
+
+
+def get_file_path(input_file):
+    # путь к файлу на диске: загрузка, записанная во временный файл, или открытый файл хранилища;
+    # по пути книга читается без копии содержимого в памяти
+    if hasattr(input_file, 'temporary_file_path'):
+        return input_file.temporary_file_path()
+    file_path = getattr(input_file.file, 'name', None)
+    if isinstance(file_path, str) and os.path.isfile(file_path):
+        return file_path
+    return None
+
+
+def parse_sheet(file_source, file_name, ws_name):
+    # выполняется в процессе пула: чтение и преобразование одного листа,
+    # строки возвращаются простыми кортежами - namedtuple из Converter между процессами не передаются;
+    # file_source - путь к файлу или его содержимое (bytes); замеры этапов - тоже кортежами
+    importer = Importer()
+    importer.ws_list = [ws_name]
+    if isinstance(file_source, bytes):
+        importer.set_input_file(File(BytesIO(file_source), name=file_name))
+    else:
+        with open(file_source, 'rb') as raw_file:
+            importer.set_input_file(File(raw_file, name=file_name))
+    converted = {}
+    stages = [tuple(stage) for stage in importer.stats.get_result()]
+    if not importer.get_fatal_error():
+        converter = Converter()
+        converter.set_input_data(importer.get_result())
+        for name, rows in converter.get_result().items():
+            if rows:
+                converted[name] = [tuple(row) for row in rows]
+        # Converter проходит все models, а строки есть только у моделей этого листа
+        stages += [tuple(stage) for stage in converter.stats.get_result() if stage.rows]
+    return importer.get_errors(), converted, stages
+
 
 class Importer:
+    # вид файла в сообщениях: "xlsx-файл не содержит лист ..."
+    file_kind = 'xlsx'
+
     def __init__(self):
         self.input_file = None
         self.result_dict = {'sert': [], 'attach': [], 'melt': [], }
@@ -49,6 +330,7 @@ class Importer:
         self.errors_list = []  # (level, text,)
         self.ws_data_dict = {'sert': None, 'attach': None, 'melt': None,}
         self.ws_names_dict = {'sert': 'SERT', 'attach': 'ATTACH', 'melt': 'MELT',}
+        self.stats = ImportStats()
         self.ws_list = ['sert', 'attach', 'melt',]
 
         self.sert_names_conv = {
@@ -77,7 +359,7 @@ class Importer:
             'is_atom',
             'atom_contract',
         ]
-        self.sert_nt = namedtuple('sert_row', self.sert_row_names)
+        self.sert_nt = namedtuple('sert_row', self.sert_row_names + ['row_number'])
         self.sert_col_names = {}
 
         self.attach_names_conv = {
@@ -131,7 +413,7 @@ class Importer:
             'is_by_gost_material_number',
             'item_units',
         ]
-        self.attach_nt = namedtuple('attach_row', self.attach_row_names)
+        self.attach_nt = namedtuple('attach_row', self.attach_row_names + ['row_number'])
         self.attach_col_names = {}
 
         self.melt_names_conv = {
@@ -194,15 +476,22 @@ class Importer:
             'hardness',
             'mkk',
         ]
-        self.melt_nt = namedtuple('melt_row', self.melt_row_names)
+        self.melt_nt = namedtuple('melt_row', self.melt_row_names + ['row_number'])
         self.melt_col_names = {}
 
     def set_input_file(self, input_file):
+        self.open_input_file(input_file)
+        self.fill_result_lists()
+        self.close_file_object()
+
+    def open_input_file(self, input_file):
+        # книга открыта, листы и колонки проверены; строки читает iter_ws_rows
         self.input_file = input_file
 
-        self.get_xlsx_object()
-        self.get_sheets_objects()
-        self.fill_result_lists()
+        with self.stats.measure('open_input_file'):
+            self.get_file_object()
+            self.get_sheets_objects()
+            self.set_columns_indexes()
 
     def get_result(self):
         return self.result_dict
@@ -213,16 +502,19 @@ class Importer:
     def get_fatal_error(self):
         return self.fatal_error
 
-    def get_xlsx_object(self):
+    def get_file_object(self):
         if self.input_file.name.endswith('.xlsx'):
-            self.wb = load_workbook(self.input_file)
+            # read_only: листы читаются потоком, без загрузки всей книги в память
+            file_path = get_file_path(self.input_file)
+            self.wb = load_workbook(file_path or self.input_file, read_only=True)
             error_text = f'Файл "{self.input_file.name}" успешно воспринят.'
             error = (messages.SUCCESS, error_text)
             self.errors_list.append(error)
         else:
             self.fatal_error = True
             file_name_list = self.input_file.name.split('.')
-            error_text = (f'Требуется ".xlsx"! Прискорбно, но загруженный файл имеет формат '
+            error_text = (f'Требуется ".xlsx", ".csv", ".zip" с CSV-файлами листов или ".ndjson"! '
+                          f'Прискорбно, но загруженный файл имеет формат '
                           f'".{file_name_list[len(file_name_list) - 1]}": ¯\\_(ツ)_/¯ Я не знаю что с ним делать...')
             error = (messages.ERROR, error_text)
             self.errors_list.append(error)
@@ -231,17 +523,39 @@ class Importer:
         for name in self.ws_list:
             try:
                 ws_name = self.ws_names_dict[name]
-                self.ws_data_dict[name] = self.wb[ws_name]
-                error_text = f'Лист "{name}" xlsx-файла успешно прочитан.'
+                self.ws_data_dict[name] = self.get_ws_object(ws_name)
+                error_text = f'Лист "{name}" {self.file_kind}-файла успешно прочитан.'
                 error = (messages.SUCCESS, error_text)
                 self.errors_list.append(error)
             except KeyError:
                 self.fatal_error = True
-                error_text = (f'xlsx-файл не содержит лист "{name}". '
+                error_text = (f'{self.file_kind}-файл не содержит лист "{name}". '
                               f'дальнейшая обработка файла не имеет смысла.')
                 error = (messages.ERROR, error_text)
                 self.errors_list.append(error)
 
+    def close_file_object(self):
+        # книга в режиме read_only держит открытым исходный файл
+        if self.wb.read_only:
+            self.wb.close()
+
+    def get_ws_object(self, ws_name):
+        # KeyError, если листа нет
+        return self.wb[ws_name]
+
+    def get_ws_head_row(self, ws):
+        # размеры листа из файла бывают недостоверны - читай до последней строки
+        ws.reset_dimensions()
+        return next(ws.iter_rows(max_row=1, values_only=True), ())
+
+    def iter_ws_values(self, ws):
+        ws.reset_dimensions()
+        return ws.iter_rows(min_row=2, values_only=True)
+
+    def iter_ws_numbered_values(self, ws):
+        # (номер строки файла, значения); первая строка - заголовки
+        return enumerate(self.iter_ws_values(ws), 2)
+
     def empty_checker(self, nt):
         is_empty = False
         li = []
@@ -263,7 +577,7 @@ class Importer:
         # print('str_to_bolean_converter', res_value)
         return res_value
 
-    def convert_ws_to_list(self, ws_name):
+    def get_meta_ws(self, ws_name):
         WS_NT = namedtuple('WS_NT', [
             'data_dict_name',
             'names_conv',
@@ -294,40 +608,283 @@ class Importer:
                 nt='melt_nt',
             ),
         }
-        meta_ws = WS_CHOISE[ws_name]
+        return WS_CHOISE[ws_name]
+
+    def set_ws_columns(self, ws_name):
+        # обработай первую строку: сопоставь колонкам их индексы
+        meta_ws = self.get_meta_ws(ws_name)
+        names_conv = self.__getattribute__(meta_ws.names_conv)
+        col_names = self.__getattribute__(meta_ws.col_names)
+        row_names = self.__getattribute__(meta_ws.row_names)
+
+        ws = self.ws_data_dict[meta_ws.data_dict_name]
+        head_row = self.get_ws_head_row(ws)
+        for index, value in enumerate(head_row):
+            name = names_conv.get(str(value))
+            if name is not None:
+                col_names[name] = index
+        missing_names = [name for name in row_names if name not in col_names]
+        if missing_names:
+            self.fatal_error = True
+            inv_names_conv = {v: k for k, v in names_conv.items()}
+            missing_str = ', '.join([f'"{inv_names_conv[name]}"' for name in missing_names])
+            error_text = (f'Лист "{ws_name}" {self.file_kind}-файла не содержит колонки: {missing_str}. '
+                          f'дальнейшая обработка файла не имеет смысла.')
+            error = (messages.ERROR, error_text)
+            self.errors_list.append(error)
+
+    def iter_ws_rows(self, ws_name):
+        # прочие строки листа за один проход, по одной; каждый вызов читает лист заново
+        meta_ws = self.get_meta_ws(ws_name)
         boolean_fields_names = ['is_print', 'is_drag_met', 'is_atom', 'is_by_gost_material_number',]
+        col_names = self.__getattribute__(meta_ws.col_names)
+        row_names = self.__getattribute__(meta_ws.row_names)
+        row_nt = self.__getattribute__(meta_ws.nt)
+        cols = [(col_names[name], name in boolean_fields_names) for name in row_names]
 
         ws = self.ws_data_dict[meta_ws.data_dict_name]
-        # обработай первую строку
-        head_row = ws.iter_rows(min_row=1, max_row=1)
-        for row in head_row:
-            for cell in row:
-                name = self.__getattribute__(meta_ws.names_conv)[str(cell.value)]
-                self.__getattribute__(meta_ws.col_names)[name] = cell.column_letter
-        # обработай прочие строки
-        for row_num in range(2, len(tuple(ws.rows)) + 1):
-            row_content = []
-            row = ws.iter_rows(min_row=row_num, max_row=row_num)
-            for a in row:
-                for aa in a:
-                    row_content.append(aa)
-            di = {}
-            for row_name_num in range(len(self.__getattribute__(meta_ws.row_names))):
-                cell_name = self.__getattribute__(meta_ws.row_names)[row_name_num]
-                val = ws[f'{self.__getattribute__(meta_ws.col_names)[cell_name]}{row_num}'].value
-                if cell_name not in boolean_fields_names:
-                    di[cell_name] = val
-                else:
-                    di[cell_name] = self.str_to_bolean_converter(val)
-            nt = self.__getattribute__(meta_ws.nt)(**di)
-            is_empty = self.empty_checker(nt)
+        for row_number, row in self.iter_ws_numbered_values(ws):
+            row_len = len(row)
+            values = []
+            for index, is_boolean in cols:
+                val = row[index] if index < row_len else None
+                if is_boolean:
+                    val = self.str_to_bolean_converter(val)
+                values.append(val)
+            is_empty = self.empty_checker(values)
             if not is_empty:
-                self.result_dict[meta_ws.data_dict_name].append(nt)
+                # row_number - номер строки в файле, по нему ошибки строки находятся в отчете загрузки
+                values.append(row_number)
+                yield row_nt._make(values)
+
+    def set_columns_indexes(self):
+        if not self.fatal_error:
+            for ws_name in self.ws_list:
+                self.set_ws_columns(ws_name)
 
     def fill_result_lists(self):
         if not self.fatal_error:
             for ws_name in self.ws_list:
-                self.convert_ws_to_list(ws_name)
+                with self.stats.measure(f'iter_ws_rows:{ws_name}') as stage:
+                    self.result_dict[ws_name] += self.iter_ws_rows(ws_name)
+                    stage['rows'] = len(self.result_dict[ws_name])
+
+    def set_cached_errors(self, errors_list, fatal_error):
+        # сообщения и итог разбора того же файла из cache (ImportManager.parse_cached)
+        self.errors_list = list(errors_list)
+        self.fatal_error = fatal_error
+
+    def set_sheets_errors(self, sheets_errors):
+        # сообщения разбора листов по отдельности (parse_sheet) - в порядке последовательного разбора:
+        # файл, наличие каждого листа, колонки листов (только если все листы на месте)
+        self.errors_list.append(sheets_errors[0][0])
+        for errors in sheets_errors:
+            self.errors_list.append(errors[1])
+        if any(errors[1][0] == messages.ERROR for errors in sheets_errors):
+            self.fatal_error = True
+            return
+        for errors in sheets_errors:
+            for error in errors[2:]:
+                self.errors_list.append(error)
+                if error[0] == messages.ERROR:
+                    self.fatal_error = True
+
+
+class CsvImporter(Importer):
+    # zip-архив с CSV-файлами листов SERT.csv, ATTACH.csv, MELT.csv (кодировка utf-8);
+    # первая строка - те же названия колонок, что в xlsx, пустое значение - пустая ячейка
+    file_kind = 'zip'
+
+    def __init__(self):
+        super().__init__()
+        self.zip_file = None
+        self.csv_names_dict = {}  # {'SERT': имя CSV-файла в архиве}
+
+    def get_file_object(self):
+        if not self.input_file.name.endswith('.zip'):
+            super().get_file_object()
+            return
+        try:
+            self.zip_file = zipfile.ZipFile(get_file_path(self.input_file) or self.input_file)
+        except zipfile.BadZipFile:
+            self.fatal_error = True
+            error_text = f'Файл "{self.input_file.name}" поврежден или не является zip-архивом.'
+            error = (messages.ERROR, error_text)
+            self.errors_list.append(error)
+            return
+        for name in self.zip_file.namelist():
+            base_name = name.rsplit('/', 1)[-1]
+            if base_name.lower().endswith('.csv'):
+                self.csv_names_dict[base_name[:-4].upper()] = name
+        error_text = f'Файл "{self.input_file.name}" успешно воспринят.'
+        error = (messages.SUCCESS, error_text)
+        self.errors_list.append(error)
+
+    def close_file_object(self):
+        if self.zip_file is not None:
+            self.zip_file.close()
+
+    def get_ws_object(self, ws_name):
+        return self.csv_names_dict[ws_name]
+
+    def get_ws_head_row(self, ws):
+        rows = self.iter_csv_rows(ws)
+        head_row = next(rows, ())
+        rows.close()
+        return head_row
+
+    def iter_ws_values(self, ws):
+        rows = self.iter_csv_rows(ws)
+        next(rows, None)
+        return rows
+
+    def iter_csv_rows(self, ws):
+        with self.zip_file.open(ws) as raw_file:
+            text_file = io.TextIOWrapper(raw_file, encoding='utf-8-sig', newline='')
+            yield from self.iter_text_rows(text_file)
+
+    @staticmethod
+    def iter_text_rows(text_file):
+        # первая строка - заголовки как есть, в прочих пустое значение - None
+        head_line = text_file.readline()
+        delimiter = max(CSV_DELIMITERS, key=head_line.count)
+        yield next(csv.reader([head_line], delimiter=delimiter), [])
+        for row in csv.reader(text_file, delimiter=delimiter):
+            yield [value or None for value in row]
+
+
+class CsvFileImporter(CsvImporter):
+    # строки всех листов в одном CSV-файле: лист строки - в колонке "лист", колонки файла - все колонки листов;
+    # колонки чужого листа в строке остаются пустыми
+    file_kind = 'csv'
+
+    def __init__(self):
+        super().__init__()
+        self.head_row = []
+        self.sheet_index = None
+
+    def get_file_object(self):
+        if not self.input_file.name.endswith('.csv'):
+            Importer.get_file_object(self)
+            return
+        rows = self.iter_file_rows()
+        row_number, self.head_row = next(rows, (1, []))
+        if CSV_SHEET_COLUMN not in self.head_row:
+            rows.close()
+            self.fatal_error = True
+            error_text = (f'Файл "{self.input_file.name}" не содержит колонку "{CSV_SHEET_COLUMN}" '
+                          f'с именем листа строки. дальнейшая обработка файла не имеет смысла.')
+            error = (messages.ERROR, error_text)
+            self.errors_list.append(error)
+            return
+        self.sheet_index = self.head_row.index(CSV_SHEET_COLUMN)
+        for row_number, row in rows:
+            ws_name = self.get_row_sheet(row)
+            self.csv_names_dict[ws_name] = ws_name
+        error_text = f'Файл "{self.input_file.name}" успешно воспринят.'
+        error = (messages.SUCCESS, error_text)
+        self.errors_list.append(error)
+
+    def close_file_object(self):
+        pass
+
+    def get_ws_head_row(self, ws):
+        return self.head_row
+
+    def iter_ws_values(self, ws):
+        for row_number, values in self.iter_ws_numbered_values(ws):
+            yield values
+
+    def iter_ws_numbered_values(self, ws):
+        # номер строки - номер строки CSV-файла, строки листа идут вперемешку со строками других листов
+        rows = self.iter_file_rows()
+        next(rows, None)
+        for row_number, row in rows:
+            if self.get_row_sheet(row) == ws:
+                yield row_number, row
+
+    def get_row_sheet(self, row):
+        return row[self.sheet_index] if self.sheet_index < len(row) else None
+
+    def iter_file_rows(self):
+        self.input_file.seek(0)
+        text_file = io.TextIOWrapper(self.input_file.file, encoding='utf-8-sig', newline='')
+        try:
+            yield from enumerate(self.iter_text_rows(text_file), 1)
+        finally:
+            # исходный файл остается открытым для следующих проходов
+            text_file.detach()
+
+
+class NdjsonImporter(Importer):
+    # строки всех листов в одном файле, по объекту JSON на строку: {"лист": "SERT", "номер_СПГ": ..., ...};
+    # колонки листа - ключи первого объекта этого листа
+    file_kind = 'ndjson'
+
+    def __init__(self):
+        super().__init__()
+        self.heads_dict = {}  # {'SERT': ключи первого объекта листа}
+
+    def get_file_object(self):
+        if not self.input_file.name.endswith(('.ndjson', '.jsonl')):
+            super().get_file_object()
+            return
+        # файл проверяется целиком до загрузки: ошибка в середине не должна оборвать уже начатую запись
+        for line_number, line in enumerate(self.iter_lines(), 1):
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                obj = None
+            if not isinstance(obj, dict):
+                self.fatal_error = True
+                self.heads_dict = {}
+                error_text = (f'Строка {line_number} файла "{self.input_file.name}" не является объектом JSON. '
+                              f'дальнейшая обработка файла не имеет смысла.')
+                error = (messages.ERROR, error_text)
+                self.errors_list.append(error)
+                return
+            ws_name = obj.get(NDJSON_SHEET_KEY)
+            if ws_name not in self.heads_dict:
+                self.heads_dict[ws_name] = [key for key in obj if key != NDJSON_SHEET_KEY]
+        error_text = f'Файл "{self.input_file.name}" успешно воспринят.'
+        error = (messages.SUCCESS, error_text)
+        self.errors_list.append(error)
+
+    def get_ws_object(self, ws_name):
+        if ws_name not in self.heads_dict:
+            raise KeyError(ws_name)
+        return ws_name
+
+    def get_ws_head_row(self, ws):
+        return self.heads_dict[ws]
+
+    def iter_ws_values(self, ws):
+        for line_number, values in self.iter_ws_numbered_values(ws):
+            yield values
+
+    def iter_ws_numbered_values(self, ws):
+        # номер строки - номер непустой строки файла, как в сообщениях get_file_object
+        head = self.heads_dict[ws]
+        # json.loads только для строк, в которых есть имя листа
+        marker = f'"{ws}"'
+        for line_number, line in enumerate(self.iter_lines(), 1):
+            if marker not in line:
+                continue
+            obj = json.loads(line)
+            if obj.get(NDJSON_SHEET_KEY) == ws:
+                yield line_number, [obj.get(key) for key in head]
+
+    def iter_lines(self):
+        self.input_file.seek(0)
+        text_file = io.TextIOWrapper(self.input_file.file, encoding='utf-8-sig')
+        try:
+            for line in text_file:
+                line = line.strip()
+                if line:
+                    yield line
+        finally:
+            # исходный файл остается открытым для следующих проходов
+            text_file.detach()
 
 
 class Converter:
@@ -337,6 +894,7 @@ class Converter:
         self.result_lists_names = ['kernel', 'sert', 'attachment', 'melt',]
         self.data_pair = {'kernel': 'sert', 'sert': 'sert', 'attachment': 'attach', 'melt': 'melt',}
         self.processing_result = {'kernel': [], 'sert': [], 'attachment': [], 'melt': [],}
+        self.stats = ImportStats()
         # self.second_processing_result = {'kernel': [], 'sert': [], 'attachment': [], 'melt': [],}
         # self.third_processing_result = {'kernel': [], 'sert': [], 'attachment': [], 'melt': [],}
 
@@ -357,7 +915,7 @@ class Converter:
             'atom_contract',
         ]
         self.kernel_load_fields = self.kernel_fields_names
-        self.kernel_nt = namedtuple('kernel_nt', self.kernel_fields_names)
+        self.kernel_nt = namedtuple('kernel_nt', self.kernel_fields_names + ['row_hash', 'row_number'])
         self.sert_pattern = {
             'id': None,
             'is_print': True,
@@ -392,7 +950,7 @@ class Converter:
             'galvan_date',
             'is_drag_met',
         ]
-        self.sert_nt = namedtuple('sert_nt', self.sert_fields_names)
+        self.sert_nt = namedtuple('sert_nt', self.sert_fields_names + ['row_hash', 'row_number'])
         self.attachment_pattern = {
             'number_spg': None,
             'number_unique': None,
@@ -483,7 +1041,7 @@ class Converter:
             'galvan_material',
             'galvan_units',
         ]
-        self.attachment_nt = namedtuple('attachment_nt', self.attachment_fields_names)
+        self.attachment_nt = namedtuple('attachment_nt', self.attachment_fields_names + ['row_hash', 'row_number'])
         self.melt_pattern = {
             'melt_id': None,
             'melt_number': None,
@@ -578,7 +1136,11 @@ class Converter:
             'hardness',
             'mkk',
         ]
-        self.melt_nt = namedtuple('melt_nt', self.melt_fields_names)
+        self.melt_nt = namedtuple('melt_nt', self.melt_fields_names + ['row_hash', 'row_number'])
+        # преобразование значений колонок по типу поля
+        self.bool_fields = ['is_atom', 'is_print', 'is_drag_met', 'is_by_gost_material_number',]
+        self.date_fields = ['date', 'galvan_date',]
+        self.melt_id_fields = ['melt_number', 'material_id', 'melt_year', 'melt_passport',]
 
 
     def set_input_data(self, input_dict):
@@ -589,6 +1151,12 @@ class Converter:
     def get_result(self):
         return self.processing_result
 
+    def set_converted_rows(self, converted):
+        # строки из parse_sheet: кортежи снова становятся namedtuple
+        for name, rows in converted.items():
+            nt = self.__getattribute__(f'{name}_nt')
+            self.processing_result[name] = [nt._make(row) for row in rows]
+
     # def get_errors(self):
     #     return self.errors_list
 
@@ -597,6 +1165,13 @@ class Converter:
             self.convert_to_model_row(name)
 
     def convert_to_model_row(self, name):
+        data_list = self.input_dict[self.data_pair[name]]
+        with self.stats.measure(f'convert_to_model_row:{name}') as stage:
+            self.processing_result[name] += self.iter_model_rows(name, data_list)
+            stage['rows'] = len(self.processing_result[name])
+
+    def iter_model_rows(self, name, data_rows):
+        # строки листа -> строки model по одной; план преобразования строится по первой строке
         NT = namedtuple('NT', [
             'pattern', 'load_fields', 'nt',
         ])
@@ -622,49 +1197,101 @@ class Converter:
                 nt='melt_nt',
             ),
         }
-        data_list_name = self.data_pair[name]
-        data_list = self.input_dict[data_list_name]
-        for data_row in data_list:
-            di = copy.deepcopy(self.__getattribute__(PARAM[name].pattern))
-            # print('старт', di)
-            fields_names = self.__getattribute__(PARAM[name].load_fields)
-            for field_name in fields_names:
-                if ((di[field_name] != data_row.__getattribute__(field_name))
-                    or (not data_row.__getattribute__(field_name))):
-                    val = data_row.__getattribute__(field_name)
-                    val = self.field_str_data_cleaner(val)
-                    val = self.field_data_type_convert(field_name, val)
-                    di[field_name] = val
-            row = self.__getattribute__(PARAM[name].nt).__call__(**di)
-            self.processing_result[name].append(row)
-
-    def field_str_data_cleaner(self, val):
-        if isinstance(val, type('str')):
-            val = val.strip()
-        return val
-
-    def field_data_type_convert(self, field_name, val):
-        bool_list = ['is_atom', 'is_print', 'is_drag_met', 'is_by_gost_material_number',]
-        if isinstance(val, type('str')):
-            if field_name in bool_list:
-                if val.lower() in ['да', 'нет', ]:
+        pattern = self.__getattribute__(PARAM[name].pattern)
+        load_fields = self.__getattribute__(PARAM[name].load_fields)
+        nt = self.__getattribute__(PARAM[name].nt)
+        get_row_hash = self.get_row_hash
+        columns = None
+        for data_row in data_rows:
+            if columns is None:
+                columns, hash_positions = self.get_conversion_plan(pattern, load_fields, nt, data_row._fields)
+            values = [column(data_row) for column in columns]
+            values.append(get_row_hash([values[position] for position in hash_positions]))
+            values.append(data_row.row_number)
+            yield nt._make(values)
+
+    def get_conversion_plan(self, pattern, load_fields, nt, data_fields):
+        # строится один раз на лист: для каждого поля namedtuple - функция, которая берет значение из строки листа;
+        # поля не из load_fields всегда получают значение из pattern
+        columns = []
+        hash_positions = []
+        fields_names = [field_name for field_name in nt._fields if field_name not in ['row_hash', 'row_number']]
+        for position, field_name in enumerate(fields_names):
+            if field_name in load_fields:
+                index = data_fields.index(field_name)
+                converter = self.get_field_converter(field_name, pattern[field_name])
+                columns.append(lambda data_row, index=index, converter=converter: converter(data_row[index]))
+            else:
+                columns.append(lambda data_row, value=pattern[field_name]: value)
+        for field_name in load_fields:
+            hash_positions.append(fields_names.index(field_name))
+        return columns, hash_positions
+
+    def get_field_converter(self, field_name, pattern_value):
+        if field_name in self.bool_fields:
+            def converter(val):
+                if isinstance(val, str):
+                    val = val.strip()
                     if val.lower() == 'да':
                         val = True
                     elif val.lower() == 'нет':
                         val = False
-        date_list = ['date', 'galvan_date',]
-        if isinstance(val, type(datetime(2024, 1, 1, 0, 0))):
-            if field_name in date_list:
-                val = val.date()
-        melt_id_list = ['melt_number', 'material_id', 'melt_year', 'melt_passport',]
-        if field_name in melt_id_list:
-            if not isinstance(val, type(None)):
-                val = str(val)
-        return val
+                return val
+        elif field_name in self.date_fields:
+            def converter(val):
+                if isinstance(val, str):
+                    val = val.strip()
+                    for date_format in TEXT_DATE_FORMATS:
+                        try:
+                            return datetime.strptime(val, date_format).date()
+                        except ValueError:
+                            pass
+                elif isinstance(val, datetime):
+                    val = val.date()
+                return val
+        elif field_name in self.melt_id_fields:
+            def converter(val):
+                if isinstance(val, str):
+                    val = val.strip()
+                if val is not None:
+                    val = str(val)
+                return val
+        else:
+            def converter(val):
+                if isinstance(val, str):
+                    val = val.strip()
+                return val
+
+        if not pattern_value:
+            return converter
+
+        # непустое значение, равное значению из pattern, остается значением из pattern (например 1.0 -> 1)
+        def pattern_converter(val):
+            if val and val == pattern_value:
+                return pattern_value
+            return converter(val)
+        return pattern_converter
+
+    @staticmethod
+    def get_row_hash(values):
+        # отпечаток загружаемых полей строки: по нему Loader пропускает строки, которые уже загружены без изменений;
+        # значения берутся текстом - число из ячейки xlsx и то же число в CSV дают один отпечаток
+        values = json.dumps([None if value is None else str(value) for value in values], ensure_ascii=False)
+        return hashlib.sha256(values.encode('utf-8')).hexdigest()
 
 
 class Loader:
-    def __init__(self):
+    def __init__(self, is_bulk=False, is_dry_run=False, is_stale_deleted=False, progress_callback=None):
+        # is_bulk: листы проверяются целиком, а запись идет через bulk_create в одной транзакции
+        self.is_bulk = is_bulk
+        # is_dry_run: только проверка по key_index, номера сертификатов не выдаются, запись не идет
+        self.is_dry_run = is_dry_run
+        # is_stale_deleted: вложения, строк которых больше нет в файле, удаляются (delete_stale_attachments)
+        self.is_stale_deleted = is_stale_deleted
+        # progress_callback(validated=..., saved=...)
+        self.progress_callback = progress_callback
+        self.validated_count = 0
+        self.saved_count = 0
         self.input_data = None
         self.fatal_error = False
         self.sert_error = False
@@ -674,6 +1301,31 @@ class Loader:
         self.attachment_data = []
         self.melt_data = []
         self.saved_serts_list = []
+        self.key_index = None
+        # номера новых сертификатов, зарезервированные до транзакции записи (reserve_numbers)
+        self.number_pool = None
+        # итог по каждой model: строки листа делятся на новые, измененные, без изменений, конфликты и ошибки
+        self.summary_nt = namedtuple('summary', [
+            'sheet', 'model', 'rows', 'inserts', 'updates', 'unchanged', 'conflicts', 'errors',
+        ])
+        self.summary_list = []
+        # параметры каждой model в порядке загрузки: Melt и Kernel раньше зависящих от них Sert и Attachment
+        self.stage_nt = namedtuple('stage', [
+            'data_name', 'load', 'sheet_name', 'model_name', 'saved_text', 'updated_text',
+        ])
+        self.stages_dict = {
+            Melt: self.stage_nt('melt', 'load_melt', 'MELT', 'Отливка(Melt):', 'сохранена(ы)', 'обновлена(ы)'),
+            Kernel: self.stage_nt('kernel', 'load_kernel', 'SERT', 'Продукт(Kernel):', 'сохранен(ы)', 'обновлен(ы)'),
+            Sert: self.stage_nt('sert', 'load_sert', 'SERT', 'Сертификат(Sert):', 'сохранен(ы)', 'обновлен(ы)'),
+            Attachment: self.stage_nt('attachment', 'load_attach', 'ATTACH', 'Вложения(Attachment):',
+                                      'сохранен(ы)', 'обновлен(ы)'),
+        }
+        # итог текущей model: при потоковой загрузке load_* вызывается на каждую часть строк листа
+        self.stage_result = {}
+        self.input_stream = None
+        self.stats = ImportStats()
+        # строки файла с ошибками и счетчики сохраненных записей; в errors_list по каждой model только счетчики
+        self.report = ImportReport()
 
     def set_input_data(self, input_data):
         self.input_data = input_data
@@ -681,9 +1333,21 @@ class Loader:
         self.load_pre_data()
         self.do_load()
 
+    def set_input_stream(self, input_stream):
+        # {data_name: функция без аргументов, которая возвращает итератор строк model}
+        self.input_stream = input_stream
+
+        self.do_stream_load()
+
     def get_errors(self):
         return self.errors_list
 
+    def get_summary(self):
+        return self.summary_list
+
+    def get_report(self):
+        return self.report
+
     def load_pre_data(self):
         try:
             self.kernel_data = self.input_data['kernel']
@@ -700,122 +1364,412 @@ class Loader:
     def do_load(self):
         if not self.fatal_error:
             # print('fatal_error = ', self.fatal_error)
-            self.load_melt()
-            self.load_kernel()
-            self.load_sert()
-            if not self.sert_error:
-                self.load_attach()
-
-    def convert_form_errors(self, form):
-        error_text_list = []
-        error_json = form.errors.as_json()
-        error_dict = json.loads(error_json)
-        for k, v in error_dict.items():
-            for i in v:
-                t = i['message']
-                text = f'{t} [{k}] '
-                error_text_list.append(text)
-        return error_text_list
-
-    def load_melt(self):
-        success_list = []
-        model_name = 'Отливка(Melt):'
-        for melt in self.melt_data:
-            form = MeltForm(melt._asdict())
-            if form.is_valid():
-                form.save()
-                ft = form.cleaned_data['melt_id']
-                melt_name = f'{ft}'
-                success_list.append(melt_name)
+            with self.stats.measure('ImportKeyIndex'):
+                self.key_index = ImportKeyIndex()
+            if self.is_dry_run or not self.is_bulk:
+                self.load_all()
             else:
-                error_text_list = self.convert_form_errors(form)
-                for m in error_text_list:
-                    melt_name = f'{melt.melt_number}-{melt.material_id}-{melt.melt_year}-{melt.melt_passport}'
-                    error_text = f'{model_name} {m} || {melt_name}'
-                    error = (messages.WARNING, error_text)
+                try:
+                    self.reserve_numbers(self.sert_data)
+                    with transaction.atomic():
+                        self.load_all()
+                except DatabaseError as e:
+                    # транзакция откачена - сообщения об успешном сохранении недействительны
+                    self.errors_list = [error for error in self.errors_list if error[0] != messages.SUCCESS]
+                    self.report.discard_saved()
+                    self.saved_serts_list = []
+                    self.saved_count = 0
+                    self.report_progress()
+                    error_text = (f'Loader: ошибка записи в базу данных, загрузка отменена целиком, '
+                                  f'ни одна запись не сохранена: {e}')
+                    error = (messages.ERROR, error_text)
                     self.errors_list.append(error)
-        if success_list:
-            et = ', '.join(success_list)
-            error_text = f'{model_name} {len(success_list)} записей || {et} сохранена(ы).'
-            error = (messages.SUCCESS, error_text)
+
+    def do_stream_load(self):
+        # строки приходят частями по STREAM_CHUNK_SIZE, в памяти только текущая часть;
+        # в режиме is_bulk каждая часть - своя транзакция, поэтому при ошибке записи предыдущие части остаются в базе
+        with self.stats.measure('ImportKeyIndex'):
+            self.key_index = ImportKeyIndex()
+        try:
+            for model, stage in self.stages_dict.items():
+                if self.is_stage_skipped(model):
+                    continue
+                # время этапа включает чтение и преобразование строк листа
+                with self.stats.measure(stage.load) as stage_stat:
+                    self.start_stage()
+                    rows = self.input_stream[stage.data_name]()
+                    chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+                    while chunk:
+                        self.__setattr__(f'{stage.data_name}_data', chunk)
+                        if model is Sert:
+                            self.reserve_numbers(chunk)
+                        self.load_chunk(stage.load)
+                        chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+                    self.__setattr__(f'{stage.data_name}_data', [])
+                    self.finish_stage(model)
+                    stage_stat['rows'] = self.stage_result['rows_count']
+        except DatabaseError as e:
+            error_text = (f'Loader: ошибка записи в базу данных, загрузка остановлена. Части файла, записанные '
+                          f'до ошибки, сохранены ({self.saved_count} записей), остальные строки не загружены: {e}')
+            error = (messages.ERROR, error_text)
             self.errors_list.append(error)
 
-    def load_kernel(self):
-        success_list = []
-        model_name = 'Продукт(Kernel):'
-        for kernel in self.kernel_data:
-            form = KernelForm(kernel._asdict())
-            if form.is_valid():
-                form.save()
-                ft = form.cleaned_data['number_spg']
-                kernel_name = f'{ft}'
-                success_list.append(kernel_name)
+    def load_chunk(self, load):
+        if self.is_dry_run or not self.is_bulk:
+            self.__getattribute__(load)()
+        else:
+            with transaction.atomic():
+                self.__getattribute__(load)()
+
+    def load_all(self):
+        for model, stage in self.stages_dict.items():
+            if self.is_stage_skipped(model):
+                continue
+            with self.stats.measure(stage.load) as stage_stat:
+                self.start_stage()
+                self.__getattribute__(stage.load)()
+                self.finish_stage(model)
+                stage_stat['rows'] = self.stage_result['rows_count']
+
+    def is_stage_skipped(self, model):
+        # вложения без сертификатов не загружаются
+        if model is not Attachment or not self.sert_error:
+            return False
+        if self.is_dry_run:
+            error_text = 'Вложения(Attachment): не проверялись - при загрузке их не будет из-за ошибок в листе SERT.'
+            error = (messages.INFO, error_text)
+            self.errors_list.append(error)
+        return True
+
+    def start_stage(self):
+        self.stage_result = {
+            'rows_count': 0,
+            'inserts_count': 0,
+            'updates_count': 0,
+            'unchanged_count': 0,
+            'conflicts_count': 0,
+            'rejected_count': 0,
+        }
+
+    def finish_stage(self, model):
+        if model is Attachment and self.is_stale_deleted:
+            # все строки листа пройдены - известно, каких вложений сертификатов файла в нем больше нет
+            self.load_chunk('delete_stale_attachments')
+        stage = self.stages_dict[model]
+        result = self.stage_result
+        self.add_summary(model, stage.sheet_name, stage.model_name, result['rows_count'],
+                         result['inserts_count'], result['updates_count'],
+                         result['unchanged_count'], result['conflicts_count'])
+        self.add_success_messages(stage.model_name, result['inserts_count'], result['updates_count'],
+                                  result['unchanged_count'], stage.saved_text, stage.updated_text)
+        self.add_error_messages(stage.sheet_name, stage.model_name, result['rejected_count'])
+
+    def is_form_valid(self, form, key_name=None):
+        # ключ принятой записи сразу попадает в key_index - следующие строки видят её как существующую,
+        # даже если в режиме is_bulk она еще не записана в базу
+        is_valid = form.is_valid()
+        if is_valid and key_name:
+            self.key_index.add(form.cleaned_data[key_name], form._meta.model)
+        if is_valid:
+            self.validated_count += 1
+            self.report_progress()
+        return is_valid
+
+    def save_form(self, form, bulk_list, update_list):
+        # новая запись - в bulk_list, существующая (строка файла изменилась) - в update_list
+        if self.is_dry_run:
+            instance = form.instance
+        elif not self.is_bulk:
+            instance = form.save()
+            self.saved_count += 1
+            self.report_progress()
+        else:
+            instance = form.save(commit=False)
+            if instance._state.adding:
+                bulk_list.append(instance)
             else:
-                error_text_list = self.convert_form_errors(form)
-                for m in error_text_list:
-                    kernel_name = f'{kernel.number_spg}, {kernel.designation}, {kernel.denomination}'
-                    error_text = f'{model_name} {m} || {kernel_name}'
-                    error = (messages.WARNING, error_text)
-                    self.errors_list.append(error)
-        if success_list:
-            et = ', '.join(success_list)
-            error_text = f'{model_name} {len(success_list)} записей || {et} сохранен(ы).'
+                update_list.append(instance)
+        return instance
+
+    def bulk_save(self, model, bulk_list, update_list, form_class):
+        if self.is_bulk and not self.is_dry_run:
+            if bulk_list:
+                model.objects.bulk_create(bulk_list, batch_size=BULK_BATCH_SIZE)
+            if update_list:
+                pk_name = model._meta.pk.name
+                update_fields = [name for name in form_class._meta.fields if name != pk_name] + ['row_hash']
+                model.objects.bulk_update(update_list, update_fields, batch_size=BULK_BATCH_SIZE)
+            if bulk_list or update_list:
+                self.saved_count += len(bulk_list) + len(update_list)
+                self.report_progress()
+
+    def get_rows_states(self, model, rows, get_row_key):
+        # состояние строк по row_hash ('new', 'changed', 'unchanged') и записи для изменения - одним запросом
+        rows_states = []
+        changed_keys = []
+        for row in rows:
+            row_state, key = self.key_index.take_row_state(get_row_key(row), row.row_hash, model)
+            rows_states.append((row_state, key))
+            if row_state == 'changed':
+                changed_keys.append(key)
+        instances = {}
+        if changed_keys:
+            instances = model.objects.in_bulk(changed_keys)
+        return rows_states, instances
+
+    @staticmethod
+    def get_melt_key(melt):
+        return f'{melt.melt_number}-{melt.material_id}-{melt.melt_year}-{melt.melt_passport}'
+
+    @staticmethod
+    def get_kernel_key(kernel):
+        return kernel.number_spg
+
+    @staticmethod
+    def get_sert_key(sert):
+        sert_type = sert.sert_type
+        if not sert_type:
+            sert_type = METHODS_LIST['НАСОС']
+        return f'{sert.number_spg}-{sert_type}'
+
+    @staticmethod
+    def get_attach_key(attach):
+        # значения полей ключа; ImportKeyIndex приводит их к виду после AttachmentForm
+        return [getattr(attach, name) for name in ATTACHMENT_KEY_FIELDS]
+
+    @staticmethod
+    def is_conflict(form):
+        # запись с таким ключом уже есть в базе или выше в этом файле
+        for errors in form.errors.as_data().values():
+            for error in errors:
+                if error.code in ['unique', 'exists']:
+                    return True
+        return False
+
+    def add_summary(self, model, sheet_name, model_name, rows_count, inserts_count, updates_count,
+                    unchanged_count, conflicts_count):
+        errors_count = rows_count - inserts_count - updates_count - unchanged_count - conflicts_count
+        summary = self.summary_nt(sheet_name, model.__name__, rows_count, inserts_count, updates_count,
+                                  unchanged_count, conflicts_count, errors_count)
+        self.summary_list.append(summary)
+        if self.is_dry_run:
+            error_text = (f'{model_name} проверка без записи, лист {sheet_name} || строк: {rows_count}, '
+                          f'новых: {inserts_count}, изменений: {updates_count}, без изменений: {unchanged_count}, '
+                          f'конфликтов: {conflicts_count}, ошибок: {errors_count}')
+            error = (messages.INFO, error_text)
+            self.errors_list.append(error)
+
+    def add_success_messages(self, model_name, inserts_count, updates_count, unchanged_count, saved_text, updated_text):
+        # сами записи - в отчете загрузки (report)
+        if self.is_dry_run:
+            return
+        if inserts_count:
+            error_text = f'{model_name} {inserts_count} записей {saved_text}.'
+            error = (messages.SUCCESS, error_text)
+            self.errors_list.append(error)
+        if updates_count:
+            error_text = f'{model_name} {updates_count} записей {updated_text}.'
             error = (messages.SUCCESS, error_text)
             self.errors_list.append(error)
+        if unchanged_count:
+            error_text = f'{model_name} {unchanged_count} записей без изменений с прошлой загрузки - пропущены.'
+            error = (messages.INFO, error_text)
+            self.errors_list.append(error)
+
+    def add_error_messages(self, sheet_name, model_name, rejected_count):
+        if rejected_count:
+            error_text = (f'{model_name} {rejected_count} строк листа {sheet_name} не приняты (ошибки или конфликты) - '
+                          f'строки и поля в отчете загрузки.')
+            error = (messages.WARNING, error_text)
+            self.errors_list.append(error)
+
+    def add_saved_row(self, model, is_updated):
+        stage = self.stages_dict[model]
+        # при is_dry_run ничего не сохраняется - в отчете только строки с ошибками;
+        # сохраненные записи - только счетчиком, иначе отчет рос бы с размером файла
+        if not self.is_dry_run:
+            status = 'обновлена' if is_updated else 'сохранена'
+            self.report.add_count(status, stage.sheet_name, stage.model_name)
+        if is_updated:
+            self.stage_result['updates_count'] += 1
+        else:
+            self.stage_result['inserts_count'] += 1
+
+    def add_error_rows(self, model, row, key, form):
+        stage = self.stages_dict[model]
+        status = 'ошибка'
+        if self.is_conflict(form):
+            status = 'конфликт'
+            self.stage_result['conflicts_count'] += 1
+        self.stage_result['rejected_count'] += 1
+        for field, message in self.get_form_errors(form):
+            self.report.add_row(status, stage.sheet_name, row.row_number, stage.model_name, key, field, message)
+
+    def report_progress(self):
+        if self.progress_callback is not None:
+            self.progress_callback(validated=self.validated_count, saved=self.saved_count)
+
+    @staticmethod
+    def get_form_errors(form):
+        # [(поле, текст ошибки), ...]; ошибки формы целиком - с полем '__all__'
+        form_errors = []
+        for field, errors in form.errors.items():
+            for message in errors:
+                form_errors.append((field, str(message)))
+        return form_errors
+
+    def load_melt(self):
+        result = self.stage_result
+        bulk_list = []
+        update_list = []
+        result['rows_count'] += len(self.melt_data)
+        rows_states, instances = self.get_rows_states(Melt, self.melt_data, self.get_melt_key)
+        for melt, (row_state, key) in zip(self.melt_data, rows_states):
+            if row_state == 'unchanged':
+                result['unchanged_count'] += 1
+                continue
+            data = melt._asdict()
+            instance = instances.get(key)
+            if instance is not None:
+                data['melt_id'] = instance.melt_id
+                data['by_gost_number'] = instance.by_gost_number
+            form = MeltForm(data, instance=instance, key_index=self.key_index)
+            if self.is_form_valid(form, 'melt_id'):
+                form.instance.row_hash = melt.row_hash
+                self.save_form(form, bulk_list, update_list)
+                self.add_saved_row(Melt, instance is not None)
+            else:
+                self.add_error_rows(Melt, melt, self.get_melt_key(melt), form)
+        self.bulk_save(Melt, bulk_list, update_list, MeltForm)
+
+    def load_kernel(self):
+        result = self.stage_result
+        bulk_list = []
+        update_list = []
+        result['rows_count'] += len(self.kernel_data)
+        rows_states, instances = self.get_rows_states(Kernel, self.kernel_data, self.get_kernel_key)
+        for kernel, (row_state, key) in zip(self.kernel_data, rows_states):
+            if row_state == 'unchanged':
+                result['unchanged_count'] += 1
+                continue
+            instance = instances.get(key)
+            form = KernelForm(kernel._asdict(), instance=instance, key_index=self.key_index)
+            if self.is_form_valid(form, 'number_spg'):
+                form.instance.row_hash = kernel.row_hash
+                self.save_form(form, bulk_list, update_list)
+                self.add_saved_row(Kernel, instance is not None)
+            else:
+                kernel_name = f'{kernel.number_spg}, {kernel.designation}, {kernel.denomination}'
+                self.add_error_rows(Kernel, kernel, kernel_name, form)
+        self.bulk_save(Kernel, bulk_list, update_list, KernelForm)
 
     def load_sert(self):
-        success_list = []
-        model_name = 'Сертификат(Sert):'
-        for sert in self.sert_data:
-            form = SertForm(sert._asdict())
+        result = self.stage_result
+        bulk_list = []
+        update_list = []
+        result['rows_count'] += len(self.sert_data)
+        rows_states, instances = self.get_rows_states(Sert, self.sert_data, self.get_sert_key)
+        # номера сертификатов выдаются после проверки всех строк - одним резервом на все новые сертификаты
+        valid_list = []
+        for sert, (row_state, key) in zip(self.sert_data, rows_states):
+            if row_state == 'unchanged':
+                result['unchanged_count'] += 1
+                continue
+            data = sert._asdict()
+            instance = instances.get(key)
+            if instance is not None:
+                # сертификат сохраняет свой идентификатор и номер
+                data['id'] = instance.id
+                data['number_unique'] = instance.number_unique_id
+            form = SertForm(data, instance=instance, key_index=self.key_index, is_number_deferred=True)
             # print(sert._asdict())
-            if form.is_valid():
-                saved_sert = form.save()
-                self.saved_serts_list.append(saved_sert)
-                ft = form.cleaned_data['id']
-                sert_name = f'{ft}'
-                success_list.append(sert_name)
+            if self.is_form_valid(form, 'id'):
+                form.instance.row_hash = sert.row_hash
+                valid_list.append((sert, instance, form))
             else:
                 self.sert_error = True
-                error_text_list = self.convert_form_errors(form)
-                for m in error_text_list:
-                    sert_name = f'{sert.number_spg}-{sert.sert_type}'
-                    error_text = f'{model_name} {m} || {sert_name}'
-                    error = (messages.WARNING, error_text)
-                    self.errors_list.append(error)
-        if success_list:
-            et = ', '.join(success_list)
-            error_text = f'{model_name} {len(success_list)} записей || {et} сохранен(ы).'
-            error = (messages.SUCCESS, error_text)
-            self.errors_list.append(error)
+                self.add_error_rows(Sert, sert, f'{sert.number_spg}-{sert.sert_type}', form)
+        self.set_numbers_unique([form for sert, instance, form in valid_list])
+        for sert, instance, form in valid_list:
+            saved_sert = self.save_form(form, bulk_list, update_list)
+            self.saved_serts_list.append(saved_sert)
+            self.add_saved_row(Sert, instance is not None)
+        self.bulk_save(Sert, bulk_list, update_list, SertForm)
+
+    def reserve_numbers(self, sert_data):
+        # в режиме is_bulk номера новых сертификатов резервируются до транзакции записи: UPDATE счетчика года
+        # фиксируется сразу, и другие загрузки и SertNumberForm не ждут конца этой загрузки;
+        # номера строк, которые не пройдут проверку, пропадают
+        if self.is_dry_run or not self.is_bulk:
+            return
+        count = 0
+        for sert in sert_data:
+            if not self.key_index.is_exist(self.get_sert_key(sert), Sert):
+                count += 1
+        self.number_pool = SertNumberPool(is_deferred=True)
+        if count:
+            self.number_pool.reserve(count)
+
+    def set_numbers_unique(self, forms_list):
+        # при is_dry_run номера не выдаются; в режиме is_bulk SertNumber записываются одним bulk_create
+        if self.is_dry_run:
+            return
+        number_pool = self.number_pool
+        self.number_pool = None
+        forms_list = [form for form in forms_list if form.is_number_needed()]
+        if not forms_list:
+            return
+        if number_pool is None:
+            # без is_bulk каждая запись - своя транзакция, резерв сразу фиксируется
+            number_pool = SertNumberPool(is_deferred=self.is_bulk)
+            number_pool.reserve(len(forms_list))
+        for form in forms_list:
+            # номеров резерва не хватило (номер из файла не найден в SertNumber) - take резервирует еще
+            form.get_number_unique(number_pool)
+        number_pool.save_pending(batch_size=BULK_BATCH_SIZE)
 
     def load_attach(self):
-        success_list = []
-        model_name = 'Вложения(Attachment):'
-        for attach in self.attachment_data:
-            form = AttachmentForm(attach._asdict())
-            if form.is_valid():
-                form.save()
-                if self.saved_serts_list:
-                    for s in self.saved_serts_list:
-                        ft1 = form.cleaned_data['number_spg'].number_spg
-                        ft2 = form.cleaned_data['sert_type']
-                        if s.id == f'{ft1}-{ft2}':
-                            form.cleaned_data['number_unique'] = s.number_unique
-                ft3 = form.cleaned_data['number_spg'].number_spg
-                ft4 = form.cleaned_data['sert_type']
-                attach_name = f'{ft3}-{ft4}'
-                success_list.append(attach_name)
+        result = self.stage_result
+        bulk_list = []
+        update_list = []
+        result['rows_count'] += len(self.attachment_data)
+        saved_serts_dict = {s.id: s for s in self.saved_serts_list}
+        # ключ вложения - сертификат и место строки в дереве (ImportKeyIndex.take_attachment_state):
+        # измененная строка обновляет свою запись
+        rows_states, instances = self.get_rows_states(Attachment, self.attachment_data, self.get_attach_key)
+        for attach, (row_state, key) in zip(self.attachment_data, rows_states):
+            if row_state == 'unchanged':
+                result['unchanged_count'] += 1
+                continue
+            instance = instances.get(key)
+            form = AttachmentForm(attach._asdict(), instance=instance, key_index=self.key_index)
+            if self.is_form_valid(form):
+                form.instance.row_hash = attach.row_hash
+                self.save_form(form, bulk_list, update_list)
+                ft1 = form.cleaned_data['number_spg'].number_spg
+                ft2 = form.cleaned_data['sert_type']
+                # при is_dry_run номер сертификату не выдан
+                if f'{ft1}-{ft2}' in saved_serts_dict and not self.is_dry_run:
+                    form.cleaned_data['number_unique'] = saved_serts_dict[f'{ft1}-{ft2}'].number_unique
+                self.add_saved_row(Attachment, instance is not None)
             else:
-                error_text_list = self.convert_form_errors(form)
-                for m in error_text_list:
-                    attach_name = f'{attach.number_spg}-{attach.sert_type}'
-                    error_text = f'{model_name} {m} || {attach_name}'
-                    error = (messages.WARNING, error_text)
-                    self.errors_list.append(error)
-        if success_list:
-            et = ', '.join(success_list)
-            error_text = f'{model_name} {len(success_list)} записей || {et} сохранен(ы).'
+                self.add_error_rows(Attachment, attach, f'{attach.number_spg}-{attach.sert_type}', form)
+        self.bulk_save(Attachment, bulk_list, update_list, AttachmentForm)
+
+    def delete_stale_attachments(self):
+        # только при is_stale_deleted: строки вложений, удаленные из файла (или перенесенные в другое место дерева),
+        # удаляются и из базы - иначе сертификат печатался бы и с прежними строками
+        stale_ids = self.key_index.take_stale_attachments()
+        if not stale_ids:
+            return
+        if self.is_dry_run:
+            error_text = f'Вложения(Attachment): {len(stale_ids)} записей будут удалены - их строк больше нет в файле.'
+            error = (messages.INFO, error_text)
+        else:
+            for start in range(0, len(stale_ids), BULK_BATCH_SIZE):
+                Attachment.objects.filter(id__in=stale_ids[start:start + BULK_BATCH_SIZE]).delete()
+            stage = self.stages_dict[Attachment]
+            self.report.add_count('удалена', stage.sheet_name, stage.model_name, len(stale_ids))
+            error_text = f'Вложения(Attachment): {len(stale_ids)} записей удалены - их строк больше нет в файле.'
             error = (messages.SUCCESS, error_text)
-            self.errors_list.append(error)
-
+        self.errors_list.append(error)
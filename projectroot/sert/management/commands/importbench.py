@@ -0,0 +1,56 @@
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from sert.importbench import ImportBenchmark
+
+
+class Command(BaseCommand):
+    help = ('Замер загрузки на синтетических xlsx-книгах: строк в секунду, пик памяти и число запросов '
+            'по этапам. Запускать на отдельной базе: --settings=SNQuality.settings_bench')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                            help='число вложений (строк ATTACH) в книгах, например 1000 10000 100000')
+        parser.add_argument('--attach-per-sert', type=int, default=50,
+                            help='вложений на один сертификат')
+        parser.add_argument('--per-row', action='store_true',
+                            help='запись по одной строке вместо пакетной (bulk)')
+        parser.add_argument('--json', action='store_true',
+                            help='вывести результат в JSON')
+
+    def handle(self, *args, **options):
+        # замер очищает таблицы загрузки - рабочую базу не трогаем
+        if connection.vendor != 'sqlite':
+            raise CommandError('Замер очищает таблицы загрузки и запускается только на SQLite: '
+                               'manage.py importbench --settings=SNQuality.settings_bench')
+        call_command('migrate', verbosity=0)
+
+        benchmark = ImportBenchmark(is_bulk=not options['per_row'], attach_per_sert=options['attach_per_sert'])
+        stages_list = []
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for size in options['sizes']:
+                path = os.path.join(temp_dir, f'bench_{size}.xlsx')
+                stages_list += benchmark.run(size, path)
+                if not options['json']:
+                    self.stdout.write(f'{size}: книга {os.path.getsize(path) // 1024} КБ')
+
+        if options['json']:
+            self.stdout.write(json.dumps([stage._asdict() for stage in stages_list], ensure_ascii=False, indent=2))
+            return
+        self.stdout.write(f'{"вложений":>9} {"этап":<9} {"строк":>7} {"сек":>8} {"строк/с":>9} '
+                          f'{"пик RSS, МБ":>11} {"запросов":>9}')
+        for stage in stages_list:
+            self.stdout.write(
+                f'{stage.size:>9} {stage.stage:<9} {stage.rows:>7} {stage.seconds:>8.2f} '
+                f'{self.format_value(stage.rows_per_sec, ".0f"):>9} '
+                f'{self.format_value(stage.peak_rss_mb, ".1f"):>11} {self.format_value(stage.queries, "d"):>9}'
+            )
+
+    @staticmethod
+    def format_value(value, value_format):
+        return '-' if value is None else format(value, value_format)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from sert.importjobs import ImportJobRunner
+
+
+class Command(BaseCommand):
+    help = 'Выполняет загрузки xlsx-файлов (ImportJob), поставленные в очередь через сайт'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='выполнить задания из очереди и завершиться')
+        parser.add_argument('--sleep', type=float, default=2.0,
+                            help='пауза в секундах между проверками пустой очереди')
+
+    def handle(self, *args, **options):
+        runner = ImportJobRunner()
+        if options['once']:
+            while runner.run_once():
+                pass
+        else:
+            runner.run_forever(options['sleep'])
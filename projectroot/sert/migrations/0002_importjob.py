@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sert', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='imports/', verbose_name='Файл загрузки')),
+                ('file_name', models.CharField(max_length=500, verbose_name='Имя файла')),
+                ('is_bulk', models.BooleanField(default=True, verbose_name='Пакетная запись')),
+                ('status', models.CharField(choices=[('PENDING', 'В очереди'), ('RUNNING', 'Выполняется'), ('DONE', 'Завершена'), ('FAILED', 'Ошибка')], db_index=True, default='PENDING', max_length=100, verbose_name='Статус')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начата')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершена')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Запусков')),
+                ('parsed_count', models.PositiveIntegerField(default=0, verbose_name='Прочитано строк')),
+                ('validated_count', models.PositiveIntegerField(default=0, verbose_name='Проверено строк')),
+                ('saved_count', models.PositiveIntegerField(default=0, verbose_name='Сохранено строк')),
+                ('messages', models.JSONField(blank=True, default=list, verbose_name='Сообщения')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Загрузка файла',
+                'verbose_name_plural': 'Загрузки файлов',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sert', '0002_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='row_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Хеш строки загрузки'),
+        ),
+        migrations.AddField(
+            model_name='kernel',
+            name='row_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Хеш строки загрузки'),
+        ),
+        migrations.AddField(
+            model_name='melt',
+            name='row_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Хеш строки загрузки'),
+        ),
+        migrations.AddField(
+            model_name='sert',
+            name='row_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Хеш строки загрузки'),
+        ),
+    ]
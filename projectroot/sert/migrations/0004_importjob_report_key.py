@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sert', '0003_row_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='report_key',
+            field=models.CharField(blank=True, max_length=32, null=True, verbose_name='Отчет загрузки'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:31
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def create_sequences(apps, schema_editor):
+    # счетчик каждого года начинается с наибольшего уже выданного номера
+    SertNumber = apps.get_model('sert', 'SertNumber')
+    SertNumberSequence = apps.get_model('sert', 'SertNumberSequence')
+    years = SertNumber.objects.order_by().values('year').annotate(last_number=Max('number'))
+    SertNumberSequence.objects.bulk_create([
+        SertNumberSequence(year=row['year'], last_number=row['last_number']) for row in years
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sert', '0004_importjob_report_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SertNumberSequence',
+            fields=[
+                ('year', models.PositiveIntegerField(primary_key=True, serialize=False, verbose_name='Год')),
+                ('last_number', models.PositiveIntegerField(default=0, verbose_name='Последний выданный номер')),
+            ],
+            options={
+                'verbose_name': 'Счетчик номеров сертификатов',
+                'verbose_name_plural': 'Счетчики номеров сертификатов',
+                'ordering': ['-year'],
+            },
+        ),
+        migrations.RunPython(create_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sert', '0005_sertnumbersequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='is_stale_deleted',
+            field=models.BooleanField(default=False, verbose_name='Удалять вложения, которых нет в файле'),
+        ),
+    ]
@@ -2,13 +2,15 @@ from datetime import datetime
 import gettext
 from django.contrib.admin.utils import label_for_field
 _ = gettext.gettext
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 from django.urls import reverse_lazy
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.shortcuts import get_object_or_404
 from django.http import Http404
 
-from sert.models_data import METHODS_LIST, ITEM_UNITS
+from sert.models_data import METHODS_LIST, ITEM_UNITS, IMPORT_JOB_STATUS_LIST
 
 
 class SertNumber(models.Model):
@@ -25,6 +27,20 @@ class SertNumber(models.Model):
         ordering = ['-year', '-number']
 
 
+class SertNumberSequence(models.Model):
+    # последний выданный номер сертификата года; номера выдаются блоками (sert.models_numbers)
+    year = models.PositiveIntegerField(primary_key=True, verbose_name='Год')
+    last_number = models.PositiveIntegerField(default=0, verbose_name='Последний выданный номер')
+
+    def __str__(self):
+        return f'{self.year}: {self.last_number}'
+
+    class Meta:
+        verbose_name = 'Счетчик номеров сертификатов'
+        verbose_name_plural = 'Счетчики номеров сертификатов'
+        ordering = ['-year']
+
+
 class Sert(models.Model):
     ## number_spg-sert_type-number_unique
     id = models.CharField(primary_key=True, unique=True, max_length=500, blank=True, verbose_name='Идентификатор')
@@ -42,6 +58,8 @@ class Sert(models.Model):
     # sign_type = models.ForeignKey('Signatories', on_delete=models.CASCADE, blank=True, null=True)
     guarantee_type = models.CharField(max_length=100, blank=True, null=True, verbose_name='Тип гарантии')
     sign_type = models.CharField(max_length=100, blank=True, null=True, verbose_name='Тип подписантов')
+    # row_hash: отпечаток строки xlsx-файла, из которой загружена запись (Converter)
+    row_hash = models.CharField(max_length=64, blank=True, null=True, editable=False, verbose_name='Хеш строки загрузки')
     # для редактирования при добавлении
 
     def __str__(self):
@@ -64,6 +82,8 @@ class Kernel(models.Model):
     quantity = models.PositiveIntegerField(default=1, blank=True, verbose_name='Количество')
     is_atom = models.BooleanField(default=False, blank=True, null=True, verbose_name='Атомка')
     atom_contract = models.TextField(null=True, blank=True, verbose_name='Атомный контракт')
+    # row_hash: отпечаток строки xlsx-файла, из которой загружена запись (Converter)
+    row_hash = models.CharField(max_length=64, blank=True, null=True, editable=False, verbose_name='Хеш строки загрузки')
     # для редактирования при добавлении
 
     def __str__(self):
@@ -114,6 +134,8 @@ class Attachment(models.Model):
     is_by_gost_material_number = models.BooleanField(default=True, blank=True, null=True, verbose_name='Мех.св-ва по ГОСТ')
     galvan_material = models.CharField(max_length=300, blank=True, null=True, verbose_name='Материал для гальваники')
     galvan_units = models.CharField(max_length=300, blank=True, null=True, verbose_name='Ед.изм. для гальваники')
+    # row_hash: отпечаток строки xlsx-файла, из которой загружена запись (Converter)
+    row_hash = models.CharField(max_length=64, blank=True, null=True, editable=False, verbose_name='Хеш строки загрузки')
 
     def __str__(self):
         return f'{self.id}-{self.number_spg}-{self.sert_type}'
@@ -160,6 +182,8 @@ class Melt(models.Model):
     impact_strength_60KCV = models.CharField(max_length=300, blank=True, null=True, verbose_name='Ударная вязкость КСV-60')  # Ударная вязкость КСV-60
     hardness = models.CharField(max_length=300, blank=True, null=True, verbose_name='Твердость')  # Твердость
     mkk = models.CharField(max_length=300, blank=True, null=True, verbose_name='МКК')  # МКК
+    # row_hash: отпечаток строки xlsx-файла, из которой загружена запись (Converter)
+    row_hash = models.CharField(max_length=64, blank=True, null=True, editable=False, verbose_name='Хеш строки загрузки')
 
     def __str__(self):
         return f'{self.melt_id}'
@@ -215,3 +239,52 @@ class Guarantee(models.Model):
         verbose_name_plural = 'Гарантии'
         ordering = ['-guarantee_type']
 
+
+class ImportJob(models.Model):
+    # загрузка xlsx-файла, которую выполняет importworker вне HTTP-запроса
+    file = models.FileField(upload_to='imports/', verbose_name='Файл загрузки')
+    file_name = models.CharField(max_length=500, verbose_name='Имя файла')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True, verbose_name='Пользователь')
+    is_bulk = models.BooleanField(default=True, verbose_name='Пакетная запись')
+    # вложения сертификатов файла, строк которых в файле больше нет, удаляются только по явному выбору в форме
+    is_stale_deleted = models.BooleanField(default=False, verbose_name='Удалять вложения, которых нет в файле')
+    status = models.CharField(choices=IMPORT_JOB_STATUS_LIST, default='PENDING', max_length=100, db_index=True, verbose_name='Статус')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
+    started_at = models.DateTimeField(blank=True, null=True, verbose_name='Начата')
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name='Завершена')
+    # сколько раз задание забирал worker: брошенное упавшим worker-ом задание запускается повторно (sert.importjobs)
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Запусков')
+    # счетчики строк
+    parsed_count = models.PositiveIntegerField(default=0, verbose_name='Прочитано строк')
+    validated_count = models.PositiveIntegerField(default=0, verbose_name='Проверено строк')
+    saved_count = models.PositiveIntegerField(default=0, verbose_name='Сохранено строк')
+    # [(level, text,), ...] - как ImportManager.get_errors()
+    messages = models.JSONField(default=list, blank=True, verbose_name='Сообщения')
+    # ключ отчета загрузки (sert.importreport): строки с ошибками и сохраненные записи
+    report_key = models.CharField(max_length=32, blank=True, null=True, verbose_name='Отчет загрузки')
+
+    def __str__(self):
+        return f'{self.id}-{self.file_name}'
+
+    def get_progress_key(self):
+        return f'import_job_progress_{self.id}'
+
+    def get_heartbeat_key(self):
+        return f'import_job_heartbeat_{self.id}'
+
+    def get_progress(self):
+        # пока загрузка идет, счетчики лежат в cache: в режиме is_bulk запись в базу идет в одной транзакции
+        # и изменения ImportJob до её завершения другим процессам не видны
+        progress = {
+            'parsed': self.parsed_count,
+            'validated': self.validated_count,
+            'saved': self.saved_count,
+        }
+        if self.status == 'RUNNING':
+            progress.update(cache.get(self.get_progress_key(), {}))
+        return progress
+
+    class Meta:
+        verbose_name = 'Загрузка файла'
+        verbose_name_plural = 'Загрузки файлов'
+        ordering = ['-created_at']
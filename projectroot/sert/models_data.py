@@ -32,3 +32,10 @@ CONCLUSIONS_NAMES = {
     'CTK_CONC2': 'CTK_CONC2',
 }
 
+
+IMPORT_JOB_STATUS_LIST = {
+    'PENDING': 'В очереди',
+    'RUNNING': 'Выполняется',
+    'DONE': 'Завершена',
+    'FAILED': 'Ошибка',
+}
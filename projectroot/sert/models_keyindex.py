@@ -0,0 +1,134 @@
+from decimal import Decimal, InvalidOperation
+
+from sert.models import (
+    SertNumber,
+    Sert,
+    Kernel,
+    Attachment,
+    Conclusion,
+    Guarantee,
+    Signatories,
+    Melt,
+)
+from sert.models_data import METHODS_LIST
+
+# естественный ключ вложения: сертификат (номер СПГ и тип) и место строки в дереве вложенности
+ATTACHMENT_KEY_FIELDS = [
+    'number_spg', 'sert_type', 'n_index',
+    'a_index', 'b_index', 'a1_index', 'b1_index', 'a2_index', 'b2_index',
+]
+
+
+class ImportKeyIndex:
+    # ключи существующих записей, по которым формы проверяют наличие записи в models
+    KEYS_FIELDS = {
+        Kernel: 'number_spg',
+        Melt: 'melt_id',
+        SertNumber: 'id',
+        Sert: 'id',
+        Conclusion: 'conclusion_type',
+        Guarantee: 'guarantee_type',
+        Signatories: 'sign_type',
+    }
+    # для этих models вместе с ключом загружается row_hash записи
+    HASH_MODELS = [Kernel, Melt, Sert]
+
+    def __init__(self):
+        self.keys_dict = {}
+        self.hashes_dict = {}  # {model: {key: row_hash}}
+        # {(место в дереве, номер повтора места): (id, row_hash)} - вложения в базе, еще не взятые строками файла
+        self.attachment_rows = {}
+        # сколько раз место в дереве уже встретилось в файле и сертификаты (номер СПГ, тип), вложения которых в файле
+        self.attachment_occurrences = {}
+        self.attachment_serts = set()
+
+        self.load_keys()
+
+    def load_keys(self):
+        # один запрос на каждую model за всю загрузку
+        for model, field_name in self.KEYS_FIELDS.items():
+            if model in self.HASH_MODELS:
+                self.hashes_dict[model] = dict(model.objects.order_by().values_list(field_name, 'row_hash'))
+                self.keys_dict[model] = set(self.hashes_dict[model])
+            else:
+                self.keys_dict[model] = set(model.objects.order_by().values_list(field_name, flat=True))
+        # по id - в порядке записи, как строки файла
+        attachments = Attachment.objects.order_by('id').values_list('id', 'row_hash', *ATTACHMENT_KEY_FIELDS)
+        occurrences = {}
+        for pk, row_hash, *values in attachments:
+            path = self.get_attachment_path(values)
+            occurrences[path] = occurrences.get(path, 0) + 1
+            self.attachment_rows[path + (occurrences[path],)] = (pk, row_hash)
+
+    def to_key(self, value, model):
+        field = model._meta.get_field(self.KEYS_FIELDS[model])
+        return field.to_python(value)
+
+    def is_exist(self, value, model):
+        return self.to_key(value, model) in self.keys_dict[model]
+
+    def add(self, value, model):
+        self.keys_dict[model].add(self.to_key(value, model))
+
+    def get_object(self, value, model):
+        # заглушка с одним первичным ключом - её достаточно для ForeignKey
+        key = self.to_key(value, model)
+        if key not in self.keys_dict[model]:
+            return None
+        return model(pk=key)
+
+    @staticmethod
+    def to_attachment_value(name, value):
+        # значение поля ключа вложения таким, каким его сохранит AttachmentForm: строка без пробелов по краям
+        # или None, n_index - целое, пустой sert_type - РЕМКОМПЛЕКТ
+        if isinstance(value, str):
+            value = value.strip()
+        if value in [None, '']:
+            if name == 'sert_type':
+                return METHODS_LIST['РЕМКОМПЛЕКТ']
+            return None
+        if name == 'n_index':
+            try:
+                return int(Decimal(str(value)))
+            except (InvalidOperation, ValueError, OverflowError):
+                return str(value)
+        return str(value)
+
+    def get_attachment_path(self, values):
+        # values - значения ATTACHMENT_KEY_FIELDS по порядку
+        return tuple(self.to_attachment_value(name, value) for name, value in zip(ATTACHMENT_KEY_FIELDS, values))
+
+    def take_attachment_state(self, values, row_hash):
+        # у соседних вложений без своих вложенных строк место в дереве одно - ключ дополняется номером повтора
+        # места по порядку строк; (состояние, id записи в базе)
+        path = self.get_attachment_path(values)
+        occurrence = self.attachment_occurrences.get(path, 0) + 1
+        self.attachment_occurrences[path] = occurrence
+        self.attachment_serts.add(path[:2])
+        saved = self.attachment_rows.pop(path + (occurrence,), None)
+        if saved is None:
+            return 'new', None
+        pk, saved_hash = saved
+        if saved_hash == row_hash:
+            return 'unchanged', pk
+        return 'changed', pk
+
+    def take_stale_attachments(self):
+        # id загруженных ранее вложений тех сертификатов, что есть в файле, которым не нашлось строки файла;
+        # вложения, внесенные вручную (без row_hash), остаются. Вызывается только при is_stale_deleted загрузки
+        stale_keys = [key for key, (pk, row_hash) in self.attachment_rows.items()
+                      if row_hash is not None and key[:2] in self.attachment_serts]
+        return [self.attachment_rows.pop(key)[0] for key in stale_keys]
+
+    def take_row_state(self, value, row_hash, model):
+        # (состояние, ключ): 'new' - записи в базе нет, 'unchanged' / 'changed' - есть, строка файла та же / другая;
+        # ключ забирается из hashes_dict - его повтор ниже в файле пойдет как новая запись и получит конфликт
+        if model is Attachment:
+            return self.take_attachment_state(value, row_hash)
+        key = self.to_key(value, model)
+        if key not in self.hashes_dict[model]:
+            return 'new', key
+        saved_hash = self.hashes_dict[model].pop(key)
+        if saved_hash == row_hash:
+            return 'unchanged', key
+        return 'changed', key
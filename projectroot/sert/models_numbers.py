@@ -0,0 +1,82 @@
+from datetime import datetime
+
+from django.db import connection, transaction
+from django.db.models import F, Max
+
+from sert.models import SertNumber, SertNumberSequence
+
+
+def reserve_numbers(year, count):
+    # (первый, последний) из count номеров года, выданных одним UPDATE счетчика:
+    # параллельные загрузки получают непересекающиеся блоки без блокировок на время загрузки.
+    # Вызывать вне долгих транзакций: строка счетчика заблокирована до конца транзакции вызывающего
+    last_number = update_sequence(year, count)
+    if last_number is None:
+        # счетчика года еще нет - начинается с наибольшего выданного номера (SertNumber, внесенные вручную)
+        last = SertNumber.objects.filter(year=year).aggregate(last=Max('number'))['last'] or 0
+        SertNumberSequence.objects.get_or_create(year=year, defaults={'last_number': last})
+        last_number = update_sequence(year, count)
+    return last_number - count + 1, last_number
+
+
+def update_sequence(year, count):
+    # новое значение счетчика или None, если счетчика года нет
+    table = connection.ops.quote_name(SertNumberSequence._meta.db_table)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            # LAST_INSERT_ID(expr) возвращает новое значение в ответе на сам UPDATE
+            cursor.execute(f'UPDATE {table} SET last_number = LAST_INSERT_ID(last_number + %s) WHERE year = %s',
+                           [count, year])
+            return cursor.lastrowid if cursor.rowcount else None
+        if connection.vendor in ['postgresql', 'sqlite']:
+            cursor.execute(f'UPDATE {table} SET last_number = last_number + %s WHERE year = %s RETURNING last_number',
+                           [count, year])
+            row = cursor.fetchone()
+            return row[0] if row else None
+    # прочие базы: UPDATE блокирует строку счетчика до конца транзакции, затем чтение в той же транзакции
+    with transaction.atomic():
+        is_updated = SertNumberSequence.objects.filter(year=year).update(last_number=F('last_number') + count)
+        if not is_updated:
+            return None
+        return SertNumberSequence.objects.filter(year=year).values_list('last_number', flat=True).get()
+
+
+class SertNumberPool:
+    # номера сертификатов текущего года, зарезервированные блоком (reserve); take выдает их по одному
+    def __init__(self, year=None, is_deferred=False):
+        self.year = year or datetime.now().year
+        # is_deferred: SertNumber не записываются сразу, а копятся для save_pending (один bulk_create)
+        self.is_deferred = is_deferred
+        self.numbers = iter(())
+        self.pending_list = []
+
+    def reserve(self, count):
+        first, last = reserve_numbers(self.year, count)
+        self.numbers = iter(range(first, last + 1))
+
+    def take(self, key_index=None):
+        # номер, занятый вручную внесенным SertNumber, пропускается
+        while True:
+            number = next(self.numbers, None)
+            if number is None:
+                self.reserve(1)
+                number = next(self.numbers)
+            sert_number = SertNumber(id=f'{number}-{self.year}', number=number, year=self.year)
+            if key_index is not None:
+                is_exist = key_index.is_exist(sert_number.id, SertNumber)
+            else:
+                is_exist = SertNumber.objects.filter(id=sert_number.id).exists()
+            if not is_exist:
+                break
+        if self.is_deferred:
+            self.pending_list.append(sert_number)
+        else:
+            sert_number.save(force_insert=True)
+        if key_index is not None:
+            key_index.add(sert_number.id, SertNumber)
+        return sert_number
+
+    def save_pending(self, batch_size=None):
+        if self.pending_list:
+            SertNumber.objects.bulk_create(self.pending_list, batch_size=batch_size)
+            self.pending_list = []
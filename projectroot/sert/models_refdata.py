@@ -0,0 +1,65 @@
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+
+from sert.models import Conclusion, Guarantee, Signatories
+
+# версия справочников в общем cache (CACHES): меняется при каждом изменении Conclusion, Guarantee, Signatories,
+# и каждый процесс (сайт, importworker) при следующей печати загружает справочники заново
+REFERENCE_DATA_VERSION_KEY = 'sert_reference_data_version'
+REFERENCE_MODELS = [Conclusion, Guarantee, Signatories]
+
+
+class ReferenceData:
+    # тексты заключений и гарантий и подписанты - тремя запросами на всю версию справочников
+    def __init__(self, version):
+        self.version = version
+        self.conclusions_dict = dict(Conclusion.objects.values_list('conclusion_type', 'conclusion_text'))
+        self.guarantees_dict = {}  # {guarantee_type: [guarantee_text, ...]}
+        for guarantee_type, guarantee_text in (Guarantee.objects.order_by('-guarantee_type', 'pk')
+                                               .values_list('guarantee_type', 'guarantee_text')):
+            self.guarantees_dict.setdefault(guarantee_type, []).append(guarantee_text)
+        self.signatories_dict = {}  # {sign_type: [Signatories, ...]}
+        for sign in Signatories.objects.order_by('-sign_type', 'pk'):
+            self.signatories_dict.setdefault(sign.sign_type, []).append(sign)
+
+    def get_conclusion_text(self, conclusion_type):
+        # None, если такого заключения нет
+        return self.conclusions_dict.get(conclusion_type)
+
+    def get_guarantee_texts(self, guarantee_type):
+        return self.guarantees_dict.get(guarantee_type, [])
+
+    def get_signatories(self, sign_type):
+        return self.signatories_dict.get(sign_type, [])
+
+
+_reference_data = None
+_reference_data_lock = threading.Lock()
+
+
+def get_reference_data():
+    # справочники этого процесса; одно чтение версии из cache, запросы в базу - только после изменения справочников
+    global _reference_data
+    version = cache.get_or_set(REFERENCE_DATA_VERSION_KEY, lambda: uuid.uuid4().hex, None)
+    reference_data = _reference_data
+    if reference_data is None or reference_data.version != version:
+        with _reference_data_lock:
+            if _reference_data is None or _reference_data.version != version:
+                _reference_data = ReferenceData(version)
+            reference_data = _reference_data
+    return reference_data
+
+
+def bump_reference_data_version(**kwargs):
+    cache.set(REFERENCE_DATA_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def connect_reference_data_signals():
+    for model in REFERENCE_MODELS:
+        post_save.connect(bump_reference_data_version, sender=model,
+                          dispatch_uid=f'reference_data_post_save_{model.__name__}')
+        post_delete.connect(bump_reference_data_version, sender=model,
+                            dispatch_uid=f'reference_data_post_delete_{model.__name__}')
@@ -0,0 +1,82 @@
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+import json
+import logging
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# этап печати одного сертификата (sert_id) или всей пачки (sert_id None): время (сек) и строки данных этапа
+SpanStat = namedtuple('SpanStat', ['name', 'sert_id', 'wall_time', 'rows'])
+
+
+class PrintTracer:
+    # замеры этапов печати в порядке выполнения; is_logged - каждый этап сразу пишется в лог строкой JSON,
+    # иначе только копится в spans_list (для проверок и для передачи из процессов печати)
+    is_enabled = True
+
+    def __init__(self, is_logged=True):
+        self.is_logged = is_logged
+        self.spans_list = []
+
+    @contextmanager
+    def span(self, name, sert_id=None):
+        # with tracer.span('set_style', sert_id) as span: ... span['rows'] = ...
+        span = {'rows': 0}
+        wall_start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.add_span(SpanStat(name, sert_id, time.perf_counter() - wall_start, span['rows']))
+
+    def call(self, name, sert_id, function, *args, rows=0):
+        with self.span(name, sert_id) as span:
+            span['rows'] = rows
+            return function(*args)
+
+    def add_span(self, span_stat):
+        self.spans_list.append(span_stat)
+        if self.is_logged:
+            logger.info(json.dumps(span_stat._asdict(), default=str, ensure_ascii=False))
+
+    def add_spans(self, spans_list):
+        # этапы из процессов печати приходят простыми кортежами
+        for span in spans_list:
+            self.add_span(SpanStat._make(span))
+
+    def get_spans(self):
+        return self.spans_list
+
+
+class NullTracer:
+    # замеры выключены: без таймеров, словарей и записей
+    is_enabled = False
+    null_span = nullcontext({'rows': 0})
+
+    def span(self, name, sert_id=None):
+        return self.null_span
+
+    @staticmethod
+    def call(name, sert_id, function, *args, rows=0):
+        return function(*args)
+
+    def add_span(self, span_stat):
+        pass
+
+    def add_spans(self, spans_list):
+        pass
+
+    @staticmethod
+    def get_spans():
+        return []
+
+
+NULL_TRACER = NullTracer()
+
+
+def get_print_tracer():
+    if getattr(settings, 'PRINT_TRACE', False):
+        return PrintTracer()
+    return NULL_TRACER
@@ -1,3 +1,1093 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import messages
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Model, QuerySet
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from docx import Document
+from docx.oxml.ns import qn
+from lxml import etree
+from openpyxl import Workbook, load_workbook
+
+from sert.createdocx2 import (
+    DOCX_CACHE_VERSION, DocxMaker, DocxTableBuilder, GroupManager, ModelDataLoader, SertPrintData, SertTabsMaker,
+    StaticTabsMaker, docx_skeletons, get_docx_cache_key, get_docx_skeleton, get_render_workers,
+)
+from sert.forms import SertNumberForm
+from sert.importjobs import HEARTBEAT_TIMEOUT, MAX_ATTEMPTS, ImportJobRunner
+from sert.importxlsx import CSV_SHEET_COLUMN, NDJSON_SHEET_KEY, ImportManager, Importer, Loader
+from sert.models import (
+    Attachment, Conclusion, Guarantee, ImportJob, Kernel, Melt, Sert, SertNumber, SertNumberSequence, Signatories,
+)
+from sert.models_keyindex import ImportKeyIndex
+from sert.models_numbers import SertNumberPool, reserve_numbers
+from sert.models_refdata import get_reference_data
+from sert.printtrace import NULL_TRACER
+from sert.views import FileLoadFormView
+
+
+class ImportTestMixin:
+    # книги загрузки собираются в тесте по картам колонок Importer, cache разбора и отчеты - во временном каталоге
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        settings_override = override_settings(
+            IMPORT_PARSE_CACHE_DIR=os.path.join(self.tmp_dir.name, 'import_cache'),
+            IMPORT_REPORT_DIR=os.path.join(self.tmp_dir.name, 'import_reports'),
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # номер нового сертификата продолжает последний выданный
+        SertNumber.objects.create(id='1-2024', number=1, year=2024)
+
+    def make_sheets(self, attach_count=16, attach_per_sert=8, melt_count=0):
+        # [(имя листа, заголовки, строки)]; вложения - детали 1-го уровня (a_index), attach_per_sert на сертификат
+        importer = Importer()
+        sert_count = -(-attach_count // attach_per_sert)
+        serts = [{
+            'number_spg': f'ТЕСТ-{index}',
+            'designation': f'СПГ.{index:06}',
+            'denomination': f'Насосный агрегат {index}',
+            'quantity': 1,
+            'sert_type': 'НАСОС',
+            'date': datetime(2024, 1, 1),
+            'is_drag_met': 'нет',
+            'is_print': 'нет',
+            'is_atom': 'нет',
+        } for index in range(sert_count)]
+        attachments = [{
+            'sert_type': 'НАСОС',
+            'number_spg': f'ТЕСТ-{index // attach_per_sert}',
+            'designation': f'ДЕТ.{index:07}',
+            'denomination': 'Деталь',
+            'quantity': 1,
+            'a_index': str(index % attach_per_sert + 1),
+            'is_by_gost_material_number': 'нет',
+        } for index in range(attach_count)]
+        melts = [{
+            'melt_number': f'П{index}',
+            'material_id': '12Х18Н10Т',
+            'melt_year': '2023',
+            'melt_passport': f'ПС-{index}',
+            'carboneum': 0.12,
+            'tensile_strength': 540,
+            'hardness': '180 HB',
+        } for index in range(melt_count)]
+        sheets = []
+        for name, rows in [('melt', melts), ('sert', serts), ('attach', attachments)]:
+            names_conv = getattr(importer, f'{name}_names_conv')
+            row_names = getattr(importer, f'{name}_row_names')
+            inv_names_conv = {v: k for k, v in names_conv.items()}
+            head = [inv_names_conv[row_name] for row_name in row_names]
+            sheets.append((importer.ws_names_dict[name], head, [[row.get(row_name) for row_name in row_names]
+                                                                for row in rows]))
+        return sheets
+
+    def make_workbook(self, attach_count=16, attach_per_sert=8, melt_count=0):
+        # без melt_count лист MELT - только заголовок
+        wb = Workbook(write_only=True)
+        for ws_name, head, rows in self.make_sheets(attach_count, attach_per_sert, melt_count):
+            ws = wb.create_sheet(ws_name)
+            ws.append(head)
+            for row in rows:
+                ws.append(row)
+        path = os.path.join(self.tmp_dir.name, 'book.xlsx')
+        wb.save(path)
+        return path
+
+    @staticmethod
+    def get_saved_rows():
+        # записи загруженных models; поля, которые не зависят от строк файла, не сравниваются
+        return {
+            'kernel': list(Kernel.objects.order_by('number_spg').values()),
+            'sert': list(Sert.objects.order_by('id').values()),
+            'attach': list(Attachment.objects.order_by('designation').values(
+                *[field.attname for field in Attachment._meta.concrete_fields if field.name != 'id'])),
+            # by_gost_number без значения в файле выбирается случайно
+            'melt': list(Melt.objects.order_by('melt_id').values(
+                *[field.attname for field in Melt._meta.concrete_fields if field.name != 'by_gost_number'])),
+        }
+
+    def load(self, path, **kwargs):
+        IM = ImportManager(**kwargs)
+        with open(path, 'rb') as input_file:
+            IM.set_file(File(input_file, name=os.path.basename(path)))
+        return IM
+
+    @staticmethod
+    def edit_attach_ws(path, edit):
+        # edit(ws, columns): columns - {имя поля: номер колонки листа ATTACH}
+        importer = Importer()
+        wb = load_workbook(path)
+        ws = wb[importer.ws_names_dict['attach']]
+        columns = {name: index + 1 for index, name in enumerate(importer.attach_row_names)}
+        edit(ws, columns)
+        wb.save(path)
+
+
+class AttachmentReimportTest(ImportTestMixin, TestCase):
+    def test_edited_row_updates_attachment(self):
+        path = self.make_workbook()
+        self.load(path, is_bulk=True)
+        self.assertEqual(Attachment.objects.count(), 16)
+        ids = set(Attachment.objects.values_list('id', flat=True))
+
+        def edit(ws, columns):
+            ws.cell(row=4, column=columns['designation'], value='ДЕТ.ИЗМЕНЕНА')
+        self.edit_attach_ws(path, edit)
+        IM = self.load(path, is_bulk=True)
+
+        summary = {row.model: row for row in IM.get_summary()}
+        self.assertEqual(summary['Attachment'].updates, 1)
+        self.assertEqual(summary['Attachment'].inserts, 0)
+        self.assertEqual(set(Attachment.objects.values_list('id', flat=True)), ids)
+        self.assertEqual(Attachment.objects.filter(designation='ДЕТ.ИЗМЕНЕНА').count(), 1)
+
+    def remove_attach_row(self, path):
+        removed_list = []
+
+        def edit(ws, columns):
+            removed_list.append(ws.cell(row=9, column=columns['designation']).value)
+            ws.delete_rows(9)
+        self.edit_attach_ws(path, edit)
+        return removed_list[0]
+
+    def test_removed_row_keeps_attachment(self):
+        # без явного выбора загрузка ничего не удаляет
+        path = self.make_workbook()
+        self.load(path, is_bulk=False)
+        removed = self.remove_attach_row(path)
+        self.load(path, is_bulk=False)
+
+        self.assertEqual(Attachment.objects.count(), 16)
+        self.assertTrue(Attachment.objects.filter(designation=removed).exists())
+
+    def test_removed_row_deletes_attachment_when_selected(self):
+        path = self.make_workbook()
+        self.load(path, is_bulk=False)
+        removed = self.remove_attach_row(path)
+        IM = self.load(path, is_bulk=True, is_stale_deleted=True, is_dry_run=True)
+        self.assertEqual(Attachment.objects.count(), 16)
+        self.assertIn((messages.INFO, 'Вложения(Attachment): 1 записей будут удалены - их строк больше нет в файле.'),
+                      IM.get_errors())
+
+        IM = self.load(path, is_bulk=True, is_stale_deleted=True)
+        self.assertEqual(Attachment.objects.count(), 15)
+        self.assertFalse(Attachment.objects.filter(designation=removed).exists())
+        counts = {(row.status, row.model): row.message for row in IM.get_report().get_rows()}
+        self.assertEqual(counts[('удалена', 'Вложения(Attachment):')], 'записей: 1')
+
+
+@mock.patch('sert.importxlsx.STREAM_CHUNK_SIZE', 10)
+class BulkLoadTest(ImportTestMixin, TestCase):
+    def test_bulk_load_matches_row_by_row_load(self):
+        path = self.make_workbook(melt_count=2)
+        with transaction.atomic():
+            IM = self.load(path)
+            saved_rows = self.get_saved_rows()
+            transaction.set_rollback(True)
+        row_errors = IM.get_errors()
+
+        # строки листов записываются через bulk_create, ModelForm.save() по строке не вызывается
+        with mock.patch.object(QuerySet, 'bulk_create', autospec=True, side_effect=QuerySet.bulk_create) as bulk_create, \
+                mock.patch.object(Model, 'save', autospec=True, side_effect=Model.save) as save:
+            IM = self.load(path, is_bulk=True)
+        self.assertEqual([call.args[0].model for call in bulk_create.call_args_list],
+                         [Melt, Kernel, SertNumber, Sert, Attachment])
+        self.assertEqual([call.args[0] for call in save.call_args_list
+                          if type(call.args[0]) in [Melt, Kernel, Sert, Attachment]], [])
+        self.assertEqual(self.get_saved_rows(), saved_rows)
+        self.assertEqual(IM.get_errors(), row_errors)
+        self.assertIn((messages.SUCCESS, 'Вложения(Attachment): 16 записей сохранен(ы).'), IM.get_errors())
+
+    def test_database_error_rolls_back_whole_file(self):
+        path = self.make_workbook()
+        bulk_create = QuerySet.bulk_create
+
+        def bulk_create_failing(queryset, objs, **kwargs):
+            if queryset.model is Attachment:
+                raise DatabaseError('disk I/O error')
+            return bulk_create(queryset, objs, **kwargs)
+        with mock.patch.object(QuerySet, 'bulk_create', bulk_create_failing):
+            IM = self.load(path, is_bulk=True)
+
+        self.assertFalse(Kernel.objects.exists())
+        self.assertFalse(Sert.objects.exists())
+        # сообщения о сохранении записей отозваны, остались только сообщения разбора файла
+        self.assertEqual([text for level, text in IM.loader.get_errors() if level == messages.SUCCESS], [])
+        self.assertTrue(any('загрузка отменена целиком' in text for level, text in IM.get_errors()))
+
+
+class ImportKeyIndexTest(ImportTestMixin, TestCase):
+    def test_duplicate_rows_conflict(self):
+        # повтор строки SERT ниже в файле: в режиме is_bulk первая строка еще не записана в базу,
+        # повтор находит ее ключ в key_index
+        path = self.make_workbook()
+        wb = load_workbook(path)
+        ws = wb['SERT']
+        ws.append([cell.value for cell in ws[2]])
+        wb.save(path)
+        IM = self.load(path, is_bulk=True)
+
+        summary = {row.model: row for row in IM.get_summary()}
+        self.assertEqual((summary['Kernel'].inserts, summary['Kernel'].conflicts), (2, 1))
+        self.assertEqual((summary['Sert'].inserts, summary['Sert'].conflicts), (2, 1))
+        self.assertEqual(Sert.objects.count(), 2)
+        error_rows = {(row.sheet, row.row_number) for row in IM.get_report().get_rows() if row.row_number is not None}
+        self.assertEqual(error_rows, {('SERT', 4)})
+
+    def test_keys_loaded_once(self):
+        # проверка строк не обращается к базе: запросы только на загрузку ключей, сколько бы строк ни было в файле
+        for attach_count in [16, 64]:
+            path = self.make_workbook(attach_count=attach_count, melt_count=2)
+            with self.assertNumQueries(len(ImportKeyIndex.KEYS_FIELDS) + 1):
+                IM = self.load(path, is_dry_run=True)
+            summary = {row.model: row for row in IM.get_summary()}
+            self.assertEqual(summary['Attachment'].inserts, attach_count)
+
+    def test_added_keys_are_found(self):
+        Kernel.objects.create(number_spg='ТЕСТ-0', designation='СПГ.000000', denomination='Насосный агрегат')
+        key_index = ImportKeyIndex()
+        self.assertTrue(key_index.is_exist('ТЕСТ-0', Kernel))
+        self.assertFalse(key_index.is_exist('ТЕСТ-1', Kernel))
+        key_index.add('ТЕСТ-1', Kernel)
+        self.assertTrue(key_index.is_exist('ТЕСТ-1', Kernel))
+        self.assertEqual(key_index.get_object('ТЕСТ-1', Kernel).pk, 'ТЕСТ-1')
+        self.assertIsNone(key_index.get_object('ТЕСТ-2', Kernel))
+
+
+class TextImportTest(ImportTestMixin, TestCase):
+    # те же строки, что в xlsx-книге, в текстовых форматах: zip с CSV, одиночный CSV, ndjson
+    @staticmethod
+    def to_text(value):
+        if isinstance(value, datetime):
+            return value.strftime('%d.%m.%Y')
+        return '' if value is None else str(value)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'wb') as output_file:
+            output_file.write(content)
+        return path
+
+    def make_zip(self, sheets):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            for ws_name, head, rows in sheets:
+                lines = [head] + [[self.to_text(value) for value in row] for row in rows]
+                text = io.StringIO(newline='')
+                csv.writer(text, delimiter=';').writerows(lines)
+                zf.writestr(f'{ws_name}.csv', text.getvalue().encode('utf-8'))
+        return self.write_file('book.zip', buffer.getvalue())
+
+    def make_csv(self, sheets):
+        # колонки файла - колонка листа и колонки всех листов, одинаковые названия - одна колонка
+        columns = [CSV_SHEET_COLUMN]
+        for ws_name, head, rows in sheets:
+            columns += [column for column in head if column not in columns]
+        text = io.StringIO(newline='')
+        writer = csv.writer(text, delimiter=';')
+        writer.writerow(columns)
+        for ws_name, head, rows in sheets:
+            for row in rows:
+                row_dict = {CSV_SHEET_COLUMN: ws_name, **dict(zip(head, row))}
+                writer.writerow([self.to_text(row_dict.get(column)) for column in columns])
+        return self.write_file('book.csv', text.getvalue().encode('utf-8'))
+
+    def make_ndjson(self, sheets):
+        lines = []
+        for ws_name, head, rows in sheets:
+            for row in rows:
+                values = [value.strftime('%Y-%m-%d') if isinstance(value, datetime) else value for value in row]
+                lines.append(json.dumps({NDJSON_SHEET_KEY: ws_name, **dict(zip(head, values))}, ensure_ascii=False))
+        return self.write_file('book.ndjson', '\n'.join(lines).encode('utf-8'))
+
+    def load_rows(self, path):
+        # записи загрузки файла; транзакция откатывается - следующий файл загружается в ту же пустую базу
+        with transaction.atomic():
+            IM = self.load(path, is_bulk=True)
+            loaded = self.get_saved_rows()
+            transaction.set_rollback(True)
+        self.assertFalse([text for level, text in IM.get_errors() if level == messages.ERROR])
+        return loaded
+
+    def test_text_formats_match_xlsx(self):
+        sheets = self.make_sheets(melt_count=2)
+        expected = self.load_rows(self.make_workbook(melt_count=2))
+        self.assertEqual([len(expected[name]) for name in ['kernel', 'sert', 'attach', 'melt']], [2, 2, 16, 2])
+        for path in [self.make_zip(sheets), self.make_csv(sheets), self.make_ndjson(sheets)]:
+            with self.subTest(path=os.path.basename(path)):
+                self.assertEqual(self.load_rows(path), expected)
+
+    def get_load_errors(self, path):
+        IM = self.load(path, is_bulk=True)
+        self.assertFalse(Sert.objects.exists())
+        return [text for level, text in IM.get_errors() if level == messages.ERROR]
+
+    def test_missing_sheet(self):
+        sheets = self.make_sheets(melt_count=1)
+        sheets_without_melt = [sheet for sheet in sheets if sheet[0] != 'MELT']
+        sheets_without_attach = [sheet for sheet in sheets if sheet[0] != 'ATTACH']
+        self.assertEqual(self.get_load_errors(self.make_zip(sheets_without_melt)), [
+            'zip-файл не содержит лист "melt". дальнейшая обработка файла не имеет смысла.'])
+        self.assertEqual(self.get_load_errors(self.make_csv(sheets_without_attach)), [
+            'csv-файл не содержит лист "attach". дальнейшая обработка файла не имеет смысла.'])
+        self.assertEqual(self.get_load_errors(self.make_ndjson(sheets_without_attach)), [
+            'ndjson-файл не содержит лист "attach". дальнейшая обработка файла не имеет смысла.'])
+
+    def test_missing_column(self):
+        # в листе ATTACH нет колонки "обозначение"; в одиночном CSV-файле колонки общие для всех листов,
+        # там проверяется колонка с именем листа
+        index = Importer().attach_row_names.index('designation')
+        sheets = [(ws_name, head, rows) if ws_name != 'ATTACH' else
+                  (ws_name, head[:index] + head[index + 1:], [row[:index] + row[index + 1:] for row in rows])
+                  for ws_name, head, rows in self.make_sheets(melt_count=1)]
+        error_text = ('Лист "attach" {}-файла не содержит колонки: "обозначение". '
+                      'дальнейшая обработка файла не имеет смысла.')
+        self.assertEqual(self.get_load_errors(self.make_zip(sheets)), [error_text.format('zip')])
+        self.assertEqual(self.get_load_errors(self.make_ndjson(sheets)), [error_text.format('ndjson')])
+
+        csv_path = self.write_file('book.csv', 'номер_СПГ;обозначение\nТЕСТ-0;СПГ.000000\n'.encode('utf-8'))
+        self.assertEqual(self.get_load_errors(csv_path)[0],
+                         'Файл "book.csv" не содержит колонку "лист" с именем листа строки. '
+                         'дальнейшая обработка файла не имеет смысла.')
+
+
+@mock.patch('sert.importxlsx.STREAM_CHUNK_SIZE', 10)
+class StreamingLoadTest(ImportTestMixin, TestCase):
+    # 40 строк ATTACH - четыре части по 10 строк, каждая записывается своей транзакцией
+    def test_streaming_load_matches_full_load(self):
+        path = self.make_workbook(attach_count=40, attach_per_sert=20)
+        self.load(path, is_bulk=True, is_streaming=True)
+        self.assertEqual(Sert.objects.count(), 2)
+        self.assertEqual(Attachment.objects.count(), 40)
+        attachments = set(Attachment.objects.values_list('id', 'number_spg', 'a_index', 'designation'))
+
+        # повторная загрузка тех же строк целиком ничего не меняет
+        IM = self.load(path, is_bulk=True)
+        self.assertFalse([text for level, text in IM.get_errors() if level == messages.ERROR])
+        self.assertEqual(set(Attachment.objects.values_list('id', 'number_spg', 'a_index', 'designation')),
+                         attachments)
+
+    def test_database_error_keeps_saved_chunks(self):
+        path = self.make_workbook(attach_count=40, attach_per_sert=20)
+        load_attach = Loader.load_attach
+        calls_list = []
+
+        def load_attach_failing(loader):
+            # третья часть записывается и падает - её транзакция откатывается
+            calls_list.append(len(loader.attachment_data))
+            load_attach(loader)
+            if len(calls_list) == 3:
+                raise DatabaseError('disk I/O error')
+        with mock.patch.object(Loader, 'load_attach', load_attach_failing):
+            IM = self.load(path, is_bulk=True, is_streaming=True)
+
+        self.assertEqual(calls_list, [10, 10, 10])
+        self.assertEqual(Sert.objects.count(), 2)
+        self.assertEqual(Attachment.objects.count(), 20)
+        self.assertTrue(any('disk I/O error' in text for level, text in IM.get_errors()))
+
+
+class ParseCacheTest(ImportTestMixin, TestCase):
+    def load_cached(self, path):
+        # parse_calls - сколько раз файл разбирался заново, без cache
+        with mock.patch.object(ImportManager, 'parse_file', autospec=True,
+                               side_effect=ImportManager.parse_file) as parse_file:
+            IM = self.load(path, is_cached=True, is_dry_run=True)
+        return parse_file.call_count, {name: list(rows) for name, rows in IM.converter.get_result().items()}
+
+    def test_renamed_file_hits_cache(self):
+        path = self.make_workbook()
+        parse_calls, rows = self.load_cached(path)
+        self.assertEqual(parse_calls, 1)
+        self.assertEqual(len(rows['attachment']), 16)
+
+        renamed_path = os.path.join(self.tmp_dir.name, 'повторно.xlsx')
+        os.rename(path, renamed_path)
+        self.assertEqual(self.load_cached(renamed_path), (0, rows))
+
+    def test_column_maps_change_invalidates_cache(self):
+        path = self.make_workbook()
+        self.assertEqual(self.load_cached(path)[0], 1)
+        self.assertEqual(self.load_cached(path)[0], 0)
+
+        importer_init = Importer.__init__
+
+        def importer_init_renamed(importer):
+            # колонка "обозначение" листа SERT теперь может называться и "децимальный_номер"
+            importer_init(importer)
+            importer.sert_names_conv['децимальный_номер'] = 'designation'
+        with mock.patch.object(Importer, '__init__', importer_init_renamed):
+            self.assertEqual(self.load_cached(path)[0], 1)
+            self.assertEqual(self.load_cached(path)[0], 0)
+
+
+class ImportReportTest(ImportTestMixin, TestCase):
+    # в отчете - только строки с ошибками и счетчики записей по model, сколько бы строк ни было в файле
+    def check_report(self, **kwargs):
+        path = self.make_workbook(attach_count=40, attach_per_sert=20)
+
+        def edit(ws, columns):
+            ws.cell(row=5, column=columns['number_spg'], value='НЕТ-ТАКОГО')
+        self.edit_attach_ws(path, edit)
+        report = self.load(path, is_bulk=True, **kwargs).get_report()
+
+        rows = report.get_rows()
+        error_rows = [row for row in rows if row.row_number is not None]
+        self.assertEqual({(row.status, row.sheet, row.row_number) for row in error_rows}, {('ошибка', 'ATTACH', 5)})
+        counts = {(row.status, row.model): row.message for row in rows if row.row_number is None}
+        self.assertEqual(counts, {
+            ('сохранена', 'Продукт(Kernel):'): 'записей: 2',
+            ('сохранена', 'Сертификат(Sert):'): 'записей: 2',
+            ('сохранена', 'Вложения(Attachment):'): 'записей: 39',
+        })
+
+    def test_report_rows(self):
+        self.check_report()
+
+    def test_streaming_report_rows(self):
+        with mock.patch('sert.importxlsx.STREAM_CHUNK_SIZE', 10):
+            self.check_report(is_streaming=True)
+
+
+class ReserveNumbersTest(ImportTestMixin, TransactionTestCase):
+    def test_concurrent_blocks_do_not_overlap(self):
+        year = 2030
+        reserve_numbers(year, 1)
+        blocks_list = []
+        errors_list = []
+
+        def reserve():
+            try:
+                for _ in range(5):
+                    blocks_list.append(reserve_numbers(year, 10))
+            except Exception as e:
+                errors_list.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=reserve) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors_list, [])
+        numbers = [number for first, last in blocks_list for number in range(first, last + 1)]
+        self.assertEqual(sorted(numbers), list(range(2, 2 + 8 * 5 * 10)))
+
+    def test_bulk_import_reserves_outside_transaction(self):
+        # строка счетчика не должна оставаться заблокированной до конца транзакции загрузки
+        path = self.make_workbook()
+        in_atomic_list = []
+        reserve = SertNumberPool.reserve
+
+        def reserve_spy(number_pool, count):
+            in_atomic_list.append(connection.in_atomic_block)
+            return reserve(number_pool, count)
+        with mock.patch.object(SertNumberPool, 'reserve', reserve_spy):
+            self.load(path, is_bulk=True)
+
+        self.assertEqual(in_atomic_list, [False])
+        self.assertEqual(Sert.objects.count(), 2)
+        self.assertEqual(set(Sert.objects.values_list('number_unique__number', flat=True)), {1, 2})
+
+
+class SertNumberFormTest(TestCase):
+    def test_number_taken_only_on_save(self):
+        SertNumber.objects.create(id='7-2030', number=7, year=2030)
+        reserve_numbers(2030, 1)
+        form = SertNumberForm({'id': '7-2030', 'number': '', 'year': 2030})
+        self.assertFalse(form.is_valid())
+        self.assertFalse(form.is_valid())
+        self.assertEqual(SertNumberSequence.objects.get(year=2030).last_number, 8)
+
+        form = SertNumberForm({'id': '', 'number': '', 'year': 2030})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(SertNumberSequence.objects.get(year=2030).last_number, 8)
+        self.assertEqual(form.save().id, '9-2030')
+
+
+class ImportJobTest(TestCase):
+    # загрузку файла в задании заменяет mock ImportManager: проверяется только очередь заданий
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=os.path.join(self.tmp_dir.name, 'media'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+        self.user = get_user_model().objects.create_user('loader', password='loader')
+        # TestCase держит транзакцию на соединении - worker не должен его закрывать
+        patcher = mock.patch('sert.importjobs.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('sert.importjobs.ImportManager')
+        import_manager = patcher.start()
+        self.addCleanup(patcher.stop)
+        import_manager.return_value.get_errors.return_value = []
+        import_manager.return_value.save_report.return_value = None
+        import_manager.return_value.get_progress.return_value = {'parsed': 3, 'validated': 3, 'saved': 3}
+
+    def create_job(self, **kwargs):
+        return ImportJob.objects.create(file=ContentFile(b'xlsx', name='book.xlsx'), file_name='book.xlsx',
+                                        user=self.user, **kwargs)
+
+    def get_load_page(self, job):
+        request = RequestFactory().get(reverse('loadfile'), {'job': job})
+        request.user = self.user
+        return FileLoadFormView.as_view()(request)
+
+    def test_bad_job_parameter_shows_page_without_polling(self):
+        for job in ['abc', '-1', '0', '1.5']:
+            response = self.get_load_page(job)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.context_data['job_id'])
+            response.render()
+        response = self.get_load_page('12')
+        self.assertEqual(response.context_data['job_id'], 12)
+
+    def post_load_page(self, is_csrf_checked=False):
+        upload = SimpleUploadedFile('book.xlsx', b'not a zip archive')
+        request = RequestFactory().post(reverse('loadfile'), {'file': upload})
+        request.user = self.user
+        request._dont_enforce_csrf_checks = not is_csrf_checked
+        return FileLoadFormView.as_view()(request)
+
+    def test_upload_handler_applies_to_load_view(self):
+        # ImportFileUploadHandler ставит сама страница загрузки: файл отброшен еще при приеме
+        response = self.post_load_page()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context_data['form'].errors['file'],
+                         ['Файл "book.xlsx" не является zip-архивом, хотя имеет такое расширение.'])
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_load_view_checks_csrf(self):
+        response = self.post_load_page(is_csrf_checked=True)
+        self.assertEqual(response.status_code, 403)
+
+    def test_job_done_deletes_file(self):
+        job = self.create_job()
+        file_path = job.file.path
+        self.assertTrue(os.path.exists(file_path))
+        ImportJobRunner().run_once()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'DONE')
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.saved_count, 3)
+        self.assertFalse(job.file)
+        self.assertFalse(os.path.exists(file_path))
+        self.assertIsNone(cache.get(job.get_heartbeat_key()))
+
+    def test_stale_running_job_is_run_again(self):
+        started_at = timezone.now() - timedelta(seconds=HEARTBEAT_TIMEOUT + 60)
+        job = self.create_job(status='RUNNING', started_at=started_at, attempts=1)
+        ImportJobRunner().run_once()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'DONE')
+        self.assertEqual(job.attempts, 2)
+
+    def test_running_job_with_heartbeat_is_kept(self):
+        started_at = timezone.now() - timedelta(seconds=HEARTBEAT_TIMEOUT + 60)
+        job = self.create_job(status='RUNNING', started_at=started_at, attempts=1)
+        ImportJobRunner.set_heartbeat(job)
+        ImportJobRunner().run_once()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'RUNNING')
+        self.assertEqual(job.attempts, 1)
+
+    def test_stale_job_fails_after_max_attempts(self):
+        started_at = timezone.now() - timedelta(seconds=HEARTBEAT_TIMEOUT + 60)
+        job = self.create_job(status='RUNNING', started_at=started_at, attempts=MAX_ATTEMPTS)
+        file_path = job.file.path
+        ImportJobRunner().run_once()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'FAILED')
+        self.assertIsNotNone(job.finished_at)
+        self.assertFalse(os.path.exists(file_path))
+
+
+class RenderWorkersTest(TestCase):
+    @override_settings(PRINT_RENDER_WORKERS=4)
+    def test_request_prints_in_process_by_default(self):
+        self.assertEqual(get_render_workers(is_request=True), 1)
+        self.assertEqual(get_render_workers(), 4)
+        with self.settings(PRINT_RENDER_IN_REQUEST=True):
+            self.assertEqual(get_render_workers(is_request=True), 4)
+
+
+class PrintDataLoadTest(TestCase):
+    # данные сертификатов на печать: три запроса на всю печать, сколько бы сертификатов ни было выбрано
+    def add_serts(self, first, last):
+        for index in range(first, last):
+            kernel = Kernel.objects.create(number_spg=f'ТЕСТ-{index}', designation=f'СПГ.{index:06}')
+            number = SertNumber.objects.create(id=f'{index}-2030', number=index, year=2030)
+            Sert.objects.create(id=f'ТЕСТ-{index}-НАСОС_ХИМ-{index}-2030', number_spg=kernel, sert_type='НАСОС_ХИМ',
+                                number_unique=number)
+            # вложения нечетных сертификатов ссылаются на номер сертификата - отбор по номеру
+            attach_number = number if index % 2 else None
+            for part in range(3):
+                melt = Melt.objects.create(melt_id=f'П{index}{part}-12Х18Н10Т-2023-ПС', melt_number=f'П{index}{part}',
+                                           material_id='12Х18Н10Т', melt_year='2023', melt_passport='ПС',
+                                           by_gost_number=1)
+                Attachment.objects.create(number_spg=kernel, number_unique=attach_number, sert_type='НАСОС_ХИМ',
+                                          designation=f'ДЕТ.{index}{part}', a_index=str(part + 1), is_cast=True,
+                                          melt_number=melt.melt_number, material_id=melt.material_id,
+                                          melt_year=melt.melt_year, melt_passport=melt.melt_passport)
+            # вложение другого сертификата того же продукта без номера - не попадает в отбор по номеру
+            Attachment.objects.create(number_spg=kernel, sert_type='НАСОС_ХИМ', designation=f'ДЕТ.{index}-старая')
+
+    def get_group_manager(self):
+        # только загрузка данных: сертификаты, вложения и плавки
+        with mock.patch('sert.createdocx2.get_reference_data'), \
+                mock.patch('sert.createdocx2.GroupManager.create_serts_incarnations'):
+            return GroupManager(render_workers=1, is_lazy=True)
+
+    def test_fixed_query_count(self):
+        for first, last in [(1, 3), (3, 9)]:
+            self.add_serts(first, last)
+            with self.assertNumQueries(3):
+                group_manager = self.get_group_manager()
+            self.assertEqual(len(group_manager.serts_to_print), last - 1)
+
+            with self.assertNumQueries(0):
+                loaded_list = [group_manager.load_model_data(sert) for sert in group_manager.serts_to_print]
+            self.assertFalse(group_manager.fatal_error)
+            # те же данные, что дает ModelDataLoader запросами по каждому сертификату
+            for sert, (kernel_data, attach_data, melt_data) in zip(group_manager.serts_to_print, loaded_list):
+                attach_list = list(ModelDataLoader.get_attachment_data(sert))
+                self.assertEqual(kernel_data, ModelDataLoader.get_kernel_data(sert))
+                self.assertEqual({attach.pk for attach in attach_data}, {attach.pk for attach in attach_list})
+                self.assertEqual(len(attach_data), 3 if sert.number_unique.number % 2 else 4)
+                melt_list = [melt for attach in attach_list for melt in ModelDataLoader.get_melt_data(attach)]
+                self.assertEqual({melt.pk for melt in melt_data}, {melt.pk for melt in melt_list})
+
+
+class ReferenceDataTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('sert.models_refdata._reference_data', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Conclusion.objects.create(conclusion_type='MAIN', conclusion_text='Изделие годно')
+        Guarantee.objects.create(guarantee_type='MAIN', guarantee_text='12 месяцев')
+        Signatories.objects.create(sign_type='MAIN', sign_person='Иванов И.И.', sign_job_title='Начальник ОТК')
+
+    def test_reloaded_after_edit(self):
+        with self.assertNumQueries(3):
+            reference_data = get_reference_data()
+        self.assertEqual(reference_data.get_conclusion_text('MAIN'), 'Изделие годно')
+        # без изменений справочников - тот же объект, без запросов
+        with self.assertNumQueries(0):
+            self.assertIs(get_reference_data(), reference_data)
+
+        conclusion = Conclusion.objects.get(conclusion_type='MAIN')
+        conclusion.conclusion_text = 'Изделие соответствует ТУ'
+        conclusion.save()
+        with self.assertNumQueries(3):
+            reference_data = get_reference_data()
+        self.assertEqual(reference_data.get_conclusion_text('MAIN'), 'Изделие соответствует ТУ')
+
+        Signatories.objects.filter(sign_type='MAIN').get().delete()
+        Guarantee.objects.create(guarantee_type='MAIN', guarantee_text='24 месяца')
+        reference_data = get_reference_data()
+        self.assertEqual(reference_data.get_signatories('MAIN'), [])
+        self.assertEqual(reference_data.get_guarantee_texts('MAIN'), ['12 месяцев', '24 месяца'])
+
+
+class DocxSkeletonTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        docx_skeletons.clear()
+        self.addCleanup(docx_skeletons.clear)
+
+    @mock.patch('sert.createdocx2.DocxSkeleton', side_effect=lambda sert_incarno: object())
+    def test_skeleton_rebuilt_after_head_image_change(self, skeleton_mock):
+        head_image = os.path.join(self.tmp_dir.name, 'header.jpg')
+        with open(head_image, 'wb') as image_file:
+            image_file.write(b'old')
+        si = SimpleNamespace(organization='ORG', page_orientation='portrait', head_image=head_image)
+        skeleton = get_docx_skeleton(si)
+        self.assertIs(get_docx_skeleton(si), skeleton)
+
+        with open(head_image, 'wb') as image_file:
+            image_file.write(b'new image')
+        stat = os.stat(head_image)
+        os.utime(head_image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNot(get_docx_skeleton(si), skeleton)
+        self.assertEqual(skeleton_mock.call_count, 2)
+        self.assertEqual(len(docx_skeletons), 1)
+
+
+class DocxCacheTest(TestCase):
+    # документ собирается заново, только если изменилось то, из чего он собран; сборку заменяет mock
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        settings_override = override_settings(PRINT_DOCX_CACHE_DIR=os.path.join(self.tmp_dir.name, 'docx_cache'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    @staticmethod
+    def make_si(sert_id, number):
+        si = SimpleNamespace(sert_id=sert_id, **{name: None for name in SertPrintData.FIELDS})
+        si.sert_type = 'НАСОС'
+        si.organization = 'ORG'
+        si.page_orientation = 'portrait'
+        si.main_tab = [['Номер сертификата', number], ['Дата', '01.01.2030']]
+        si.docx_tab = [Signatories(pk=1, sign_type='MAIN', sign_person='Иванов И.И.', sign_job_title='Начальник ОТК')]
+        return si
+
+    @staticmethod
+    def print_serts(si_list):
+        # (содержимое документов, sert_id собранных заново)
+        group_manager = GroupManager.__new__(GroupManager)
+        group_manager.render_workers = 1
+        group_manager.tracer = NULL_TRACER
+        group_manager.serts_incarnations_list = si_list
+
+        def render(si, is_traced):
+            return f'{si.sert_id} {si.main_tab[0][1]} {si.docx_tab[0].sign_person}'.encode('utf-8'), []
+        with mock.patch('sert.createdocx2.render_docx_content', side_effect=render) as render_mock:
+            contents = list(group_manager.iter_docx_contents())
+        return contents, [call.args[0].sert_id for call in render_mock.call_args_list]
+
+    def test_hit_then_miss_after_change(self):
+        si_list = [self.make_si('ТЕСТ-1', '1-2030'), self.make_si('ТЕСТ-2', '2-2030')]
+        contents, rendered = self.print_serts(si_list)
+        self.assertEqual(rendered, ['ТЕСТ-1', 'ТЕСТ-2'])
+        self.assertEqual(self.print_serts(si_list), (contents, []))
+
+        # строка сертификата и запись справочника в таблице - другой ключ
+        si_list[0].main_tab[0][1] = '7-2030'
+        si_list[1].docx_tab[0].sign_person = 'Петров П.П.'
+        contents, rendered = self.print_serts(si_list)
+        self.assertEqual(rendered, ['ТЕСТ-1', 'ТЕСТ-2'])
+        self.assertEqual(contents, ['ТЕСТ-1 7-2030 Иванов И.И.'.encode('utf-8'),
+                                    'ТЕСТ-2 2-2030 Петров П.П.'.encode('utf-8')])
+        self.assertEqual(self.print_serts(si_list), (contents, []))
+
+        # новая версия печати - прежние документы из cache не берутся
+        cache_key = get_docx_cache_key(si_list[0])
+        with mock.patch('sert.createdocx2.DOCX_CACHE_VERSION', DOCX_CACHE_VERSION + 1):
+            self.assertNotEqual(get_docx_cache_key(si_list[0]), cache_key)
+            self.assertEqual(self.print_serts(si_list), (contents, ['ТЕСТ-1', 'ТЕСТ-2']))
+
+
+class DocxTableXmlTest(TestCase):
+    # таблицы DocxTableBuilder сверяются с XML, который давала сборка через python-docx (add_table,
+    # style_tabrow_set_alignment_and_font_bold, add_repeat_table_header, style_tab_set_widths_for_cols)
+    TBL_PR = ('<w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/><w:jc w:val="{}"/>'
+              '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" '
+              'w:noVBand="1" w:val="04A0"/></w:tblPr>')
+
+    @staticmethod
+    def get_docx_maker(si):
+        # только таблицы: без make_frankenstein, документ - пустой
+        docx_maker = DocxMaker.__new__(DocxMaker)
+        docx_maker.si = si
+        docx_maker.docx = Document()
+        return docx_maker
+
+    @staticmethod
+    def get_xml(element):
+        # объявления пространств имен наследуются от документа - в сверке не нужны
+        return re.sub(r' xmlns:\w+="[^"]*"', '', etree.tostring(element, encoding='unicode'))
+
+    def get_last_tbl(self, docx_maker):
+        return docx_maker.docx.element.body.findall('{*}tbl')[-1]
+
+    def get_rows_xml(self, tbl):
+        return [self.get_xml(tr) for tr in tbl.findall('{*}tr')]
+
+    def get_head_xml(self, tbl):
+        return self.get_xml(tbl.find('{*}tblPr')) + self.get_xml(tbl.find('{*}tblGrid'))
+
+    def test_parts_table_xml(self):
+        si = SimpleNamespace(is_symmetrical=True, main_parts_tab=SimpleNamespace(
+            head_row=['№', 'Наименование', 'Обозначение', 'Кол.'],
+            # короткая строка - пустые ячейки до конца; табуляция и перевод строки - w:tab и w:br
+            symm_data_rows=[['1', 'Корпус', 'СПГ.001\tисп. 2', '1'], ['2', 'Крышка\nверхняя']],
+        ))
+        docx_maker = self.get_docx_maker(si)
+        docx_maker.setting_body_for_main_parts_tab()
+        tbl = self.get_last_tbl(docx_maker)
+
+        self.assertEqual(self.get_head_xml(tbl), self.TBL_PR.format('center') + (
+            '<w:tblGrid><w:gridCol w:w="567"/><w:gridCol w:w="3402"/><w:gridCol w:w="5669"/>'
+            '<w:gridCol w:w="1134"/></w:tblGrid>'))
+        self.assertEqual(self.get_rows_xml(tbl), [
+            '<w:tr><w:trPr><w:tblHeader/></w:trPr>'
+            '<w:tc><w:tcPr><w:tcW w:w="567" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>№</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="3402" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>Наименование</w:t></w:r></w:p>'
+            '</w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="5669" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>Обозначение</w:t></w:r></w:p>'
+            '</w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="1134" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>Кол.</w:t></w:r></w:p></w:tc>'
+            '</w:tr>',
+            '<w:tr>'
+            '<w:tc><w:tcPr><w:tcW w:w="567" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>1</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="3402" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>Корпус</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="5669" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>СПГ.001</w:t><w:tab/><w:t>исп. 2</w:t></w:r></w:p>'
+            '</w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="1134" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>1</w:t></w:r></w:p></w:tc>'
+            '</w:tr>',
+            '<w:tr>'
+            '<w:tc><w:tcPr><w:tcW w:w="567" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>2</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="3402" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>Крышка</w:t><w:br/><w:t>верхняя</w:t></w:r></w:p>'
+            '</w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="5669" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="1134" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr></w:p></w:tc>'
+            '</w:tr>',
+        ])
+
+    def test_chem_table_xml(self):
+        si = SimpleNamespace(is_symmetrical=True, chem_tab=SimpleNamespace(
+            head_row=['Плавка', 'Марка', 'C', 'Si'],
+            symm_data_rows=[['П-1', '20Л', '0,2', '0,3']],
+        ))
+        docx_maker = self.get_docx_maker(si)
+        docx_maker.setting_body_for_chem_tab()
+        tbl = self.get_last_tbl(docx_maker)
+
+        # 20 и 22 мм, остальные 148 мм поровну
+        self.assertEqual(self.get_head_xml(tbl), self.TBL_PR.format('center') + (
+            '<w:tblGrid><w:gridCol w:w="1134"/><w:gridCol w:w="1247"/><w:gridCol w:w="4195"/>'
+            '<w:gridCol w:w="4195"/></w:tblGrid>'))
+        self.assertEqual(self.get_rows_xml(tbl), [
+            '<w:tr><w:trPr><w:tblHeader/></w:trPr>'
+            '<w:tc><w:tcPr><w:tcW w:w="1134" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>Плавка</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="1247" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>Марка</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="4195" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>C</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="4195" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/></w:rPr><w:t>Si</w:t></w:r></w:p></w:tc>'
+            '</w:tr>',
+            '<w:tr>'
+            '<w:tc><w:tcPr><w:tcW w:w="1134" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>П-1</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="1247" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>20Л</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="4195" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>0,2</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="4195" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>0,3</w:t></w:r></w:p></w:tc>'
+            '</w:tr>',
+        ])
+
+    def test_ctk_chem_nested_table_xml(self):
+        si = SimpleNamespace(sert_number_index=0, ctk_mech_tab=SimpleNamespace(
+            chem_head_row=[['Плавка', 'C', 'Si']],
+            chem_data_rows=[[['П-1', '0,2', '0,3'], ['П-2', '0,1', '0,4'], ['П-3', '0,2', '0,2'], ['П-4', '0,3', '0,3']]],
+        ))
+        docx_maker = self.get_docx_maker(si)
+        docx_maker.setting_body_for_ctk_chem_tab()
+        outer_tbl = self.get_last_tbl(docx_maker)
+
+        # до 6 колонок - три вложенные таблицы рядом, строки раскладываются по ним по очереди;
+        # каждая ячейка внешней таблицы заканчивается пустым абзацем
+        cells = outer_tbl.findall('{*}tr/{*}tc')
+        self.assertEqual(len(cells), 3)
+        self.assertEqual([etree.QName(cell[-1]).localname for cell in cells], ['p', 'p', 'p'])
+        inner_tbls = [cell.find('{*}tbl') for cell in cells]
+        self.assertEqual([[tr[-3].findtext('.//{*}t') for tr in tbl.findall('{*}tr')[1:]] for tbl in inner_tbls],
+                         [['П-1', 'П-4'], ['П-2'], ['П-3']])
+        self.assertEqual(self.get_head_xml(inner_tbls[0]), self.TBL_PR.format('left') + (
+            '<w:tblGrid><w:gridCol w:w="907"/><w:gridCol w:w="794"/><w:gridCol w:w="794"/></w:tblGrid>'))
+        self.assertEqual(self.get_rows_xml(inner_tbls[0]), [
+            '<w:tr><w:trPr><w:tblHeader/></w:trPr>'
+            '<w:tc><w:tcPr><w:tcW w:w="907" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/><w:sz w:val="20"/></w:rPr>'
+            '<w:t>Плавка</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="794" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/><w:sz w:val="20"/></w:rPr>'
+            '<w:t>C</w:t></w:r></w:p></w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="794" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/><w:sz w:val="20"/></w:rPr>'
+            '<w:t>Si</w:t></w:r></w:p></w:tc>'
+            '</w:tr>',
+            '<w:tr>'
+            '<w:tc><w:tcPr><w:tcW w:w="907" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:sz w:val="20"/></w:rPr><w:t>П-1</w:t></w:r></w:p>'
+            '</w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="794" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:sz w:val="20"/></w:rPr><w:t>0,2</w:t></w:r></w:p>'
+            '</w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="794" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:sz w:val="20"/></w:rPr><w:t>0,3</w:t></w:r></w:p>'
+            '</w:tc>'
+            '</w:tr>',
+            '<w:tr>'
+            '<w:tc><w:tcPr><w:tcW w:w="907" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:sz w:val="20"/></w:rPr><w:t>П-4</w:t></w:r></w:p>'
+            '</w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="794" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:sz w:val="20"/></w:rPr><w:t>0,3</w:t></w:r></w:p>'
+            '</w:tc>'
+            '<w:tc><w:tcPr><w:tcW w:w="794" w:type="dxa"/><w:vAlign w:val="center"/></w:tcPr>'
+            '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:sz w:val="20"/></w:rPr><w:t>0,3</w:t></w:r></w:p>'
+            '</w:tc>'
+            '</w:tr>',
+        ])
+
+
+class PartsTabTreeTest(TestCase):
+    # РЕМКОМПЛЕКТ в 4 уровня: 1 Комплект > 1.1 Узел > 1.1.1 Деталь > 1.1.1.1 Винт, у Комплекта еще 1.2 Шайба,
+    # 2 Прокладка - без вложенных строк
+    # {уровень: (a-ключ, b-ключ)}
+    LEVEL_INDEXES = {
+        1: ('a_index', None), 2: ('a1_index', 'b_index'), 3: ('a2_index', 'b1_index'), 4: (None, 'b2_index'),
+    }
+
+    def make_attach_row(self, level, denomination, a_key=None, b_key=None, quantity='1'):
+        # строка вложения так, как ее видит create_parts_tab: a-ключ - для своих вложенных строк, b-ключ - родителя
+        values = {name: None for name in ['a_index', 'b_index', 'a1_index', 'b1_index', 'a2_index', 'b2_index']}
+        a_name, b_name = self.LEVEL_INDEXES[level]
+        if a_name:
+            values[a_name] = a_key
+        if b_name:
+            values[b_name] = b_key
+        return SimpleNamespace(
+            denomination=denomination, designation=f'ОБ.{denomination}', quantity=Decimal(quantity),
+            is_one=level == 1, is_two=level == 2, is_three=level == 3, is_four=level == 4, **values,
+        )
+
+    def make_attach_data(self):
+        return [
+            self.make_attach_row(1, 'Комплект', a_key='1'),
+            self.make_attach_row(1, 'Прокладка', a_key='2', quantity='2'),
+            self.make_attach_row(2, 'Узел', a_key='11', b_key='1'),
+            self.make_attach_row(2, 'Шайба', b_key='1', quantity='4'),
+            self.make_attach_row(3, 'Деталь', a_key='111', b_key='11'),
+            self.make_attach_row(4, 'Винт', b_key='111', quantity='3'),
+        ]
+
+    @staticmethod
+    def get_parts_tab(attach_data):
+        # только create_parts_tab: без create_tabs и справочников
+        tabs_maker = SertTabsMaker.__new__(SertTabsMaker)
+        StaticTabsMaker.__init__(tabs_maker)
+        tabs_maker.si = SimpleNamespace(kernel_data=SimpleNamespace(quantity=2), attach_data=attach_data)
+        tabs_maker.create_parts_tab()
+        return tabs_maker.si.parts_tab
+
+    @staticmethod
+    def get_docx_maker(parts_tab):
+        docx_maker = DocxMaker.__new__(DocxMaker)
+        docx_maker.si = SimpleNamespace(parts_tab=parts_tab)
+        docx_maker.docx = Document()
+        return docx_maker
+
+    def test_rows_follow_parent_child_order(self):
+        rows = self.get_parts_tab(self.make_attach_data()).symm_data_rows
+        # уровень за уровнем, дети - под номером родителя; количество - с учетом количества родителя
+        self.assertEqual([(row.order_num, row.denomination, row.quantity) for row in rows], [
+            ('1', 'Комплект', '2'), ('2', 'Прокладка', '4'),
+            ('1.1', 'Узел', '2'), ('1.2', 'Шайба', '8'),
+            ('1.1.1', 'Деталь', '2'),
+            ('1.1.1.1', 'Винт', '6'),
+        ])
+
+        docx_maker = self.get_docx_maker(None)
+        sorted_data = docx_maker.sort_data_by_attach_index(rows)
+        children_index = docx_maker.index_nested_rows(sorted_data)
+        self.assertEqual({level: {key: [row.order_num for row in level_rows] for key, level_rows in index.items()}
+                          for level, index in children_index.items()},
+                         {1: {'1': ['1.1', '1.2']}, 2: {'11': ['1.1.1']}, 3: {'111': ['1.1.1.1']}})
+        inner_rows = {}
+        for level, level_rows in enumerate(sorted_data, start=1):
+            for row in level_rows:
+                inner_list = docx_maker.get_inner_rows(row, children_index, level)
+                inner_rows[row.order_num] = [inner.order_num for inner in inner_list]
+        self.assertEqual(inner_rows, {
+            '1': ['1.1', '1.2'], '2': [], '1.1': ['1.1.1'], '1.2': [], '1.1.1': ['1.1.1.1'], '1.1.1.1': [],
+        })
+
+    def test_nested_tables_by_level(self):
+        docx_maker = self.get_docx_maker(self.get_parts_tab(self.make_attach_data()))
+        docx_maker.setting_body_for_parts_tab()
+        tbl = docx_maker.docx.element.body.findall('{*}tbl')[-1]
+
+        def get_first_texts(table):
+            return [tr.findtext('{*}tc//{*}t') for tr in table.findall('{*}tr')]
+        self.assertEqual(get_first_texts(tbl), ['№п/п', '1', 'в составе:', '2'])
+        nested_tables = {}
+        table = tbl
+        for level in [1, 2, 3]:
+            table = table.find('{*}tr/{*}tc/{*}tbl')
+            nested_tables[level] = table
+        self.assertEqual(get_first_texts(nested_tables[1]), ['1.1', 'в составе:', '1.2'])
+        self.assertEqual(get_first_texts(nested_tables[2]), ['1.1.1', 'в составе:'])
+        # строка 4-го уровня - последняя: вложенной таблицы под ней нет
+        self.assertEqual(get_first_texts(nested_tables[3]), ['1.1.1.1'])
+        self.assertIsNone(nested_tables[3].find('.//{*}tbl'))
+
+        for level, table in nested_tables.items():
+            nesting = DocxMaker.PARTS_NESTING[level]
+            fill = DocxTableBuilder.FILLS[nesting.color]
+            self.assertEqual([int(col.get(qn('w:w'))) for col in table.findall('{*}tblGrid/{*}gridCol')],
+                             [width.twips for width in nesting.widths])
+            for tr in table.findall('{*}tr'):
+                cells = tr.findall('{*}tc')
+                # у каждой ячейки одна заливка уровня; объединенная ячейка строки с вложенной таблицей -
+                # одна ячейка с одной заливкой, а не четыре
+                self.assertEqual([[shd.get(qn('w:fill')) for shd in cell.findall('{*}tcPr/{*}shd')] for cell in cells],
+                                 [[fill]] * len(cells))
+                if len(cells) == 1:
+                    self.assertEqual(cells[0].find('{*}tcPr/{*}gridSpan').get(qn('w:val')), '4')
+        # размер шрифта номера строки: строки таблицы 1-го уровня вложенности - 12, глубже - 10
+        font_sizes = {level: [tr.find('{*}tc/{*}p/{*}r/{*}rPr/{*}sz').get(qn('w:val'))
+                              for tr in table.findall('{*}tr') if len(tr.findall('{*}tc')) > 1]
+                      for level, table in nested_tables.items()}
+        self.assertEqual(font_sizes, {1: ['24', '24'], 2: ['20'], 3: ['20']})
+
+    def test_row_height_only_in_outer_table(self):
+        # 22 строки 1-го уровня и строка с вложенной таблицей: высота задается строкам внешней таблицы
+        attach_data = [self.make_attach_row(1, f'Деталь {index}', a_key=str(index)) for index in range(1, 23)]
+        attach_data.append(self.make_attach_row(2, 'Винт', b_key='1'))
+        docx_maker = self.get_docx_maker(self.get_parts_tab(attach_data))
+        docx_maker.setting_body_for_parts_tab()
+        tbl = docx_maker.docx.element.body.findall('{*}tbl')[-1]
+
+        outer_rows = tbl.findall('{*}tr')
+        self.assertEqual(len(outer_rows), 24)
+        self.assertEqual({tr.find('{*}trPr/{*}trHeight') is not None for tr in outer_rows}, {True})
+        self.assertEqual(tbl.findall('{*}tr/{*}tc/{*}tbl/{*}tr/{*}trPr/{*}trHeight'), [])
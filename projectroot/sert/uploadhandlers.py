@@ -0,0 +1,37 @@
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+
+# файлы больше этого размера (байт) не принимаются: прием обрывается на первых частях
+IMPORT_MAX_FILE_SIZE = 100 * 1024 * 1024
+# xlsx - zip-архив: книга, части которой в распакованном виде больше этого размера (байт), не разбирается
+IMPORT_MAX_UNCOMPRESSED_SIZE = 1024 * 1024 * 1024
+# любой zip-архив, а значит и xlsx-файл, начинается с этих байт
+ZIP_SIGNATURE = b'PK\x03\x04'
+
+
+class ImportFileUploadHandler(TemporaryFileUploadHandler):
+    # файл сразу пишется частями во временный файл на диске, без копии в памяти;
+    # слишком большой файл или .xlsx / .zip, который не zip-архив, отбрасывается - причина в request.upload_error
+    is_too_large = False
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.is_too_large = content_length > IMPORT_MAX_FILE_SIZE
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        if self.is_too_large:
+            self.reject(file_name)
+        super().new_file(field_name, file_name, *args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > IMPORT_MAX_FILE_SIZE:
+            self.reject(self.file_name)
+        if start == 0 and self.file_name.endswith(('.xlsx', '.zip')) and not raw_data.startswith(ZIP_SIGNATURE):
+            error_text = f'Файл "{self.file_name}" не является zip-архивом, хотя имеет такое расширение.'
+            self.request.upload_error = error_text
+            raise SkipFile()
+        return super().receive_data_chunk(raw_data, start)
+
+    def reject(self, file_name):
+        max_size = IMPORT_MAX_FILE_SIZE // (1024 * 1024)
+        error_text = f'Файл "{file_name}" больше {max_size} МБ и не принят.'
+        self.request.upload_error = error_text
+        raise SkipFile()
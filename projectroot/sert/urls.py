@@ -7,6 +7,8 @@ from sert.views import (
     OneSert,
     PrintSert,
     FileLoadFormView,
+    import_job_status,
+    import_report,
     OneSertUpdateView,
     OneKernelUpdateView,
     OneAttachmentUpdateView,
@@ -32,4 +34,6 @@ urlpatterns = [
     path('print/', cache_page(5)(PrintSert.as_view()), name='printsert'),
     path('loadfile/', cache_page(5)(FileLoadFormView.as_view()), name='loadfile'),
     path('getform/', get_loadform, name='getform'),
+    path('importjob/<int:pk>/', import_job_status, name='importjobstatus'),
+    path('importreport/<slug:report_key>/<slug:file_format>/', import_report, name='importreport'),
 ]
\ No newline at end of file
@@ -12,20 +12,28 @@ from sert.forms import BaseForm
 from django.views import View
 from django.views.generic.edit import FormView, UpdateView
 from sert.createdocx import SertMaker
-from sert.createdocx2 import GroupManager
+from sert.createdocx2 import GroupManager, get_render_workers
 
 from sert.importxlsx import ImportManager, Importer, Converter, Loader
-from sert.models import Sert, Attachment, Melt, Kernel
+from sert.importreport import get_report
+from sert.models import Sert, Attachment, Melt, Kernel, ImportJob
 from sert.forms import SertForm, SertFormUpdate, KernelFormUpdate, AttachmentFormUpdate, MeltFormUpdate
 
 
 from datetime import datetime
 from django.contrib import messages
-from django.http import HttpResponse, HttpRequest, HttpResponseRedirect, FileResponse
-from io import BytesIO
+from django.conf import settings
+from django.http import (HttpResponse, HttpRequest, HttpResponseRedirect, FileResponse, JsonResponse, Http404,
+                         StreamingHttpResponse)
+from io import BytesIO, RawIOBase
 import zipfile
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
+from django.utils.decorators import method_decorator
+from django.utils.html import format_html
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from sert.uploadhandlers import ImportFileUploadHandler
 
 
 class InstructionView(LoginRequiredMixin, TemplateView):
@@ -169,8 +177,16 @@ class PrintSert(LoginRequiredMixin, ListView):
         return Sert.objects.filter(is_print=True)
 
     def post(self, request, *args, **kwargs):
-        GM = GroupManager()
-        docx_list = GM.get_docx_list()
+        # PRINT_STREAMING_ZIP: архив отдается по мере печати, в памяти - один документ
+        is_streaming = getattr(settings, 'PRINT_STREAMING_ZIP', True)
+        # пул процессов печати из запроса - только при PRINT_RENDER_IN_REQUEST (см. sert.workers)
+        GM = GroupManager(render_workers=get_render_workers(is_request=True), is_lazy=is_streaming)
+        if is_streaming and GM.get_docx_list() is not None:
+            if GM.get_docx_count() >= 2:
+                return self.get_streaming_response(GM)
+            docx_list = list(GM.iter_docx_list())
+        else:
+            docx_list = GM.get_docx_list()
         if not docx_list:
             errors = GM.get_error()
             for level, text in errors:
@@ -182,6 +198,13 @@ class PrintSert(LoginRequiredMixin, ListView):
         response['Content-Disposition'] = f'attachment; filename="{export_file.filename}"'
         return response
 
+    @staticmethod
+    def get_streaming_response(GM):
+        ZSM = ZipStreamMaker(GM.iter_docx_list())
+        response = StreamingHttpResponse(ZSM.iter_content(), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="{ZSM.filename}"'
+        return response
+
 
 @login_required
 def is_print_switch(request, id):
@@ -229,6 +252,9 @@ class FileMaker:
 
     @staticmethod
     def get_file_content(docx_nt):
+        # при параллельной печати GroupManager отдает уже готовое содержимое .docx
+        if isinstance(docx_nt.content, bytes):
+            return docx_nt.content
         with BytesIO() as buffer:
             document = docx_nt.content
             document.save(buffer)
@@ -246,6 +272,8 @@ class FileMaker:
 
     @staticmethod
     def get_file_read_content(docx_nt_content):
+        if isinstance(docx_nt_content, bytes):
+            return docx_nt_content
         with BytesIO() as buffer:
             docx_nt_content.save(buffer)
             buffer.seek(0)
@@ -262,7 +290,7 @@ class FileMaker:
                     content=self.get_file_read_content(docx_nt.content),
                 ))
 
-            with zipfile.ZipFile(mem_zip, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+            with zipfile.ZipFile(mem_zip, mode="w", compression=zipfile.ZIP_STORED) as zf:
                 for docx_tuple in docx_tuples_list:  # итерирует кортеж
                     zf.writestr(docx_tuple.filename, docx_tuple.content)
             content = mem_zip.getvalue()
@@ -275,22 +303,153 @@ class FileMaker:
             )
 
 
+class ZipStreamBuffer(RawIOBase):
+    # поток без seek: zipfile пишет в него архив с дескрипторами данных после каждой записи,
+    # а ZipStreamMaker забирает накопленное после каждого файла
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop_content(self):
+        content = b''.join(self.chunks)
+        self.chunks = []
+        return content
+
+
+class ZipStreamMaker:
+    # архив из docx_parts (content - bytes) для StreamingHttpResponse: каждый документ уходит клиенту,
+    # как только напечатан; .docx уже сжат, поэтому хранится без повторного сжатия (ZIP_STORED)
+    def __init__(self, docx_parts_iter):
+        self.docx_parts_iter = docx_parts_iter
+        pre_name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self.filename = f'{pre_name}_serts.zip'
+
+    def iter_content(self):
+        buffer = ZipStreamBuffer()
+        with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as zf:
+            for docx_nt in self.docx_parts_iter:
+                zf.writestr(f'{docx_nt.name}.{docx_nt.format}', FileMaker.get_file_read_content(docx_nt.content))
+                yield buffer.pop_content()
+        # оглавление архива
+        yield buffer.pop_content()
+
+
 class FileLoadFormView(LoginRequiredMixin, FormView):
     template_name = 'sert/forloadfile.html'
     form_class = BaseForm
     success_url = reverse_lazy('loadfile')
 
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        # загружаемый файл сразу пишется на диск и проверяется по размеру и заголовку zip еще при приеме;
+        # обработчики меняются до чтения тела запроса, поэтому проверка CSRF (она читает POST) - после них
+        request.upload_handlers = [ImportFileUploadHandler(request)]
+        return self.dispatch_protected(request, *args, **kwargs)
+
+    @method_decorator(csrf_protect)
+    def dispatch_protected(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['job_id'] = self.get_job_id(self.request.GET.get('job'))
+        return context
+
+    @staticmethod
+    def get_job_id(job):
+        # ?job= - номер задания после постановки в очередь; другое значение - страница без опроса задания
+        try:
+            job_id = int(job)
+        except (TypeError, ValueError):
+            return None
+        if job_id <= 0:
+            return None
+        return job_id
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['upload_error'] = getattr(self.request, 'upload_error', None)
+        return kwargs
+
     def form_valid(self, form):
         # This method is called when valid form data has been POSTed.
         # It should return an HttpResponse.
+        # файл загружает importworker, страница опрашивает importjobstatus
         file = self.request.FILES['file']
-        IM = ImportManager()
-        IM.set_file(file)
-        for_messages_list = IM.get_errors() # (level, text,)
-        if not for_messages_list:
-            pass
-        else:
-            for level, text in for_messages_list:
+        if form.cleaned_data['is_dry_run']:
+            # проверка без записи в базу идет сразу, в запросе
+            IM = ImportManager(is_dry_run=True, is_stale_deleted=form.cleaned_data['is_stale_deleted'], is_cached=True,
+                               is_stats_shown=self.request.user.is_staff)
+            IM.set_file(file)
+            for level, text in IM.get_errors(): # (level, text,)
                 messages.add_message(self.request, level, text,)
-        return super().form_valid(form)
+            report_key = IM.save_report(self.request.user.id)
+            if report_key is not None:
+                text = format_html('Отчет проверки по строкам файла: <a href="{}">xlsx</a>, <a href="{}">CSV</a>.',
+                                   reverse('importreport', args=[report_key, 'xlsx']),
+                                   reverse('importreport', args=[report_key, 'csv']))
+                messages.add_message(self.request, messages.INFO, text,)
+            return super().form_valid(form)
+        job = ImportJob.objects.create(file=file, file_name=file.name, user=self.request.user, is_bulk=True,
+                                       is_stale_deleted=form.cleaned_data['is_stale_deleted'])
+        text = f'Файл "{file.name}" поставлен в очередь на загрузку.'
+        messages.add_message(self.request, messages.INFO, text,)
+        return HttpResponseRedirect(f'{self.get_success_url()}?job={job.id}')
+
+
+@login_required
+def import_job_status(request, pk):
+    try:
+        job = ImportJob.objects.get(pk=pk)
+    except ObjectDoesNotExist:
+        raise Http404
+    if job.user_id != request.user.id and not request.user.is_staff:
+        raise Http404
+    job_messages = [
+        {'level': level, 'tag': messages.DEFAULT_TAGS.get(level, ''), 'text': text,}
+        for level, text in job.messages
+    ]
+    data = {
+        'id': job.id,
+        'file_name': job.file_name,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'is_finished': job.status in ['DONE', 'FAILED'],
+        'progress': job.get_progress(),
+        'messages': job_messages,
+        'report_urls': get_report_urls(job.report_key),
+    }
+    return JsonResponse(data)
+
+
+def get_report_urls(report_key):
+    if not report_key:
+        return {}
+    return {file_format: reverse('importreport', args=[report_key, file_format]) for file_format in ['xlsx', 'csv']}
+
+
+@login_required
+def import_report(request, report_key, file_format):
+    # отчет загрузки (ImportManager.save_report) скачивает тот, кто загружал файл, или сотрудник
+    report = get_report(report_key)
+    if report is None:
+        raise Http404
+    if report.user_id != request.user.id and not request.user.is_staff:
+        raise Http404
+    if file_format == 'xlsx':
+        response = HttpResponse(content=report.get_xlsx_content(),
+                                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    elif file_format == 'csv':
+        response = HttpResponse(content=report.get_csv_content(), content_type='text/csv; charset=utf-8')
+    else:
+        raise Http404
+    response['Content-Disposition'] = f'attachment; filename="import_report_{report_key[:8]}.{file_format}"'
+    return response
 
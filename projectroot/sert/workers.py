@@ -0,0 +1,27 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+
+
+def init_worker():
+    # при spawn процесс пула запускается заново - Django в нем настраивается до первого задания
+    django.setup()
+
+
+def get_process_pool(max_workers):
+    # Пул запускается только там, где процесс однопоточный и живет долго: importworker, команды manage.py.
+    # В процессе сайта fork копирует блокировки, которые держат потоки других запросов (logging, соединения),
+    # и процесс пула может на них зависнуть; к тому же каждый запрос платил бы за запуск процессов.
+    # Из запросов сайта пул запускает только печать и только при settings.PRINT_RENDER_IN_REQUEST (sert.createdocx2)
+    # fork запускает процессы пула без повторного импорта проекта; задания пула с базой не работают,
+    # поэтому унаследованные соединения им не мешают. Где fork нет (Windows) - spawn
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+    else:
+        mp_context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp_context,
+        initializer=init_worker,
+    )